@@ -0,0 +1,192 @@
+"""In-memory pre-aggregation of metrics before they are queued"""
+import atexit
+import math
+import threading
+import time
+
+from metric_record import Metric
+
+PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+
+class LogSketch:
+    """Mergeable quantile sketch with bounded relative error (DDSketch-style)
+
+    Values are counted in logarithmically sized buckets, so any quantile is
+    answered within ``relative_accuracy`` of the true value and two sketches
+    merge by adding their bucket counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value > 0:
+            key = math.ceil(math.log(value) / self._log_gamma)
+            self.positive[key] = self.positive.get(key, 0) + 1
+        elif value < 0:
+            key = math.ceil(math.log(-value) / self._log_gamma)
+            self.negative[key] = self.negative.get(key, 0) + 1
+        else:
+            self.zero_count += 1
+
+    def merge(self, other):
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+
+class Accumulator:
+    """Running count/sum/sumsq/min/max/first/last plus a quantile sketch for one series"""
+
+    __slots__ = ('count', 'sum', 'sumsq', 'min', 'max', 'first', 'first_timestamp', 'last', 'last_timestamp',
+                 'sketch')
+
+    def __init__(self, relative_accuracy):
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.first = None
+        self.first_timestamp = None
+        self.last = None
+        self.last_timestamp = -1
+        self.sketch = LogSketch(relative_accuracy)
+
+    def add(self, value, timestamp):
+        self.count += 1
+        self.sum += value
+        self.sumsq += value * value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if self.first_timestamp is None or timestamp < self.first_timestamp:
+            self.first = value
+            self.first_timestamp = timestamp
+        if timestamp >= self.last_timestamp:
+            self.last = value
+            self.last_timestamp = timestamp
+        self.sketch.add(value)
+
+    def fields(self):
+        # The fields of a rollup point, so queries merge them with raw points (see metric_record.encode_line)
+        fields = {
+            'count': float(self.count),
+            'sum': self.sum,
+            'sumsq': self.sumsq,
+            'min': self.min,
+            'max': self.max,
+            'first': self.first,
+            'last': self.last,
+        }
+        for field, q in PERCENTILES:
+            fields[field] = self.sketch.quantile(q)
+        return fields
+
+
+class Aggregator:
+    """Fold metrics into per-(name, tags, source) accumulators and flush them periodically
+
+    Each flush emits one metric per series whose ``value`` is the mean over
+    the interval. count/sum/sumsq/min/max/first/last and p50/p95/p99 travel
+    as extra fields on the same point; queries merge the first seven with raw
+    points, so sum, count and rate stay exact. Metrics whose timestamp is older than
+    ``max_delay`` seconds are not aggregated and should be queued as-is.
+    """
+
+    def __init__(self, publish, interval=10.0, max_series=100000, max_delay=60.0,
+                 relative_accuracy=0.01):
+        self.publish = publish
+        self.interval = interval
+        self.max_series = max_series
+        self.max_delay = max_delay
+        self.relative_accuracy = relative_accuracy
+        self._series = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, metric):
+        """Fold a Metric into its accumulator; False if it must be queued as-is"""
+        timestamp = metric.timestamp
+        if time.time_ns() - timestamp > self.max_delay * 1000000000:
+            return False
+
+        key = (metric.name, tuple(sorted(metric.tags.items())), metric.source)
+        with self._lock:
+            accumulator = self._series.get(key)
+            if accumulator is None:
+                if len(self._series) >= self.max_series:
+                    return False
+                accumulator = self._series[key] = Accumulator(self.relative_accuracy)
+            accumulator.add(metric.value, timestamp)
+        if self._thread is None:
+            self.start()
+        return True
+
+    def series_count(self):
+        """Number of series accumulated since the last flush"""
+        with self._lock:
+            return len(self._series)
+
+    def start(self):
+        """Start the periodic flush thread"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='aggregator-flush', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Emit one metric per accumulated series and reset the accumulators"""
+        with self._lock:
+            series, self._series = self._series, {}
+        if not series:
+            return
+        timestamp = time.time_ns()
+        metrics = []
+        for (name, tags, source), accumulator in series.items():
+            metrics.append(Metric(name, accumulator.sum / accumulator.count, dict(tags), timestamp, source,
+                                  accumulator.fields()))
+        try:
+            self.publish(metrics)
+        except Exception as e:
+            print(f"Error publishing aggregated metrics: {e}")
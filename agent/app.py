@@ -1,56 +1,144 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from celery import Celery
 import os
-from dotenv import load_dotenv
-from datetime import datetime
+import time
+import zlib
+import redis
 
-load_dotenv()
+from config import (
+    REDIS_URL, TASK_SERIALIZER, BATCH_CHUNK_SIZE, MAX_REPORTED_ERRORS, AGGREGATION_ENABLED, AGGREGATION_INTERVAL,
+    AGGREGATION_MAX_SERIES, AGGREGATION_MAX_DELAY, QUEUE_HIGH_WATER, TASK_QUEUE, SPOOL_DIR, SPOOL_MAX_BYTES,
+    SPOOL_SEGMENT_BYTES, SPOOL_FSYNC, SPOOL_DRAIN_INTERVAL, SPOOL_DRAIN_BATCH, BROKER_BACKOFF, BROKER_TIMEOUT,
+    SELF_METRICS, TELEMETRY_INTERVAL, SOURCE_FROM_ADDRESS, INGEST_SHARDS
+)
+from ingest import normalize_metric
+from sharding import ShardRouter
+from line_protocol import iter_lines, parse_line, PRECISIONS
+from statsd import StatsDListener
+from aggregator import Aggregator
+from spool import Spool, SpoolDrainer, BrokerHealth
+from telemetry import telemetry, Reporter
 
 app = Flask(__name__)
 CORS(app)
 
-# Celery client to send tasks to worker
+telemetry.service = 'agent'
+
+# Celery client to send tasks to worker. Ingest is fire-and-forget: no result
+# backend, so no result keys are written to Redis for tasks nobody waits on.
 celery_app = Celery(
     'theia_agent',
-    broker=os.getenv('REDIS_URL', 'redis://redis:6379/0'),
-    backend=os.getenv('REDIS_URL', 'redis://redis:6379/0')
+    broker=REDIS_URL
 )
 
 celery_app.conf.update(
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
+    task_serializer=TASK_SERIALIZER,
+    accept_content=['msgpack', 'json'],
+    task_ignore_result=True,
     timezone='UTC',
     enable_utc=True,
+    broker_transport_options={'socket_connect_timeout': BROKER_TIMEOUT, 'socket_timeout': BROKER_TIMEOUT},
 )
 
+if SPOOL_DIR:
+    # Fail fast when the broker is down; the spool absorbs the outage instead of the request
+    celery_app.conf.broker_transport_options.update(max_retries=1, interval_start=0)
+
+router = ShardRouter(TASK_QUEUE, INGEST_SHARDS)
+
+spool = Spool(
+    SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES, segment_bytes=SPOOL_SEGMENT_BYTES, fsync=SPOOL_FSYNC
+) if SPOOL_DIR else None
+
+broker = BrokerHealth(
+    redis.Redis.from_url(REDIS_URL, socket_connect_timeout=BROKER_TIMEOUT, socket_timeout=BROKER_TIMEOUT),
+    router.queues(), high_water=QUEUE_HIGH_WATER, backoff=BROKER_BACKOFF
+) if spool is not None else None
+
+
+def publish_spooled(records):
+    """Replay spooled (task_name, payload) records to the broker"""
+    with celery_app.producer_or_acquire() as producer:
+        for task_name, payload in records:
+            celery_app.send_task(task_name, args=[payload], queue=router.payload_queue(task_name, payload),
+                                 producer=producer, retry=False, ignore_result=True,
+                                 headers={'enqueued_at': time.time()})
+
+
+drainer = SpoolDrainer(
+    spool, publish_spooled, can_publish=broker.refresh, interval=SPOOL_DRAIN_INTERVAL,
+    batch_size=SPOOL_DRAIN_BATCH
+) if spool is not None else None
+
+
+def publish(task_name, payload, queue):
+    """Send a task to the broker, spooling it to disk when the broker is down or saturated"""
+    # The worker measures queue wait from the enqueued_at header
+    with telemetry.timer('publish_seconds'):
+        if spool is None:
+            celery_app.send_task(task_name, args=[payload], queue=queue, ignore_result=True,
+                                 headers={'enqueued_at': time.time()})
+            return
+        if broker.available():
+            try:
+                celery_app.send_task(task_name, args=[payload], queue=queue, retry=False, ignore_result=True,
+                                     headers={'enqueued_at': time.time()})
+                return
+            except Exception as e:
+                telemetry.incr('publish_errors')
+                broker.mark_down(e)
+        spool.append(task_name, payload)
+        telemetry.incr('spooled_tasks')
+        drainer.start()
+
+
+def send_batch(metrics):
+    """Send metrics to the worker, one task per chunk of one shard"""
+    for queue, chunk in router.route(metrics, BATCH_CHUNK_SIZE):
+        publish('process_metric_batch', chunk, queue)
+
+
+aggregator = Aggregator(
+    send_batch,
+    interval=AGGREGATION_INTERVAL,
+    max_series=AGGREGATION_MAX_SERIES,
+    max_delay=AGGREGATION_MAX_DELAY,
+) if AGGREGATION_ENABLED else None
+
+
+def queue_metrics(metrics):
+    """Queue normalized metrics, folding them into the aggregator when enabled"""
+    if aggregator is not None:
+        metrics = [metric for metric in metrics if not aggregator.add(metric)]
+    send_batch(metrics)
+
+
+def client_source():
+    """Source for metrics that do not name one: the client address, unless AGENT_SOURCE_FROM_ADDRESS is off"""
+    return request.remote_addr if SOURCE_FROM_ADDRESS else None
+
 
 @app.route('/metrics', methods=['POST'])
 def receive_metric():
     """Receive metrics from clients and queue them"""
     try:
-        data = request.get_json()
-        
-        # Validate required fields
-        if not data or 'name' not in data or 'value' not in data:
-            return jsonify({'error': 'Missing required fields: name and value'}), 400
-        
-        # Prepare metric data
-        metric_data = {
-            'name': data['name'],
-            'value': data['value'],
-            'tags': data.get('tags', {}),
-            'timestamp': data.get('timestamp', datetime.utcnow().isoformat()),
-            'source': data.get('source', request.remote_addr)
-        }
+        with telemetry.timer('parse_seconds'):
+            data = request.get_json()
+            metric_data, error = normalize_metric(data, default_source=client_source())
+        if error:
+            telemetry.incr('metrics_rejected')
+            return jsonify({'error': error}), 400
+        telemetry.incr('metrics_received')
         
         # Queue the metric for processing
-        celery_app.send_task('process_metric', args=[metric_data])
+        if aggregator is None or not aggregator.add(metric_data):
+            publish('process_metric', metric_data, router.queue_for(metric_data))
         
         return jsonify({'status': 'queued', 'message': 'Metric queued for processing'}), 202
         
     except Exception as e:
+        telemetry.incr('request_errors')
         return jsonify({'error': str(e)}), 500
 
 
@@ -58,33 +146,94 @@ def receive_metric():
 def receive_metrics_batch():
     """Receive multiple metrics in a batch"""
     try:
+        started = time.perf_counter()
         data = request.get_json()
         
         if not data or 'metrics' not in data:
             return jsonify({'error': 'Missing required field: metrics'}), 400
         
         metrics = data['metrics']
-        queued_count = 0
+        if not isinstance(metrics, list):
+            return jsonify({'error': 'Field metrics must be a list'}), 400
         
-        for metric in metrics:
-            if 'name' in metric and 'value' in metric:
-                metric_data = {
-                    'name': metric['name'],
-                    'value': metric['value'],
-                    'tags': metric.get('tags', {}),
-                    'timestamp': metric.get('timestamp', datetime.utcnow().isoformat()),
-                    'source': metric.get('source', request.remote_addr)
-                }
-                celery_app.send_task('process_metric', args=[metric_data])
-                queued_count += 1
+        accepted = []
+        rejected = []
+        for index, metric in enumerate(metrics):
+            metric_data, error = normalize_metric(metric, default_source=client_source())
+            if error:
+                rejected.append({'index': index, 'error': error})
+            else:
+                accepted.append(metric_data)
+        telemetry.observe('parse_seconds', time.perf_counter() - started)
+        telemetry.incr('metrics_received', len(accepted))
+        telemetry.incr('metrics_rejected', len(rejected))
+        
+        # One task per chunk instead of one per metric
+        queue_metrics(accepted)
+        
+        return jsonify({
+            'status': 'queued',
+            'queued_count': len(accepted),
+            'total_count': len(metrics),
+            'rejected_count': len(rejected),
+            'rejected': rejected
+        }), 202
+        
+    except Exception as e:
+        telemetry.incr('request_errors')
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/write', methods=['POST'])
+@app.route('/api/v2/write', methods=['POST'])
+def receive_line_protocol():
+    """Receive metrics as InfluxDB line protocol, parsed as the body streams in"""
+    try:
+        precision = request.args.get('precision', 'ns')
+        if precision not in PRECISIONS:
+            return jsonify({'error': f'Unsupported precision: {precision}'}), 400
+        gzipped = request.headers.get('Content-Encoding', '').lower() == 'gzip'
+        
+        chunk = []
+        queued_count = 0
+        rejected_count = 0
+        rejected = []
+        # Reading and parsing the body, excluding the time spent queueing chunks
+        parse_seconds = 0.0
+        started = time.perf_counter()
+        for line_number, line in enumerate(iter_lines(request.stream, gzipped=gzipped), start=1):
+            try:
+                chunk.extend(parse_line(line, precision=precision, default_source=client_source()))
+            except ValueError as e:
+                rejected_count += 1
+                if len(rejected) < MAX_REPORTED_ERRORS:
+                    rejected.append({'line': line_number, 'error': str(e)})
+                continue
+            if len(chunk) >= BATCH_CHUNK_SIZE:
+                parse_seconds += time.perf_counter() - started
+                queue_metrics(chunk)
+                queued_count += len(chunk)
+                chunk = []
+                started = time.perf_counter()
+        parse_seconds += time.perf_counter() - started
+        telemetry.observe('parse_seconds', parse_seconds)
+        if chunk:
+            queue_metrics(chunk)
+            queued_count += len(chunk)
+        telemetry.incr('metrics_received', queued_count)
+        telemetry.incr('metrics_rejected', rejected_count)
         
         return jsonify({
             'status': 'queued',
             'queued_count': queued_count,
-            'total_count': len(metrics)
+            'rejected_count': rejected_count,
+            'rejected': rejected
         }), 202
         
+    except (OSError, UnicodeDecodeError, zlib.error) as e:
+        return jsonify({'error': f'Invalid request body: {e}'}), 400
     except Exception as e:
+        telemetry.incr('request_errors')
         return jsonify({'error': str(e)}), 500
 
 
@@ -94,6 +243,43 @@ def health():
     return jsonify({'status': 'healthy'})
 
 
+@app.route('/internal/metrics', methods=['GET'])
+def internal_metrics():
+    """Stage timings, counters and gauges of this agent; format=prometheus for the text format"""
+    if request.args.get('format') == 'prometheus':
+        return Response(telemetry.prometheus(), mimetype='text/plain; version=0.0.4')
+    return jsonify(telemetry.snapshot())
+
+
+if spool is not None:
+    telemetry.gauge('spool_bytes', spool.size_bytes)
+    telemetry.gauge('queue_depth', lambda: broker.queue_depth)
+if aggregator is not None:
+    telemetry.gauge('aggregator_series', aggregator.series_count)
+
+reporter = Reporter(telemetry, interval=TELEMETRY_INTERVAL, write=queue_metrics) if SELF_METRICS else None
+
+
+
+def start_background():
+    """Start the StatsD listener, the telemetry reporter and the spool drainer"""
+    # The UDP StatsD listener is opt-in: set STATSD_PORT (e.g. 8125) to enable it.
+    statsd_port = os.getenv('STATSD_PORT')
+    if statsd_port:
+        listener = StatsDListener(queue_metrics, port=int(statsd_port), source_from_address=SOURCE_FROM_ADDRESS).start()
+        telemetry.gauge('statsd_dropped', lambda: listener.dropped)
+    if reporter is not None:
+        reporter.start()
+    # Replay anything left in the spool by a previous run
+    if drainer is not None:
+        drainer.start()
+
+
+# Under the debug reloader (FLASK_DEBUG=1) the parent process only watches files; its child serves requests
+if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    start_background()
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    app.run(host='0.0.0.0', port=8000)
 
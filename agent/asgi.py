@@ -0,0 +1,311 @@
+"""Asyncio ingest server for the agent
+
+Serves the same /metrics, /metrics/batch, /health and /internal/metrics
+routes as app.py, but publishes tasks over a pooled redis.asyncio connection
+instead of blocking a thread per request. Run it with:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import contextlib
+import time
+
+import redis
+import redis.asyncio as aioredis
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from config import (
+    REDIS_URL, TASK_SERIALIZER, BATCH_CHUNK_SIZE, AGGREGATION_ENABLED, AGGREGATION_INTERVAL, AGGREGATION_MAX_SERIES,
+    AGGREGATION_MAX_DELAY, TASK_QUEUE, REDIS_POOL_SIZE, MAX_IN_FLIGHT, QUEUE_HIGH_WATER,
+    QUEUE_POLL_INTERVAL, RETRY_AFTER_SECONDS, SPOOL_DIR, SPOOL_MAX_BYTES, SPOOL_SEGMENT_BYTES,
+    SPOOL_FSYNC, SPOOL_DRAIN_INTERVAL, SPOOL_DRAIN_BATCH, BROKER_BACKOFF, BROKER_TIMEOUT, SELF_METRICS,
+    TELEMETRY_INTERVAL, SOURCE_FROM_ADDRESS, INGEST_SHARDS
+)
+from ingest import normalize_metric
+from sharding import ShardRouter
+from aggregator import Aggregator
+from task_messages import build_task_message
+from spool import Spool, SpoolDrainer, BrokerHealth
+from telemetry import telemetry, Reporter
+
+telemetry.service = 'agent'
+
+
+class IngestState:
+    """Connection pool, admission counters and queue depth shared by the handlers"""
+
+    def __init__(self):
+        self.redis = None
+        self.in_flight = 0
+        self.queue_depth = 0
+
+
+state = IngestState()
+router = ShardRouter(TASK_QUEUE, INGEST_SHARDS)
+
+
+def task_message(task_name, payload, queue):
+    return build_task_message(task_name, [payload], queue=queue, serializer=TASK_SERIALIZER)
+
+
+def push_messages(client, task_name, routed):
+    """LPUSH task messages for (queue, payload) pairs, one LPUSH per queue in a single round trip
+
+    Returns the pipeline's execute(), which is awaitable for a redis.asyncio client.
+    """
+    by_queue = {}
+    for queue, payload in routed:
+        by_queue.setdefault(queue, []).append(task_message(task_name, payload, queue))
+    pipe = client.pipeline(transaction=False)
+    for queue, messages in by_queue.items():
+        pipe.lpush(queue, *messages)
+    return pipe.execute()
+
+
+def publish_batch_sync(metrics):
+    """Publish aggregator flushes from its background thread"""
+    client = redis.Redis.from_url(REDIS_URL)
+    try:
+        push_messages(client, 'process_metric_batch', router.route(metrics, BATCH_CHUNK_SIZE))
+    finally:
+        client.close()
+
+
+spool = Spool(
+    SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES, segment_bytes=SPOOL_SEGMENT_BYTES, fsync=SPOOL_FSYNC
+) if SPOOL_DIR else None
+
+broker = BrokerHealth(
+    redis.Redis.from_url(REDIS_URL, socket_connect_timeout=BROKER_TIMEOUT, socket_timeout=BROKER_TIMEOUT),
+    router.queues(), high_water=QUEUE_HIGH_WATER, backoff=BROKER_BACKOFF
+) if spool is not None else None
+
+
+def publish_spooled(records):
+    """Replay spooled (task_name, payload) records to the broker"""
+    pipe = broker.client.pipeline(transaction=False)
+    for task_name, payload in records:
+        queue = router.payload_queue(task_name, payload)
+        pipe.lpush(queue, task_message(task_name, payload, queue))
+    pipe.execute()
+
+
+drainer = SpoolDrainer(
+    spool, publish_spooled, can_publish=broker.refresh, interval=SPOOL_DRAIN_INTERVAL,
+    batch_size=SPOOL_DRAIN_BATCH
+) if spool is not None else None
+
+
+aggregator = Aggregator(
+    publish_batch_sync,
+    interval=AGGREGATION_INTERVAL,
+    max_series=AGGREGATION_MAX_SERIES,
+    max_delay=AGGREGATION_MAX_DELAY,
+) if AGGREGATION_ENABLED else None
+
+
+def spool_payloads(task_name, routed):
+    for _, payload in routed:
+        spool.append(task_name, payload)
+    telemetry.incr('spooled_tasks', len(routed))
+    drainer.start()
+
+
+async def publish(task_name, routed):
+    """Push one task message per (queue, payload) pair onto its queue in a single round trip
+
+    With a spool configured, payloads go to disk instead while the broker is
+    down or over the high-water mark.
+    """
+    routed = list(routed)
+    if not routed:
+        return
+    with telemetry.timer('publish_seconds'):
+        if spool is not None and not broker.available():
+            await asyncio.to_thread(spool_payloads, task_name, routed)
+            return
+        try:
+            await push_messages(state.redis, task_name, routed)
+        except (aioredis.RedisError, OSError) as e:
+            telemetry.incr('publish_errors')
+            if spool is None:
+                raise
+            broker.mark_down(e)
+            await asyncio.to_thread(spool_payloads, task_name, routed)
+
+
+def overloaded_response():
+    """Return a 429 response when the request must be shed, otherwise None"""
+    headers = {'Retry-After': str(RETRY_AFTER_SECONDS)}
+    if state.in_flight >= MAX_IN_FLIGHT:
+        error = 'Too many requests in flight'
+    # With a spool, a saturated queue is absorbed on disk instead of rejected
+    elif spool is None and state.queue_depth >= QUEUE_HIGH_WATER:
+        error = 'Ingest queue is saturated'
+    else:
+        return None
+    telemetry.incr('requests_shed')
+    return JSONResponse({'error': error}, status_code=429, headers=headers)
+
+
+@contextlib.contextmanager
+def admitted():
+    """Track a request as in flight for MAX_IN_FLIGHT"""
+    state.in_flight += 1
+    try:
+        yield
+    finally:
+        state.in_flight -= 1
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def receive_metric(request):
+    """Receive metrics from clients and queue them"""
+    rejection = overloaded_response()
+    if rejection is not None:
+        return rejection
+    with admitted():
+        try:
+            with telemetry.timer('parse_seconds'):
+                data = await read_json(request)
+                default_source = request.client.host if request.client and SOURCE_FROM_ADDRESS else None
+                metric_data, error = normalize_metric(data, default_source=default_source)
+            if error:
+                telemetry.incr('metrics_rejected')
+                return JSONResponse({'error': error}, status_code=400)
+            telemetry.incr('metrics_received')
+
+            if aggregator is None or not aggregator.add(metric_data):
+                await publish('process_metric', [(router.queue_for(metric_data), metric_data)])
+
+            return JSONResponse({'status': 'queued', 'message': 'Metric queued for processing'}, status_code=202)
+
+        except Exception as e:
+            telemetry.incr('request_errors')
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def receive_metrics_batch(request):
+    """Receive multiple metrics in a batch"""
+    rejection = overloaded_response()
+    if rejection is not None:
+        return rejection
+    with admitted():
+        try:
+            started = time.perf_counter()
+            data = await read_json(request)
+
+            if not data or 'metrics' not in data:
+                return JSONResponse({'error': 'Missing required field: metrics'}, status_code=400)
+
+            metrics = data['metrics']
+            if not isinstance(metrics, list):
+                return JSONResponse({'error': 'Field metrics must be a list'}, status_code=400)
+
+            default_source = request.client.host if request.client and SOURCE_FROM_ADDRESS else None
+            accepted = []
+            rejected = []
+            for index, metric in enumerate(metrics):
+                metric_data, error = normalize_metric(metric, default_source=default_source)
+                if error:
+                    rejected.append({'index': index, 'error': error})
+                elif aggregator is None or not aggregator.add(metric_data):
+                    accepted.append(metric_data)
+            telemetry.observe('parse_seconds', time.perf_counter() - started)
+            telemetry.incr('metrics_received', len(metrics) - len(rejected))
+            telemetry.incr('metrics_rejected', len(rejected))
+
+            await publish('process_metric_batch', router.route(accepted, BATCH_CHUNK_SIZE))
+
+            return JSONResponse({
+                'status': 'queued',
+                'queued_count': len(metrics) - len(rejected),
+                'total_count': len(metrics),
+                'rejected_count': len(rejected),
+                'rejected': rejected
+            }, status_code=202)
+
+        except Exception as e:
+            telemetry.incr('request_errors')
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def health(request):
+    """Health check endpoint"""
+    return JSONResponse({'status': 'healthy', 'in_flight': state.in_flight, 'queue_depth': state.queue_depth})
+
+
+async def internal_metrics(request):
+    """Stage timings, counters and gauges of this agent; format=prometheus for the text format"""
+    if request.query_params.get('format') == 'prometheus':
+        return PlainTextResponse(telemetry.prometheus(), media_type='text/plain; version=0.0.4')
+    return JSONResponse(telemetry.snapshot())
+
+
+telemetry.gauge('in_flight', lambda: state.in_flight)
+telemetry.gauge('queue_depth', lambda: state.queue_depth)
+if spool is not None:
+    telemetry.gauge('spool_bytes', spool.size_bytes)
+if aggregator is not None:
+    telemetry.gauge('aggregator_series', aggregator.series_count)
+
+reporter = Reporter(telemetry, interval=TELEMETRY_INTERVAL, write=publish_batch_sync) if SELF_METRICS else None
+
+
+async def poll_queue_depth():
+    """Refresh the broker queue length used for backpressure"""
+    while True:
+        try:
+            pipe = state.redis.pipeline(transaction=False)
+            for queue in router.queues():
+                pipe.llen(queue)
+            state.queue_depth = sum(await pipe.execute())
+        except Exception as e:
+            print(f"Error polling queue depth: {e}")
+        await asyncio.sleep(QUEUE_POLL_INTERVAL)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Requests wait for a pooled connection instead of failing when all are busy
+    pool = aioredis.BlockingConnectionPool.from_url(
+        REDIS_URL, max_connections=REDIS_POOL_SIZE, timeout=5, socket_connect_timeout=BROKER_TIMEOUT
+    )
+    state.redis = aioredis.Redis(connection_pool=pool)
+    poller = asyncio.create_task(poll_queue_depth())
+    if reporter is not None:
+        reporter.start()
+    if drainer is not None:
+        # Replay anything left in the spool by a previous run
+        drainer.start()
+    try:
+        yield
+    finally:
+        # Uvicorn has stopped accepting and waited for in-flight requests (--timeout-graceful-shutdown)
+        if aggregator is not None:
+            await asyncio.to_thread(aggregator.flush)
+        poller.cancel()
+        await state.redis.aclose()
+        await pool.disconnect()
+
+
+app = Starlette(
+    routes=[
+        Route('/metrics', receive_metric, methods=['POST']),
+        Route('/metrics/batch', receive_metrics_batch, methods=['POST']),
+        Route('/health', health, methods=['GET']),
+        Route('/internal/metrics', internal_metrics, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
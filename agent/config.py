@@ -0,0 +1,49 @@
+"""Agent settings read from the environment"""
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+# Task payload encoding; the worker accepts both msgpack and json
+TASK_SERIALIZER = os.getenv('AGENT_TASK_SERIALIZER', 'msgpack')
+
+# Maximum number of metrics shipped to the worker in one task message
+BATCH_CHUNK_SIZE = int(os.getenv('AGENT_BATCH_CHUNK_SIZE', '1000'))
+# Line-level errors reported back per /write request
+MAX_REPORTED_ERRORS = 100
+
+# Opt-in pre-aggregation: fold metrics in memory and flush one point per series per interval
+AGGREGATION_ENABLED = os.getenv('AGENT_AGGREGATION', 'false').lower() in ('1', 'true', 'yes')
+AGGREGATION_INTERVAL = float(os.getenv('AGENT_AGGREGATION_INTERVAL', '10'))
+AGGREGATION_MAX_SERIES = int(os.getenv('AGENT_AGGREGATION_MAX_SERIES', '100000'))
+AGGREGATION_MAX_DELAY = float(os.getenv('AGENT_AGGREGATION_MAX_DELAY', '60'))
+
+# Async ingest server (asgi.py)
+TASK_QUEUE = os.getenv('AGENT_TASK_QUEUE', 'celery')
+# Number of ingest queues metrics are spread over by series; workers must use the same INGEST_SHARDS
+INGEST_SHARDS = int(os.getenv('INGEST_SHARDS', '1'))
+REDIS_POOL_SIZE = int(os.getenv('AGENT_REDIS_POOL_SIZE', '32'))
+MAX_IN_FLIGHT = int(os.getenv('AGENT_MAX_IN_FLIGHT', '512'))
+QUEUE_HIGH_WATER = int(os.getenv('AGENT_QUEUE_HIGH_WATER', '100000'))
+QUEUE_POLL_INTERVAL = float(os.getenv('AGENT_QUEUE_POLL_INTERVAL', '1'))
+RETRY_AFTER_SECONDS = int(os.getenv('AGENT_RETRY_AFTER', '1'))
+
+# Durable spool used while the broker is down or over QUEUE_HIGH_WATER (disabled when unset)
+SPOOL_DIR = os.getenv('AGENT_SPOOL_DIR', '')
+SPOOL_MAX_BYTES = int(os.getenv('AGENT_SPOOL_MAX_BYTES', str(1024 ** 3)))
+SPOOL_SEGMENT_BYTES = int(os.getenv('AGENT_SPOOL_SEGMENT_BYTES', str(16 * 1024 ** 2)))
+SPOOL_FSYNC = os.getenv('AGENT_SPOOL_FSYNC', 'false').lower() in ('1', 'true', 'yes')
+SPOOL_DRAIN_INTERVAL = float(os.getenv('AGENT_SPOOL_DRAIN_INTERVAL', '1'))
+SPOOL_DRAIN_BATCH = int(os.getenv('AGENT_SPOOL_DRAIN_BATCH', '100'))
+# Seconds to skip the broker after a failed publish, so requests do not wait on timeouts
+BROKER_BACKOFF = float(os.getenv('AGENT_BROKER_BACKOFF', '5'))
+BROKER_TIMEOUT = float(os.getenv('AGENT_BROKER_TIMEOUT', '2'))
+
+# Metrics without a source get the client's address as their source, one series per client host;
+# turn off when clients sit behind NAT or are short-lived containers
+SOURCE_FROM_ADDRESS = os.getenv('AGENT_SOURCE_FROM_ADDRESS', 'true').lower() in ('1', 'true', 'yes')
+
+# With SELF_METRICS set, telemetry is ingested as theia.agent.* metrics every TELEMETRY_INTERVAL seconds
+SELF_METRICS = os.getenv('SELF_METRICS', 'false').lower() in ('1', 'true', 'yes')
+TELEMETRY_INTERVAL = float(os.getenv('TELEMETRY_INTERVAL', '10'))
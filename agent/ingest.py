@@ -0,0 +1,16 @@
+"""Validation and normalization of incoming metrics"""
+from metric_record import validate
+
+
+def normalize_metric(metric, default_source=None):
+    """Validate a client metric and return (Metric, error)"""
+    try:
+        return validate(metric, default_source), None
+    except ValueError as e:
+        return None, str(e)
+
+
+def chunked(items, size):
+    """Split a list into chunks of at most size items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
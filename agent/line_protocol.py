@@ -0,0 +1,157 @@
+"""Incremental parser for InfluxDB line protocol request bodies"""
+import math
+import time
+import zlib
+
+from metric_record import Metric, check_backslashes
+
+READ_SIZE = 64 * 1024
+
+# Multipliers converting a timestamp in the given precision to nanoseconds
+PRECISIONS = {
+    'ns': 1,
+    'us': 1000,
+    'ms': 1000000,
+    's': 1000000000,
+}
+
+
+def iter_lines(stream, gzipped=False, read_size=READ_SIZE):
+    """Yield decoded lines from a file-like body without reading it all at once"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    pending = b''
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            # The decompressor's buffered tail may still hold several lines
+            if decompressor is None:
+                break
+            chunk, decompressor = decompressor.flush(), None
+            if not chunk:
+                break
+        elif decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        pending += chunk
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if pending:
+        yield pending.decode('utf-8')
+
+
+def _split(text, separator, limit=-1):
+    """Split on separator, honouring backslash escapes and double-quoted strings"""
+    if '\\' not in text and '"' not in text:
+        return text.split(separator, limit)
+    parts = []
+    current = []
+    escaped = False
+    quoted = False
+    for char in text:
+        if escaped:
+            current.append(char)
+            escaped = False
+        elif char == '\\':
+            current.append(char)
+            escaped = True
+        elif char == '"':
+            current.append(char)
+            quoted = not quoted
+        elif char == separator and not quoted and (limit < 0 or len(parts) < limit):
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append(''.join(current))
+    return parts
+
+
+def _unescape(text):
+    if '\\' not in text:
+        return text
+    out = []
+    escaped = False
+    for char in text:
+        if escaped:
+            out.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            out.append(char)
+    return ''.join(out)
+
+
+def _field_value(raw):
+    """Convert a line protocol field value to a float, or None for non-numeric fields"""
+    if raw.startswith('"'):
+        return None
+    if raw in ('t', 'T', 'true', 'True', 'TRUE'):
+        return 1.0
+    if raw in ('f', 'F', 'false', 'False', 'FALSE'):
+        return 0.0
+    if raw[-1:] in ('i', 'u'):
+        raw = raw[:-1]
+    value = float(raw)
+    if not math.isfinite(value):
+        raise ValueError(f'Non-finite field value: {raw}')
+    return value
+
+
+def parse_line(line, precision='ns', default_source=None):
+    """Parse one line of line protocol into a list of Metrics
+
+    The measurement becomes the metric name. A field called ``value`` maps
+    to the measurement itself; any other numeric field ``f`` becomes the
+    metric ``<measurement>.<f>``. A ``source`` tag fills the metric source.
+    Timestamps are returned as integer nanoseconds.
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return []
+
+    sections = _split(line, ' ')
+    sections = [section for section in sections if section]
+    if len(sections) not in (2, 3):
+        raise ValueError('Expected measurement, fields and optional timestamp')
+
+    series = _split(sections[0], ',')
+    measurement = _unescape(series[0])
+    if not measurement:
+        raise ValueError('Missing measurement')
+
+    tags = {}
+    for pair in series[1:]:
+        key_value = _split(pair, '=', limit=1)
+        if len(key_value) != 2 or not key_value[0] or not key_value[1]:
+            raise ValueError(f'Invalid tag: {pair}')
+        tags[_unescape(key_value[0])] = _unescape(key_value[1])
+    source = tags.pop('source', default_source)
+    check_backslashes(measurement, tags, source)
+
+    if len(sections) == 3:
+        try:
+            timestamp = int(sections[2]) * PRECISIONS[precision]
+        except ValueError:
+            raise ValueError(f'Invalid timestamp: {sections[2]}')
+    else:
+        timestamp = time.time_ns()
+
+    metrics = []
+    for pair in _split(sections[1], ','):
+        key_value = _split(pair, '=', limit=1)
+        if len(key_value) != 2 or not key_value[0] or not key_value[1]:
+            raise ValueError(f'Invalid field: {pair}')
+        field = _unescape(key_value[0])
+        # Other fields become part of the metric name
+        check_backslashes(field, {})
+        try:
+            value = _field_value(key_value[1])
+        except ValueError:
+            raise ValueError(f'Invalid field value: {pair}')
+        if value is None:
+            continue
+        metrics.append(Metric(measurement if field == 'value' else f'{measurement}.{field}', value, dict(tags),
+                              timestamp, source))
+    return metrics
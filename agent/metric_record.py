@@ -0,0 +1,179 @@
+"""Compact metric records shared by the agent and the worker
+
+The agent and the backend are built as separate images, so each carries a
+copy of this module. The agent validates each metric once into a Metric
+with an integer nanosecond timestamp. A Metric is a tuple, so task messages
+carry it as a msgpack array instead of a map repeating every key, and the
+worker encodes it straight to line protocol.
+"""
+import math
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+NAIVE_EPOCH = datetime(1970, 1, 1)
+
+_ESCAPE_KEY = str.maketrans({
+    ',': r'\,',
+    '=': r'\=',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+})
+_NEEDS_ESCAPE = frozenset(',= \n\t\r\\')
+# Field holding the value (the mean) of a pre-aggregated metric
+AGGREGATE_VALUE_FIELD = 'mean'
+
+
+class Metric(namedtuple('Metric', ('name', 'value', 'tags', 'timestamp', 'source', 'fields'), defaults=(None, None))):
+    """A metric: name, float value, str tags, integer nanosecond timestamp, optional source and extra fields"""
+    __slots__ = ()
+
+    def as_dict(self):
+        return {
+            'name': self.name, 'value': self.value, 'tags': self.tags, 'timestamp': self.timestamp,
+            'source': self.source, 'fields': self.fields,
+        }
+
+
+def timestamp_ns(timestamp):
+    """Convert integer nanoseconds or an ISO 8601 string (UTC unless it has an offset) to integer nanoseconds"""
+    if type(timestamp) is int:
+        return timestamp
+    if not isinstance(timestamp, str):
+        raise ValueError('Metric timestamp must be an ISO 8601 string or integer nanoseconds')
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except ValueError:
+        raise ValueError(f'Invalid metric timestamp: {timestamp}')
+    delta = parsed - (NAIVE_EPOCH if parsed.tzinfo is None else EPOCH)
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+
+def check_backslashes(name, tags, source=None):
+    """Raise ValueError if the name, a tag or the source ends with a backslash, which line protocol cannot write"""
+    # Line protocol has no escape for a backslash before a separator (see escape)
+    if name[-1:] == '\\' or (type(source) is str and source.endswith('\\')) or any(
+        key.endswith('\\') or val.endswith('\\') for key, val in tags.items()
+    ):
+        raise ValueError('Metric name, tags and source must not end with a backslash')
+
+
+def validate(metric, default_source=None):
+    """Check a client metric in one pass and return it as a Metric; raises ValueError"""
+    if type(metric) is not dict:
+        raise ValueError('Metric must be an object')
+    try:
+        name = metric['name']
+        value = metric['value']
+    except KeyError:
+        raise ValueError('Missing required fields: name and value')
+    if type(name) is not str or not name:
+        raise ValueError('Metric name must be a non-empty string')
+
+    if type(value) is not float:
+        if isinstance(value, bool):
+            raise ValueError('Metric value must be numeric')
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError('Metric value must be numeric')
+    if not math.isfinite(value):
+        raise ValueError('Metric value must be finite')
+
+    tags = metric.get('tags')
+    if tags:
+        if type(tags) is not dict:
+            raise ValueError('Metric tags must be an object')
+        tags = {
+            key if type(key) is str else str(key): val if type(val) is str else str(val)
+            for key, val in tags.items()
+        }
+    elif tags is None or tags == {}:
+        tags = {}
+    else:
+        raise ValueError('Metric tags must be an object')
+
+    source = metric.get('source', default_source)
+    check_backslashes(name, tags, source)
+
+    timestamp = metric.get('timestamp')
+    timestamp = timestamp_ns(timestamp) if timestamp else time.time_ns()
+    return Metric(name, value, tags, timestamp, source)
+
+
+def as_record(item):
+    """Read a task payload item back into a Metric: a Metric, its list form, or the older dict form
+
+    Raises ValueError, TypeError or KeyError for a malformed item.
+    """
+    if type(item) is Metric:
+        return item
+    if isinstance(item, (list, tuple)):
+        metric = Metric(*item)
+    else:
+        timestamp = item.get('timestamp')
+        metric = Metric(item['name'], item['value'], item.get('tags') or {},
+                        timestamp_ns(timestamp) if timestamp else time.time_ns(), item.get('source'),
+                        item.get('fields'))
+    if type(metric.name) is not str or not metric.name:
+        raise ValueError('Metric name must be a non-empty string')
+    if type(metric.value) is not float:
+        metric = metric._replace(value=float(metric.value))
+    if not math.isfinite(metric.value):
+        raise ValueError('Metric value must be finite')
+    if type(metric.tags) is not dict:
+        raise TypeError('Metric tags must be an object')
+    if type(metric.timestamp) is not int:
+        metric = metric._replace(timestamp=timestamp_ns(metric.timestamp))
+    return metric
+
+
+def escape(text):
+    """Escape a line protocol measurement, tag key, tag value or field key; raises ValueError if it cannot be"""
+    if _NEEDS_ESCAPE.isdisjoint(text):
+        return text
+    # A trailing backslash would escape the separator after it, and InfluxDB keeps a doubled one as two
+    if text.endswith('\\'):
+        raise ValueError(f'Line protocol cannot write a name or tag ending with a backslash: {text!r}')
+    return text.translate(_ESCAPE_KEY)
+
+
+def format_float(value):
+    text = repr(value)
+    return text[:-2] if text.endswith('.0') else text
+
+
+def encode_line(metric, measurement='metrics'):
+    """Encode a Metric as one line of line protocol, with the metric name as the name tag
+
+    Tags are sorted, as InfluxDB prefers, and empty tags are left out. A
+    ``name`` tag is overridden by the metric's tags and ``source`` by its
+    source, as influxdb_client's Point did.
+
+    A pre-aggregated metric (one with a ``count`` field, as the agent's
+    aggregator flushes) stands for many points, so its value is written as
+    the ``mean`` field rather than ``value``. Aggregate queries then merge its
+    count, sum, min, ... fields with the values of raw points instead of
+    counting it as one point.
+    """
+    tags = metric.tags
+    if tags:
+        tags = dict(tags)
+        tags.setdefault('name', metric.name)
+    else:
+        tags = {'name': metric.name}
+    if metric.source:
+        tags['source'] = str(metric.source)
+    tag_text = ''.join([f',{escape(key)}={escape(value)}' for key, value in sorted(tags.items()) if key and value])
+
+    field_text = f'value={format_float(metric.value)}'
+    if metric.fields:
+        fields = {key: float(value) for key, value in metric.fields.items() if value is not None}
+        fields[AGGREGATE_VALUE_FIELD if 'count' in fields else 'value'] = metric.value
+        field_text = ','.join([
+            f'{escape(key)}={format_float(value)}' for key, value in sorted(fields.items()) if math.isfinite(value)
+        ])
+    return f'{measurement}{tag_text} {field_text} {metric.timestamp}'
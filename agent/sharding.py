@@ -0,0 +1,71 @@
+"""Consistent-hash routing of metrics onto per-shard ingest queues"""
+import hashlib
+
+from ingest import chunked
+from metric_record import as_record
+
+
+def series_hash(metric):
+    """Stable 64-bit hash of a Metric's series: its name, sorted tags and source"""
+    key = '\n'.join([metric.name, str(metric.source or ''), *(f'{k}={v}' for k, v in sorted(metric.tags.items()))])
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash (Lamping and Veach): the bucket of a 64-bit key among ``buckets``
+
+    Going from n to n + 1 buckets moves only 1/(n + 1) of the keys, all of
+    them into the new bucket.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_queue(queue, shard):
+    return f'{queue}.{shard}'
+
+
+class ShardRouter:
+    """Pick the ingest queue of each metric, so every series always goes to the same shard
+
+    With one shard everything goes to ``queue`` as before. With more, shard
+    i is the queue ``<queue>.<i>`` and a series is placed by a jump
+    consistent hash of its series key.
+    """
+
+    def __init__(self, queue, shards=1):
+        self.queue = queue
+        self.shards = max(shards, 1)
+
+    def queues(self):
+        if self.shards == 1:
+            return [self.queue]
+        return [shard_queue(self.queue, shard) for shard in range(self.shards)]
+
+    def queue_for(self, metric):
+        if self.shards == 1:
+            return self.queue
+        return shard_queue(self.queue, jump_hash(series_hash(metric), self.shards))
+
+    def payload_queue(self, task_name, payload):
+        """Queue of a task payload, e.g. when replaying the spool; a batch goes where its first metric does"""
+        if self.shards == 1:
+            return self.queue
+        metric = payload[0] if task_name == 'process_metric_batch' else payload
+        return self.queue_for(as_record(metric))
+
+    def route(self, metrics, chunk_size):
+        """Split metrics into (queue, chunk) pairs of at most chunk_size metrics from one shard"""
+        if self.shards == 1:
+            by_queue = {self.queue: metrics}
+        else:
+            by_queue = {}
+            for metric in metrics:
+                by_queue.setdefault(self.queue_for(metric), []).append(metric)
+        for queue, shard_metrics in by_queue.items():
+            for chunk in chunked(shard_metrics, chunk_size):
+                yield queue, chunk
@@ -0,0 +1,208 @@
+"""Durable on-disk spool for tasks that could not be sent to the broker"""
+import json
+import os
+import threading
+import time
+
+import redis
+
+SEGMENT_SUFFIX = '.spool'
+OFFSET_FILE = 'drain.offset'
+
+
+class Spool:
+    """Append-only, segmented write-ahead spool of task messages
+
+    Each record is one JSON line holding a task name and its payload. Records
+    go to the newest segment file until it reaches ``segment_bytes``, then a
+    new segment is started. When the spool exceeds ``max_bytes`` the oldest
+    segments are evicted. Draining replays records oldest-first and
+    persists its position, so a crash mid-drain replays at most one batch.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3, segment_bytes=16 * 1024 ** 2, fsync=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.evicted_records = 0
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+        self._sizes = {name: os.path.getsize(self._path(name)) for name in self._segments}
+        self._writer = None
+        self._writer_name = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _next_segment_name(self):
+        last = int(self._segments[-1][:-len(SEGMENT_SUFFIX)]) if self._segments else 0
+        return f'{last + 1:012d}{SEGMENT_SUFFIX}'
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer_name = self._next_segment_name()
+        self._writer = open(self._path(self._writer_name), 'ab')
+        self._segments.append(self._writer_name)
+        self._sizes[self._writer_name] = 0
+
+    def _evict(self):
+        """Drop the oldest sealed segments until the spool fits in max_bytes"""
+        while sum(self._sizes.values()) > self.max_bytes and len(self._segments) > 1:
+            name = self._segments.pop(0)
+            del self._sizes[name]
+            path = self._path(name)
+            with open(path, 'rb') as f:
+                self.evicted_records += sum(1 for _ in f)
+            os.remove(path)
+            print(f"Spool over {self.max_bytes} bytes, evicted segment {name}")
+
+    def append(self, task_name, payload):
+        """Persist one task message"""
+        record = json.dumps({'task': task_name, 'payload': payload}, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._writer is None or self._sizes[self._writer_name] >= self.segment_bytes:
+                self._roll()
+            self._writer.write(record)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._sizes[self._writer_name] += len(record)
+            self._evict()
+
+    def size_bytes(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def is_empty(self):
+        return self.size_bytes() == 0
+
+    def _read_offset(self):
+        try:
+            with open(self._path(OFFSET_FILE)) as f:
+                name, offset = f.read().split()
+                return name, int(offset)
+        except (OSError, ValueError):
+            return None, 0
+
+    def _write_offset(self, name, offset):
+        path = self._path(OFFSET_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(f'{name} {offset}')
+        os.replace(path + '.tmp', path)
+
+    def drain(self, publish, batch_size=100):
+        """Replay spooled records oldest-first through publish(records)
+
+        ``publish`` receives a list of (task_name, payload) tuples and must
+        raise if they could not be delivered; draining then stops and resumes
+        from the same record next time. Returns the number of records replayed.
+        """
+        replayed = 0
+        with self._drain_lock:
+            while True:
+                with self._lock:
+                    if not self._segments:
+                        return replayed
+                    name = self._segments[0]
+                    if name == self._writer_name:
+                        # Seal the active segment so new appends do not race the reader
+                        self._writer.close()
+                        self._writer = None
+                        self._writer_name = None
+                saved_name, offset = self._read_offset()
+                if saved_name != name:
+                    offset = 0
+
+                with open(self._path(name), 'rb') as f:
+                    f.seek(offset)
+                    while True:
+                        records = []
+                        for _ in range(batch_size):
+                            line = f.readline()
+                            if not line.endswith(b'\n'):
+                                break
+                            record = json.loads(line)
+                            records.append((record['task'], record['payload']))
+                        if not records:
+                            break
+                        publish(records)
+                        replayed += len(records)
+                        offset = f.tell()
+                        self._write_offset(name, offset)
+
+                with self._lock:
+                    if self._segments and self._segments[0] == name:
+                        self._segments.pop(0)
+                        del self._sizes[name]
+                        os.remove(self._path(name))
+                self._write_offset('', 0)
+
+
+class SpoolDrainer:
+    """Background thread replaying the spool once the broker accepts messages again"""
+
+    def __init__(self, spool, publish, can_publish=None, interval=1.0, batch_size=100):
+        self.spool = spool
+        self.publish = publish
+        self.can_publish = can_publish or (lambda: True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='spool-drainer', daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            # can_publish runs every tick so it can also refresh broker health
+            if not self.can_publish() or self.spool.is_empty():
+                continue
+            try:
+                replayed = self.spool.drain(self.publish, batch_size=self.batch_size)
+                if replayed:
+                    print(f"Replayed {replayed} spooled tasks")
+            except Exception as e:
+                print(f"Spool drain interrupted: {e}")
+
+
+class BrokerHealth:
+    """Circuit breaker and last known queue depth, summed over the ingest queues, used to decide when to spool"""
+
+    def __init__(self, client, queues, high_water, backoff=5.0):
+        self.client = client
+        self.queues = queues
+        self.high_water = high_water
+        self.backoff = backoff
+        self.down_until = 0.0
+        self.queue_depth = 0
+
+    def available(self):
+        return time.monotonic() >= self.down_until and self.queue_depth < self.high_water
+
+    def mark_down(self, error):
+        if time.monotonic() >= self.down_until:
+            print(f"Broker unavailable, spooling to disk: {error}")
+        self.down_until = time.monotonic() + self.backoff
+
+    def refresh(self):
+        """Poll the queue length; doubles as a broker health check for the drainer"""
+        try:
+            with self.client.pipeline(transaction=False) as pipe:
+                for queue in self.queues:
+                    pipe.llen(queue)
+                self.queue_depth = sum(pipe.execute())
+            self.down_until = 0.0
+        except redis.RedisError as e:
+            self.mark_down(e)
+            return False
+        return self.queue_depth < self.high_water
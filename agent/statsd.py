@@ -0,0 +1,101 @@
+"""UDP listener accepting StatsD and DogStatsD datagrams"""
+import math
+import socket
+import threading
+import time
+
+from metric_record import Metric, check_backslashes
+
+STATSD_TYPES = {'c', 'g', 'ms', 'h', 'd'}
+
+
+def parse_statsd(line, default_source=None):
+    """Parse one StatsD line (name:value|type[|@rate][|#tag:val,...]) into a Metric"""
+    line = line.strip()
+    if not line:
+        return None
+    name, sep, rest = line.partition(':')
+    if not sep or not name:
+        raise ValueError('Expected <name>:<value>|<type>')
+    parts = rest.split('|')
+    if len(parts) < 2 or parts[1] not in STATSD_TYPES:
+        raise ValueError(f'Unsupported metric type in: {line}')
+
+    value = float(parts[0])
+    if not math.isfinite(value):
+        raise ValueError(f'Non-finite value in: {line}')
+    metric_type = parts[1]
+    tags = {}
+    for part in parts[2:]:
+        if part.startswith('@') and metric_type == 'c':
+            rate = float(part[1:])
+            if rate > 0:
+                # Scale sampled counters back up to the full count
+                value /= rate
+        elif part.startswith('#'):
+            for tag in part[1:].split(','):
+                key, _, val = tag.partition(':')
+                if key:
+                    tags[key] = val or 'true'
+
+    source = tags.pop('source', default_source)
+    check_backslashes(name, tags, source)
+    return Metric(name, value, tags, time.time_ns(), source)
+
+
+class StatsDListener:
+    """Receive StatsD datagrams and hand them to ``publish`` in batches"""
+
+    def __init__(self, publish, host='0.0.0.0', port=8125, batch_size=1000, flush_interval=1.0,
+                 source_from_address=True):
+        self.publish = publish
+        self.source_from_address = source_from_address
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._socket = None
+
+    def start(self):
+        """Bind the socket and start the receive and flush threads"""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((self.host, self.port))
+        threading.Thread(target=self._receive, name='statsd-receive', daemon=True).start()
+        threading.Thread(target=self._flush_periodically, name='statsd-flush', daemon=True).start()
+        return self
+
+    def _receive(self):
+        while True:
+            data, address = self._socket.recvfrom(65535)
+            for line in data.decode('utf-8', errors='replace').splitlines():
+                try:
+                    metric = parse_statsd(line, default_source=address[0] if self.source_from_address else None)
+                except ValueError:
+                    self.dropped += 1
+                    continue
+                if metric is None:
+                    continue
+                with self._lock:
+                    self._buffer.append(metric)
+                    full = len(self._buffer) >= self.batch_size
+                if full:
+                    self.flush()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Publish everything buffered so far"""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            try:
+                self.publish(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                print(f"Error publishing StatsD metrics: {e}")
@@ -0,0 +1,237 @@
+"""Counters, gauges and latency histograms for a service's own hot paths
+
+The agent and the backend are built as separate images, so each carries a
+copy of this module. Instrument code through the module-level ``telemetry``
+registry; each entry point names its service with ``telemetry.service``.
+"""
+import bisect
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from metric_record import Metric
+
+# Upper bounds, in seconds, of the latency histogram buckets; one more bucket holds the rest
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'max')
+
+    def __init__(self, counts=None, total=0.0, maximum=0.0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.sum = total
+        self.max = maximum
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def copy(self):
+        return Histogram(list(self.counts), self.sum, self.max)
+
+    def since(self, previous):
+        """Observations made after the previous copy was taken; max stays the lifetime max"""
+        if previous is None:
+            return self.copy()
+        return Histogram([a - b for a, b in zip(self.counts, previous.counts)], self.sum - previous.sum, self.max)
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside the bucket it falls in"""
+        count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+        return self.max
+
+    def summary(self):
+        count = self.count
+        summary = {'count': count, 'sum': self.sum, 'mean': self.sum / count if count else None, 'max': self.max}
+        for label, q in QUANTILES:
+            summary[label] = self.quantile(q)
+        return summary
+
+
+class Telemetry:
+    """Registry of named counters, gauges and histograms
+
+    Counters only go up. Gauges are callables read when a snapshot is taken.
+    Histograms record durations in seconds, usually through timer().
+    """
+
+    def __init__(self, service='theia'):
+        self.service = service
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Time the block into the named histogram, whether or not it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def gauge(self, name, read):
+        """Register a callable returning the gauge's current value"""
+        with self._lock:
+            self._gauges[name] = read
+
+    def gauge_group(self, prefix, read):
+        """Register a callable returning a stats dict; its numeric entries become <prefix>_<key> gauges"""
+        with self._lock:
+            self._groups[prefix] = read
+
+    def gauges(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+            groups = dict(self._groups)
+        values = {}
+        for name, read in gauges.items():
+            try:
+                values[name] = read()
+            except Exception as e:
+                print(f"Error reading gauge {name}: {e}")
+                values[name] = None
+        for prefix, read in groups.items():
+            try:
+                stats = read()
+            except Exception as e:
+                print(f"Error reading gauges {prefix}: {e}")
+                continue
+            values.update(
+                (f'{prefix}_{key}', value) for key, value in stats.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)
+            )
+        return values
+
+    def state(self):
+        """Copies of the counters and histograms, for computing changes between reports"""
+        with self._lock:
+            return dict(self._counters), {name: histogram.copy() for name, histogram in self._histograms.items()}
+
+    def snapshot(self):
+        counters, histograms = self.state()
+        return {
+            'service': self.service,
+            'uptime_seconds': time.time() - self.started,
+            'counters': counters,
+            'gauges': self.gauges(),
+            'histograms': {name: histogram.summary() for name, histogram in histograms.items()},
+        }
+
+    def prometheus(self):
+        """The same data in the Prometheus text exposition format"""
+        counters, histograms = self.state()
+        prefix = f'theia_{self.service}_'
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines += [f'# TYPE {prefix}{name} counter', f'{prefix}{name} {value}']
+        for name, value in sorted(self.gauges().items()):
+            if value is not None:
+                lines += [f'# TYPE {prefix}{name} gauge', f'{prefix}{name} {value}']
+        for name, histogram in sorted(histograms.items()):
+            lines.append(f'# TYPE {prefix}{name} histogram')
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f'{prefix}{name}_sum {histogram.sum}', f'{prefix}{name}_count {cumulative}']
+        return '\n'.join(lines) + '\n'
+
+
+class Reporter:
+    """Background thread handing the telemetry to callbacks every ``interval`` seconds
+
+    publish(snapshot) receives a full snapshot. write(metrics) receives what
+    changed since the previous report as theia.<service>.<name> Metrics:
+    counter increments, gauge values and, per histogram, the count, mean
+    and quantiles of the new observations under a ``stat`` tag.
+    """
+
+    def __init__(self, telemetry, interval=10.0, publish=None, write=None, source=None):
+        self.telemetry = telemetry
+        self.interval = interval
+        self.publish = publish
+        self.write = write
+        self.source = source or socket.gethostname()
+        self._previous = ({}, {})
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self.interval > 0 and (self.publish or self.write):
+                self._thread = threading.Thread(target=self._run, name='telemetry-reporter', daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.report()
+            except Exception as e:
+                print(f"Error reporting telemetry: {e}")
+
+    def report(self):
+        if self.publish is not None:
+            self.publish(self.telemetry.snapshot())
+        if self.write is not None:
+            metrics = self.metrics()
+            if metrics:
+                self.write(metrics)
+
+    def metrics(self):
+        """Metrics for the changes since the previous call"""
+        counters, histograms = self.telemetry.state()
+        previous_counters, previous_histograms = self._previous
+        self._previous = (counters, histograms)
+        timestamp = time.time_ns()
+        prefix = f'theia.{self.telemetry.service}.'
+        tags = {'service': self.telemetry.service}
+
+        def metric(name, value, **extra):
+            return Metric(prefix + name, float(value), dict(tags, **extra), timestamp, self.source)
+
+        metrics = [metric(name, value - previous_counters.get(name, 0)) for name, value in counters.items()]
+        metrics += [metric(name, value) for name, value in self.telemetry.gauges().items() if value is not None]
+        for name, histogram in histograms.items():
+            summary = histogram.since(previous_histograms.get(name)).summary()
+            if not summary['count']:
+                continue
+            metrics += [metric(name, summary[stat], stat=stat) for stat in ('count', 'mean', 'p50', 'p90', 'p99')]
+        return metrics
+
+
+telemetry = Telemetry()
@@ -0,0 +1,131 @@
+"""Vectorized aggregation of metric points into time buckets with NumPy"""
+import numpy as np
+
+from flux_queries import PERCENTILE_PATTERN
+
+NS_PER_SECOND = 1000000000
+
+
+def aggregate_spec(aggregate_fn):
+    """Normalize an aggregate name into (function, quantile or None)"""
+    aggregate_fn = (aggregate_fn or 'mean').lower()
+    if aggregate_fn == 'avg':
+        return 'mean', None
+    if aggregate_fn == 'median':
+        aggregate_fn = 'p50'
+    match = PERCENTILE_PATTERN.match(aggregate_fn)
+    if match:
+        q = float(match.group(1)) / 100
+        if not 0 < q < 1:
+            raise ValueError(f'Invalid percentile: {aggregate_fn}')
+        return 'quantile', q
+    if aggregate_fn in ('mean', 'sum', 'count', 'min', 'max', 'first', 'last', 'stddev', 'spread', 'rate'):
+        return aggregate_fn, None
+    # Unknown functions fall back to mean, as the Flux path does
+    return 'mean', None
+
+
+def aggregate(timestamps, values, window_ns, aggregate_fn='mean', groups=None):
+    """Reduce points into one value per (group, epoch-aligned window)
+
+    timestamps are int64 epoch nanoseconds, values float64 and groups
+    optional integer codes (e.g. a series or name code per point). Cells are
+    assigned by integer division, so any window length works. Sums, counts
+    and means come from np.bincount; the other aggregates sort the points by
+    cell (and time or value where the aggregate needs it) and reduce each
+    run with np.*.reduceat.
+
+    Returns (groups, bucket starts in ns, values, counts) ordered by bucket
+    start, then group. Cells whose value is undefined (stddev of one point)
+    are left out, as Flux leaves them null.
+    """
+    fn, q = aggregate_spec(aggregate_fn)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if groups is None:
+        groups = np.zeros(len(values), dtype=np.int64)
+    else:
+        groups = np.asarray(groups, dtype=np.int64)
+    if not len(values):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float64), empty
+
+    buckets = timestamps // window_ns
+    first_bucket = buckets.min()
+    span = int(buckets.max() - first_bucket) + 1
+    keys = groups * span + (buckets - first_bucket)
+
+    # Dense cell ids when the (group, bucket) grid is small enough, otherwise compact them
+    cell_count = (int(groups.max()) + 1) * span
+    if cell_count <= 4 * len(keys) + 65536:
+        cells = keys
+        counts = np.bincount(cells, minlength=cell_count)
+        occupied = np.flatnonzero(counts)
+        cell_keys = occupied
+    else:
+        cell_keys, cells = np.unique(keys, return_inverse=True)
+        counts = np.bincount(cells)
+        occupied = np.arange(len(cell_keys))
+    counts = counts[occupied]
+
+    if fn in ('mean', 'sum', 'rate', 'stddev'):
+        sums = np.bincount(cells, weights=values)[occupied]
+        if fn == 'mean':
+            result = sums / counts
+        elif fn == 'sum':
+            result = sums
+        elif fn == 'rate':
+            result = sums / (window_ns / NS_PER_SECOND)
+        else:
+            squares = np.bincount(cells, weights=values * values)[occupied]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                variance = (squares - sums * sums / counts) / (counts - 1)
+            result = np.sqrt(np.maximum(variance, 0.0))
+            result[counts < 2] = np.nan
+    elif fn == 'count':
+        result = counts.astype(np.float64)
+    else:
+        if fn == 'quantile':
+            order = np.lexsort((values, cells))
+        elif fn in ('first', 'last'):
+            order = np.lexsort((timestamps, cells))
+        else:
+            order = np.argsort(cells, kind='stable')
+        ordered = values[order]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        if fn == 'min':
+            result = np.minimum.reduceat(ordered, starts)
+        elif fn == 'max':
+            result = np.maximum.reduceat(ordered, starts)
+        elif fn == 'spread':
+            result = np.maximum.reduceat(ordered, starts) - np.minimum.reduceat(ordered, starts)
+        elif fn == 'first':
+            result = ordered[starts]
+        elif fn == 'last':
+            result = ordered[starts + counts - 1]
+        else:
+            # Linear interpolation between the closest ranks, as numpy.quantile does
+            position = starts + q * (counts - 1)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.minimum(lower + 1, starts + counts - 1)
+            result = ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+    cell_groups = cell_keys // span
+    cell_buckets = (cell_keys % span + first_bucket) * window_ns
+    defined = ~np.isnan(result)
+    order = np.lexsort((cell_groups[defined], cell_buckets[defined]))
+    return (cell_groups[defined][order], cell_buckets[defined][order], result[defined][order],
+            counts[defined][order])
+
+
+def aggregated_row(values, name, group_by, time_bucket, value, count):
+    """One row of an aggregate query result; values holds the row's name and group_by tags"""
+    row = {
+        'name': values.get('name') or (name if isinstance(name, str) else None) or 'unknown',
+        'time_bucket': time_bucket,
+        'avg_value': float(value),  # Keep field name for compatibility
+        'count': int(count)
+    }
+    if group_by:
+        row['tags'] = {key: values.get(key) for key in group_by}
+    return row
@@ -1,18 +1,249 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-from datetime import datetime
+from werkzeug.datastructures import MultiDict
+from datetime import datetime, timedelta, timezone
+import json
+import math
 import os
+import queue
 import time
+import redis
 from dotenv import load_dotenv
 
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["ETag", "X-Next-Since", "X-Range-Start"])
 
 from influxdb_service import InfluxDB
+from storage import open_storage
+from query_cache import AggregateCache, range_start, closed_before, flux_time
+from live import LiveHub
+from columnar import ColumnarMetrics, ARROW_MIMETYPE, arrow_available
+from series_index import SeriesIndex, IndexReconciler
+from rollups import RollupManager, parse_tiers
+from flux_queries import parse_duration, group_columns, time_literal
+from query_executor import QueryExecutor, QueryTimeout, QueryRejected
+from telemetry import telemetry, Reporter
+from cardinality import CardinalityGuard, parse_limits
+from sharding import assignment, live_members, shard_queue
 
-influxdb = InfluxDB()
+telemetry.service = "backend"
+
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "16"))
+QUERY_HEAVY_SLOTS = int(os.getenv("QUERY_HEAVY_SLOTS", "4"))
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "30"))
+QUERY_QUEUE_TIMEOUT = float(os.getenv("QUERY_QUEUE_TIMEOUT", "10"))
+QUERY_HEAVY_RANGE = parse_duration(os.getenv("QUERY_HEAVY_RANGE", "24h"))
+
+# A few connections beyond the executor's workers for streamed reads and the live hub
+storage = open_storage(timeout_ms=int(QUERY_TIMEOUT * 1000), pool_size=QUERY_WORKERS + 4)
+query_executor = QueryExecutor(
+    max_workers=QUERY_WORKERS, heavy_slots=QUERY_HEAVY_SLOTS, timeout=QUERY_TIMEOUT, queue_timeout=QUERY_QUEUE_TIMEOUT
+)
+
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+QUERY_CACHE_GRACE = float(os.getenv("QUERY_CACHE_GRACE", "30"))
+QUERY_CACHE_TAIL_TTL = float(os.getenv("QUERY_CACHE_TAIL_TTL", "5"))
+
+ROLLUP_TIERS = os.getenv("ROLLUP_TIERS", "1m:14d,1h:180d,1d:1825d")
+ROLLUP_BACKFILL = os.getenv("ROLLUP_BACKFILL", "30d")
+
+# Rollup tiers are InfluxDB buckets filled by tasks; the local store aggregates raw points only
+rollups = (
+    RollupManager(
+        storage, parse_tiers(ROLLUP_TIERS, storage.bucket, grace=QUERY_CACHE_GRACE), backfill=parse_duration(ROLLUP_BACKFILL)
+    )
+    if ROLLUP_TIERS and isinstance(storage, InfluxDB)
+    else None
+)
+storage.rollups = rollups
+
+query_cache = (
+    AggregateCache(storage, max_bytes=QUERY_CACHE_MAX_BYTES, grace=QUERY_CACHE_GRACE, tail_ttl=QUERY_CACHE_TAIL_TTL)
+    if QUERY_CACHE_MAX_BYTES > 0
+    else None
+)
+
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+LIVE_CHANNEL = os.getenv("LIVE_CHANNEL", "theia:live")
+LIVE_PUSH_INTERVAL = float(os.getenv("LIVE_PUSH_INTERVAL", "0.5"))
+LIVE_HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", "15"))
+
+live_hub = LiveHub(
+    storage, REDIS_URL, LIVE_CHANNEL, push_interval=LIVE_PUSH_INTERVAL, grace=QUERY_CACHE_GRACE, executor=query_executor
+)
+
+SERIES_INDEX_PREFIX = os.getenv("SERIES_INDEX_PREFIX", "theia:index")
+SERIES_INDEX_RECONCILE_INTERVAL = float(os.getenv("SERIES_INDEX_RECONCILE_INTERVAL", "3600"))
+
+redis_client = redis.Redis.from_url(REDIS_URL)
+series_index = SeriesIndex(redis_client, prefix=SERIES_INDEX_PREFIX) if SERIES_INDEX_PREFIX else None
+reconciler = (
+    IndexReconciler(series_index, storage, interval=SERIES_INDEX_RECONCILE_INTERVAL)
+    if series_index is not None and SERIES_INDEX_RECONCILE_INTERVAL > 0
+    else None
+)
+
+# The worker enforces the cardinality limits; the backend reports on them with the same settings
+CARDINALITY_PREFIX = os.getenv("CARDINALITY_PREFIX", "theia:cardinality")
+cardinality = CardinalityGuard(
+    redis_client,
+    prefix=CARDINALITY_PREFIX,
+    max_series=int(os.getenv("CARDINALITY_MAX_SERIES", "10000")),
+    max_tag_values=int(os.getenv("CARDINALITY_MAX_TAG_VALUES", "1000")),
+    policy=os.getenv("CARDINALITY_POLICY", "drop"),
+    window=int(os.getenv("CARDINALITY_WINDOW", "3600")),
+    limits=parse_limits(os.getenv("CARDINALITY_LIMITS", "")),
+) if CARDINALITY_PREFIX else None
+
+# Shards of the ingest queue, to report how they are spread over the workers; match the workers' settings
+INGEST_QUEUE = os.getenv("INGEST_QUEUE", "celery")
+INGEST_SHARDS = int(os.getenv("INGEST_SHARDS", "1"))
+SHARD_REPLICAS = int(os.getenv("SHARD_REPLICAS", "1"))
+SHARD_PREFIX = os.getenv("SHARD_PREFIX", "theia:shards")
+
+# Workers store their telemetry under <prefix>:worker:*; with SELF_METRICS the backend's own
+# is written back as theia.backend.* metrics every TELEMETRY_INTERVAL seconds
+TELEMETRY_PREFIX = os.getenv("TELEMETRY_PREFIX", "theia:telemetry")
+TELEMETRY_INTERVAL = float(os.getenv("TELEMETRY_INTERVAL", "10"))
+SELF_METRICS = os.getenv("SELF_METRICS", "false").lower() in ("1", "true", "yes")
+
+
+def write_self_metrics(metrics):
+    storage.write_batch([storage.encode_point(metric) for metric in metrics])
+
+
+telemetry.gauge_group("executor", query_executor.stats)
+telemetry.gauge_group("live", live_hub.stats)
+if query_cache is not None:
+    telemetry.gauge_group("query_cache", query_cache.stats)
+reporter = Reporter(telemetry, interval=TELEMETRY_INTERVAL, write=write_self_metrics) if SELF_METRICS else None
+
+
+def tag_filters(args):
+    """Collect tag.<key>=<expression> query parameters into a tag filter dict
+
+    A repeated key matches any of its expressions (see flux_queries.tag_predicate).
+    """
+    return {
+        key[len("tag."):]: values[0] if len(values) == 1 else values
+        for key, values in args.lists()
+        if key.startswith("tag.") and key != "tag."
+    }
+
+
+def metric_names(args):
+    """One name, a sorted list when name is repeated, or None for all metrics"""
+    names = sorted(set(args.getlist("name")) - {""})
+    if len(names) <= 1:
+        return names[0] if names else None
+    return names
+
+
+def group_by_tags(args):
+    """Tag keys from repeated or comma-separated group_by parameters"""
+    return [key.strip() for value in args.getlist("group_by") for key in value.split(",") if key.strip()]
+
+
+TOP_BY = {
+    "mean": lambda values: sum(values) / len(values),
+    "sum": sum,
+    "max": max,
+    "min": min,
+    "last": lambda values: values[-1],
+}
+
+
+def series_key(row):
+    return row["name"], tuple(sorted((row.get("tags") or {}).items()))
+
+
+def top_series(rows, limit, by="mean"):
+    """Keep the rows of the limit series whose bucket values rank highest by the given function"""
+    values = {}
+    for row in rows:
+        values.setdefault(series_key(row), []).append(row["avg_value"])
+    keep = set(sorted(values, key=lambda key: TOP_BY[by](values[key]), reverse=True)[:limit])
+    return [row for row in rows if series_key(row) in keep]
+
+
+def parse_since(value):
+    """Parse a since cursor (ISO 8601 time) into an aware datetime"""
+    since = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return since
+
+
+def conditional(response, headers):
+    """Add an ETag to a buffered response, or turn it into 304 Not Modified when it matches If-None-Match"""
+    response.headers.update(headers)
+    response.headers["Cache-Control"] = "no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def conditional_json(data, headers):
+    with telemetry.timer("serialize_seconds"):
+        response = jsonify(data)
+    return conditional(response, headers)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """Time API requests up to the response headers; a streamed body is not included"""
+    if request.path.startswith("/api/") and "request_started" in g:
+        telemetry.observe("request_seconds", time.perf_counter() - g.request_started)
+        if response.status_code >= 500:
+            telemetry.incr("request_errors")
+    return response
+
+
+def query_error(e):
+    """Response for a query the executor timed out or turned away"""
+    if isinstance(e, QueryRejected):
+        telemetry.incr("queries_rejected")
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(math.ceil(QUERY_QUEUE_TIMEOUT))}
+    telemetry.incr("queries_timed_out")
+    return jsonify({"error": str(e)}), 504
+
+
+def encode_metrics(rows, chunk_size=1000):
+    """Encode (name, value, timestamp, tags, source) rows as a JSON array, a chunk at a time
+
+    The name/source/tags part of each object is encoded once per series. Keys are
+    sorted as jsonify sorts them. A query error part way through ends the array early.
+    """
+    prefixes = {}
+    chunk = []
+    separator = ""
+    yield "["
+    try:
+        for name, value, timestamp, tags, source in rows:
+            key = (name, source, id(tags))
+            prefix = prefixes.get(key)
+            if prefix is None:
+                prefix = prefixes[key] = '{"name":%s,"source":%s,"tags":%s,' % (
+                    json.dumps(name),
+                    json.dumps(source),
+                    json.dumps(tags, sort_keys=True, separators=(",", ":")),
+                )
+            number = repr(value) if math.isfinite(value) else json.dumps(value)
+            chunk.append(f'{separator}{prefix}"timestamp":"{timestamp}","value":{number}}}')
+            separator = ","
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+    except Exception as e:
+        print(f"Error streaming metrics: {e}")
+    yield "".join(chunk) + "]"
 
 
 @app.route("/api/metrics", methods=["GET"])
@@ -23,64 +254,417 @@ def get_metrics():
     start_time = request.args.get("start_time")
     end_time = request.args.get("end_time")
     limit = request.args.get("limit", type=int, default=1000)
+    output_format = request.args.get("format", "json")
+    if output_format not in ("json", "columnar", "arrow"):
+        return jsonify({"error": "Invalid format: expected json, columnar or arrow"}), 400
+    if output_format == "arrow" and not arrow_available():
+        return jsonify({"error": "format=arrow requires pyarrow to be installed"}), 501
+    try:
+        for bound in (start_time, end_time):
+            if bound:
+                time_literal(bound)
+    except ValueError as e:
+        return jsonify({"error": f"{e}: expected now(), a negative duration or an ISO 8601 time"}), 400
+
+    # With since, only points at or after the cursor are returned. The next cursor trails
+    # now by the grace period so late points are picked up; clients dedupe the overlap.
+    if request.args.get("since"):
+        try:
+            start_time = flux_time(parse_since(request.args["since"]))
+        except ValueError:
+            return jsonify({"error": "Invalid since: expected an ISO 8601 time"}), 400
+    next_since = datetime.now(timezone.utc) - timedelta(seconds=QUERY_CACHE_GRACE)
+    headers = {"X-Next-Since": next_since.isoformat()}
+
+    def rows():
+        try:
+            return storage.iter_metrics(
+                name=name,
+                source=source,
+                start_time=start_time,
+                end_time=end_time,
+                limit=limit,
+                iso_timestamps=output_format == "json",
+            )
+        except Exception as e:
+            print(f"Error querying storage: {e}")
+            return iter(())
+
+    def columnar():
+        try:
+            with telemetry.timer("decode_seconds"):
+                return ColumnarMetrics(rows())
+        except Exception as e:
+            print(f"Error querying storage: {e}")
+            return ColumnarMetrics(())
+
+    def buffered_json():
+        # Rows are decoded as they are encoded, so this times both
+        with telemetry.timer("serialize_seconds"):
+            return "".join(encode_metrics(rows()))
+
+    # Buffered responses are read on the query executor, under its deadline
+    try:
+        if output_format != "json":
+            columns = query_executor.run(columnar)
+            with telemetry.timer("serialize_seconds"):
+                if output_format == "arrow":
+                    response = Response(columns.to_arrow(), mimetype=ARROW_MIMETYPE)
+                else:
+                    response = Response(columns.to_json(), mimetype="application/json")
+            return conditional(response, headers)
+
+        # Delta polls are small and buffered so they can be answered with 304; full reads are
+        # streamed row by row instead of building the whole list in memory
+        if "since" in request.args or request.if_none_match:
+            body = query_executor.run(buffered_json)
+            return conditional(Response(body, mimetype="application/json"), headers)
+    except (QueryTimeout, QueryRejected) as e:
+        return query_error(e)
+    return Response(encode_metrics(rows()), mimetype="application/json", headers=headers)
+
 
-    metrics = influxdb.query_metrics(
-        name=name, source=source, start_time=start_time, end_time=end_time, limit=limit
+def aggregate_params(args):
+    """Parse the parameters of an aggregate query; raises ValueError with a message for the client"""
+    params = {
+        "name": metric_names(args),
+        "window": args.get("window", "1h"),
+        "aggregate_fn": args.get("aggregate", "mean"),  # mean, sum, max, min, count, last, p50, p95, p99
+        "tags": tag_filters(args),
+        "group_by": group_by_tags(args),
+        "top": args.get("top", type=int),
+        "top_by": args.get("top_by", "mean"),
+    }
+    try:
+        params["since"] = parse_since(args["since"]) if args.get("since") else None
+    except ValueError:
+        raise ValueError("Invalid since: expected an ISO 8601 time")
+    if params["top"] is not None and params["top"] < 1:
+        raise ValueError("Invalid top: expected a positive integer")
+    if params["top_by"] not in TOP_BY:
+        raise ValueError(f"Invalid top_by: expected one of {', '.join(TOP_BY)}")
+    group_columns(params["group_by"])
+    return params
+
+
+def plan_aggregate(params, now):
+    """Return (fetch, heavy, headers) for an aggregate query
+
+    fetch() runs the query and returns its rows. heavy is set when it would
+    aggregate more than QUERY_HEAVY_RANGE of raw points, after the cache and
+    rollup tiers have taken their share.
+    """
+    name, window, aggregate_fn, tags, group_by, top, top_by, since = (
+        params[key] for key in ("name", "window", "aggregate_fn", "tags", "group_by", "top", "top_by", "since")
     )
+    # X-Next-Since is the oldest bucket that can still change; a client passes it back as
+    # since and merges the returned buckets over the ones it holds, dropping any older
+    # than X-Range-Start.
+    start = range_start(window, now)
+    headers = {
+        "X-Next-Since": closed_before(window, now, timedelta(seconds=QUERY_CACHE_GRACE)).isoformat(),
+        "X-Range-Start": start.isoformat(),
+    }
+    # Top series are ranked over the whole range, so since is applied afterwards
+    start_time = flux_time(max(since, start)) if since is not None and top is None else None
+    if query_cache is not None:
+        query_start = query_cache.next_start(
+            name=name, window=window, aggregate_fn=aggregate_fn, tags=tags, group_by=group_by
+        )
+        heavy = query_start is not None and (
+            storage.raw_span(window, aggregate_fn, flux_time(query_start)) > QUERY_HEAVY_RANGE
+        )
+    else:
+        heavy = storage.raw_span(window, aggregate_fn, start_time) > QUERY_HEAVY_RANGE
 
-    return jsonify(metrics)
+    def fetch():
+        if query_cache is not None:
+            metrics = query_cache.query(
+                name=name, window=window, aggregate_fn=aggregate_fn, tags=tags, group_by=group_by
+            )
+        else:
+            metrics = storage.fetch_aggregated_metrics(
+                name=name,
+                window=window,
+                aggregate_fn=aggregate_fn,
+                tags=tags,
+                start_time=start_time,
+                group_by=group_by,
+            )
+        if top is not None:
+            metrics = top_series(metrics, top, top_by)
+        if since is not None and (query_cache is not None or top is not None):
+            metrics = [row for row in metrics if datetime.fromisoformat(row["time_bucket"]) >= since]
+        return metrics
+
+    return fetch, heavy, headers
 
 
 @app.route("/api/metrics/aggregate", methods=["GET"])
 def get_aggregated_metrics():
-    """Get aggregated metrics grouped by name and time window"""
+    """Get aggregated metrics grouped by name, group_by tags and time window"""
+    try:
+        fetch, heavy, headers = plan_aggregate(aggregate_params(request.args), datetime.now(timezone.utc))
+        metrics = query_executor.run(fetch, heavy=heavy)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except (QueryTimeout, QueryRejected) as e:
+        return query_error(e)
+    except Exception as e:
+        print(f"Error querying aggregated metrics: {e}")
+        telemetry.incr("aggregate_errors")
+        metrics = []
+
+    return conditional_json(metrics, headers)
+
+
+@app.route("/api/metrics/aggregate/batch", methods=["POST"])
+def batch_aggregated_metrics():
+    """Run several aggregate queries in parallel, e.g. every panel of a dashboard
+
+    Each query is an object of /api/metrics/aggregate parameters. Results come
+    back in order, each with its rows or an error and status code.
+    """
+    queries = (request.get_json(silent=True) or {}).get("queries")
+    if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+        return jsonify({"error": 'Expected {"queries": [{...parameters...}, ...]}'}), 400
+
+    now = datetime.now(timezone.utc)
+    plans = []
+    for query in queries:
+        try:
+            plans.append(plan_aggregate(aggregate_params(MultiDict(query)), now))
+        except ValueError as e:
+            plans.append(e)
+    outcomes = iter(query_executor.run_all([plan[:2] for plan in plans if not isinstance(plan, Exception)]))
+
+    results = []
+    for plan in plans:
+        outcome = plan if isinstance(plan, Exception) else next(outcomes)
+        if isinstance(outcome, ValueError):
+            results.append({"error": str(outcome), "status": 400})
+        elif isinstance(outcome, QueryRejected):
+            results.append({"error": str(outcome), "status": 503})
+        elif isinstance(outcome, QueryTimeout):
+            results.append({"error": str(outcome), "status": 504})
+        elif isinstance(outcome, Exception):
+            print(f"Error querying aggregated metrics: {outcome}")
+            results.append({"error": "Query failed", "status": 502})
+        else:
+            headers = plan[2]
+            results.append({
+                "data": outcome,
+                "next_since": headers["X-Next-Since"],
+                "range_start": headers["X-Range-Start"],
+            })
+    return jsonify({"results": results})
+
+
+@app.route("/api/metrics/stream", methods=["GET"])
+def stream_aggregated_metrics():
+    """Stream bucket updates for one aggregated series as server-sent events
+
+    Each event carries the buckets that changed, in the same shape as /api/metrics/aggregate,
+    and the current range start. Clients load the series once and merge events into it.
+    """
     name = request.args.get("name")
     window = request.args.get("window", "1h")
-    aggregate_fn = request.args.get("aggregate", "mean")  # mean, sum, max, min, count
+    aggregate_fn = request.args.get("aggregate", "mean")
+    if not name:
+        return jsonify({"error": "Missing required parameter: name"}), 400
+
+    try:
+        key, updates = live_hub.subscribe(name, window, aggregate_fn)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except (QueryTimeout, QueryRejected) as e:
+        return query_error(e)
+    except Exception as e:
+        print(f"Error starting live stream: {e}")
+        return jsonify({"error": "Live stream unavailable"}), 503
+
+    def events():
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                try:
+                    event = updates.get(timeout=LIVE_HEARTBEAT)
+                except queue.Empty:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            live_hub.unsubscribe(key, updates)
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def index_lookup(lookup, fallback):
+    """Answer from the series index, or from a storage scan while it is unavailable or not yet built"""
+    if series_index is not None:
+        try:
+            if not series_index.is_empty():
+                return lookup()
+        except redis.RedisError as e:
+            print(f"Series index unavailable, scanning storage: {e}")
+    try:
+        return fallback()
+    except Exception as e:
+        print(f"Error scanning storage schema: {e}")
+        return []
+
 
-    metrics = influxdb.query_aggregated_metrics(name=name, window=window, aggregate_fn=aggregate_fn)
+def search_params():
+    return request.args.get("prefix") or None, request.args.get("limit", type=int)
 
-    return jsonify(metrics)
+
+def filter_prefix(values, prefix, limit):
+    values = [value for value in values if not prefix or value.startswith(prefix)]
+    return values[:limit] if limit else values
 
 
 @app.route("/api/metrics/names", methods=["GET"])
 def get_metric_names():
-    """Get list of all unique metric names"""
-    names = influxdb.get_metric_names()
+    """Get list of all unique metric names, optionally those starting with prefix"""
+    prefix, limit = search_params()
+    names = index_lookup(
+        lambda: series_index.names(prefix=prefix, limit=limit),
+        lambda: filter_prefix(storage.get_metric_names(), prefix, limit),
+    )
     return jsonify(names)
 
 
+@app.route("/api/metrics/<path:name>/tags", methods=["GET"])
+def get_metric_tag_keys(name):
+    """Get the tag keys used by a metric, optionally those starting with prefix"""
+    prefix, limit = search_params()
+    keys = index_lookup(
+        lambda: series_index.tag_keys(name, prefix=prefix, limit=limit),
+        lambda: filter_prefix([key for key in storage.get_tag_keys(name) if key != "name"], prefix, limit),
+    )
+    return jsonify(keys)
+
+
+@app.route("/api/metrics/<path:name>/tags/<key>/values", methods=["GET"])
+def get_metric_tag_values(name, key):
+    """Get the values of one tag of a metric, optionally those starting with prefix"""
+    prefix, limit = search_params()
+    values = index_lookup(
+        lambda: series_index.tag_values(name, key, prefix=prefix, limit=limit),
+        lambda: filter_prefix(storage.get_tag_values(key, name=name), prefix, limit),
+    )
+    return jsonify(values)
+
+
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint"""
     try:
-        influxdb.client.ping()
-        return jsonify({"status": "healthy"})
+        storage.ping()
+        status = {"status": "healthy"}
+        if query_cache is not None:
+            status["query_cache"] = query_cache.stats()
+        status["live"] = live_hub.stats()
+        if rollups is not None:
+            status["rollups"] = rollups.stats()
+        status["query_executor"] = query_executor.stats()
+        return jsonify(status)
     except Exception as e:
         return jsonify({"status": "unhealthy", "error": str(e)}), 503
 
 
+@app.route("/internal/metrics", methods=["GET"])
+def internal_metrics():
+    """Stage timings, counters and gauges of this backend; format=prometheus for the text format"""
+    if request.args.get("format") == "prometheus":
+        return Response(telemetry.prometheus(), mimetype="text/plain; version=0.0.4")
+    return jsonify(telemetry.snapshot())
+
+
+@app.route("/internal/metrics/workers", methods=["GET"])
+def worker_metrics():
+    """The latest telemetry snapshot of every running worker process, keyed by host:pid"""
+    prefix = f"{TELEMETRY_PREFIX}:worker:"
+    try:
+        keys = sorted(redis_client.scan_iter(match=prefix + "*", count=100))
+        snapshots = redis_client.mget(keys) if keys else []
+    except redis.RedisError as e:
+        return jsonify({"error": f"Redis unavailable: {e}"}), 503
+    return jsonify({
+        key.decode()[len(prefix):]: json.loads(snapshot) for key, snapshot in zip(keys, snapshots) if snapshot
+    })
+
+
+@app.route("/internal/cardinality", methods=["GET"])
+def cardinality_report():
+    """Metrics with the most series and enforced cardinality limits in the current window (query param: top)"""
+    if cardinality is None:
+        return jsonify({"error": "Cardinality tracking is disabled"}), 404
+    try:
+        return jsonify(cardinality.report(top=request.args.get("top", 20, type=int)))
+    except redis.RedisError as e:
+        return jsonify({"error": f"Redis unavailable: {e}"}), 503
+
+
+@app.route("/internal/shards", methods=["GET"])
+def shard_report():
+    """Live workers, the shards each one consumes, and the queue depth of every shard"""
+    queues = [shard_queue(INGEST_QUEUE, shard) for shard in range(INGEST_SHARDS)] if INGEST_SHARDS > 1 else []
+    try:
+        _, members = live_members(redis_client, SHARD_PREFIX)
+        with redis_client.pipeline(transaction=False) as pipe:
+            for name in [INGEST_QUEUE] + queues:
+                pipe.llen(name)
+            depths = pipe.execute()
+    except redis.RedisError as e:
+        return jsonify({"error": f"Redis unavailable: {e}"}), 503
+    owned = assignment(INGEST_SHARDS, members, SHARD_REPLICAS) if queues else {}
+    return jsonify({
+        "shards": INGEST_SHARDS,
+        "replicas": SHARD_REPLICAS,
+        "members": members,
+        "queue_depth": depths[0],
+        "assignment": [
+            {"shard": shard, "queue": queue, "owners": owned[shard], "queue_depth": depth}
+            for shard, (queue, depth) in enumerate(zip(queues, depths[1:]))
+        ],
+    })
+
+
 def init_db():
-    """Check InfluxDB connection"""
+    """Check the storage connection"""
     max_retries = 30
     retry_count = 0
 
     while retry_count < max_retries:
         try:
-            influxdb.client.ping()
-            print("InfluxDB connection successful!")
+            storage.ping()
+            print("Storage connection successful!")
             return True
         except Exception as e:
             retry_count += 1
-            print(f"InfluxDB connection failed (attempt {retry_count}/{max_retries}): {e}")
+            print(f"Storage connection failed (attempt {retry_count}/{max_retries}): {e}")
             if retry_count < max_retries:
                 time.sleep(2)
             else:
-                print("Failed to connect to InfluxDB after multiple attempts")
+                print("Failed to connect to storage after multiple attempts")
                 return False
     return False
 
 
 if __name__ == "__main__":
     init_db()
+    # Only the reloader's child process runs background jobs
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        if reconciler is not None:
+            reconciler.start()
+        if rollups is not None:
+            rollups.start()
+        if reporter is not None:
+            reporter.start()
     app.run(host="0.0.0.0", port=5000, debug=True)
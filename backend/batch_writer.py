@@ -0,0 +1,171 @@
+"""Micro-batching write stage shared by the worker's tasks"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class BatchWriteError(Exception):
+    """Raised when a batch could not be written after all retries"""
+
+
+class BatchWriter:
+    """Accumulate points across tasks and write them to InfluxDB in batches
+
+    Points are submitted in groups (one group per task). A group is never
+    split across writes, and its future resolves only once the batch holding
+    it has been written, so callers can defer acking until the data is stored.
+    A batch is flushed when it reaches ``max_batch_size`` points or when the
+    oldest pending group has waited ``max_linger_ms``.
+    """
+
+    def __init__(self, write_fn, max_batch_size=5000, max_linger_ms=200, max_retries=5,
+                 retry_backoff_ms=100, stats_interval=60):
+        self.write_fn = write_fn
+        self.max_batch_size = max_batch_size
+        self.max_linger = max_linger_ms / 1000.0
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff_ms / 1000.0
+        self.stats_interval = stats_interval
+
+        self._pending = deque()  # (enqueued_at, points, future)
+        self._pending_points = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._stats = {
+            'batches': 0,
+            'points': 0,
+            'failed_batches': 0,
+            'retries': 0,
+            'max_batch_size': 0,
+            'total_flush_seconds': 0.0,
+            'max_flush_seconds': 0.0,
+            'last_flush_seconds': 0.0,
+        }
+        self._last_report = time.monotonic()
+
+    def start(self):
+        """Start the background flusher thread"""
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='batch-writer', daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, points):
+        """Queue a group of points and return a future resolved after the write"""
+        future = Future()
+        if not points:
+            future.set_result(0)
+            return future
+        with self._condition:
+            if self._closed:
+                raise BatchWriteError('Batch writer is closed')
+            self._pending.append((time.monotonic(), list(points), future))
+            self._pending_points += len(points)
+            if self._pending_points >= self.max_batch_size:
+                self._condition.notify()
+        if self._thread is None:
+            self.start()
+        return future
+
+    def close(self, timeout=10):
+        """Flush everything still pending and stop the flusher thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        """Return a snapshot of flush latency and batch size statistics"""
+        with self._condition:
+            stats = dict(self._stats)
+            stats['pending_points'] = self._pending_points
+        batches = stats['batches']
+        stats['avg_batch_size'] = stats['points'] / batches if batches else 0.0
+        stats['avg_flush_seconds'] = stats['total_flush_seconds'] / batches if batches else 0.0
+        return stats
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._ready():
+                    if self._closed and not self._pending:
+                        return
+                    self._condition.wait(self._wait_time())
+                batch = self._take_batch()
+            self._flush(batch)
+            self._maybe_report()
+
+    def _ready(self):
+        if not self._pending:
+            return False
+        if self._closed or self._pending_points >= self.max_batch_size:
+            return True
+        return time.monotonic() - self._pending[0][0] >= self.max_linger
+
+    def _wait_time(self):
+        if not self._pending:
+            return self.max_linger
+        return max(self.max_linger - (time.monotonic() - self._pending[0][0]), 0.001)
+
+    def _take_batch(self):
+        batch = []
+        size = 0
+        while self._pending:
+            points = self._pending[0][1]
+            if batch and size + len(points) > self.max_batch_size:
+                break
+            group = self._pending.popleft()
+            batch.append(group)
+            size += len(points)
+        self._pending_points -= size
+        return batch
+
+    def _flush(self, batch):
+        points = [point for _, group, _ in batch for point in group]
+        started = time.monotonic()
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._stats['retries'] += 1
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+            try:
+                if self.write_fn(points):
+                    error = None
+                    break
+                error = BatchWriteError('Failed to write batch to InfluxDB')
+            except Exception as e:
+                error = e
+        elapsed = time.monotonic() - started
+
+        with self._condition:
+            self._stats['batches'] += 1
+            self._stats['points'] += len(points)
+            self._stats['max_batch_size'] = max(self._stats['max_batch_size'], len(points))
+            self._stats['total_flush_seconds'] += elapsed
+            self._stats['max_flush_seconds'] = max(self._stats['max_flush_seconds'], elapsed)
+            self._stats['last_flush_seconds'] = elapsed
+            if error is not None:
+                self._stats['failed_batches'] += 1
+
+        for _, group, future in batch:
+            if error is None:
+                future.set_result(len(group))
+            else:
+                future.set_exception(error)
+
+    def _maybe_report(self):
+        if not self.stats_interval or time.monotonic() - self._last_report < self.stats_interval:
+            return
+        self._last_report = time.monotonic()
+        stats = self.stats()
+        print(
+            f"Batch writer: {stats['batches']} batches, {stats['points']} points, "
+            f"avg batch {stats['avg_batch_size']:.1f}, max batch {stats['max_batch_size']}, "
+            f"avg flush {stats['avg_flush_seconds'] * 1000:.1f}ms, "
+            f"max flush {stats['max_flush_seconds'] * 1000:.1f}ms, "
+            f"{stats['failed_batches']} failed, {stats['retries']} retries"
+        )
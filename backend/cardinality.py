@@ -0,0 +1,333 @@
+"""Series cardinality tracking and limits, applied by the worker before points are written"""
+import fnmatch
+import json
+import math
+import threading
+import time
+from datetime import datetime, timezone
+
+import redis
+
+# Tag value that series of an over-limit tag key are folded into by the aggregate policy
+OTHER = '__other__'
+POLICIES = ('drop', 'strip', 'aggregate')
+
+
+def parse_keys(spec):
+    """Parse a comma-separated list of tag keys"""
+    return {key.strip() for key in (spec or '').split(',') if key.strip()}
+
+
+def parse_limits(spec):
+    """Parse per-metric series limits, e.g. 'api_requests=50000,debug.*=100' (fnmatch patterns)"""
+    limits = []
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        pattern, separator, limit = item.rpartition('=')
+        if not separator or not pattern:
+            raise ValueError(f'Invalid series limit: {item!r}, expected pattern=limit')
+        limits.append((pattern, int(limit)))
+    return limits
+
+
+def merge_points(metrics):
+    """Merge points of one series and time into a pre-aggregated point (see metric_record.encode_line)
+
+    Each point adds its rollup fields if it has them, or its value as one
+    point, so queries merge the result as they merge the agent's points.
+    """
+    count = total = squares = 0.0
+    low, high = math.inf, -math.inf
+    for metric in metrics:
+        fields = metric.fields or {}
+        points = fields.get('count') or 1.0
+        count += points
+        total += fields.get('sum', metric.value * points)
+        squares += fields.get('sumsq', metric.value * metric.value * points)
+        low = min(low, fields.get('min', metric.value))
+        high = max(high, fields.get('max', metric.value))
+    first, last = metrics[0], metrics[-1]
+    fields = {
+        'count': count, 'sum': total, 'sumsq': squares, 'min': low, 'max': high,
+        'first': (first.fields or {}).get('first', first.value), 'last': (last.fields or {}).get('last', last.value),
+    }
+    return first._replace(value=total / count, fields=fields)
+
+
+def series_tags(metric):
+    """Tags of a Metric including source, which is stored as a tag too"""
+    tags = dict(metric.tags)
+    if metric.source:
+        tags['source'] = str(metric.source)
+    return tags
+
+
+class CardinalityGuard:
+    """Keeps series cardinality per metric and per tag key under configurable limits
+
+    Distinct values per (metric, tag key) and distinct series per metric are
+    counted in Redis HyperLogLogs shared by all workers, per ``window``
+    seconds, so the counts reflect active series and recover once a bad
+    client stops. Each worker remembers what it has already counted in the
+    current window, so Redis is only touched for new values and series.
+
+    A tag key goes over its limit when it has more than ``max_tag_values``
+    values for a metric. When a metric has more than its series limit, its
+    tag key with the most values goes over its limit too, and the next one
+    for each further tenth of the limit it grows by. Points carrying an
+    over-limit key are then handled by ``policy``:
+
+      drop       the point is not written
+      strip      the tag is removed
+      aggregate  the tag value is replaced with __other__, so the series fold into one
+
+    Points of a batch that land on the same series and time once their tags
+    are changed (by a policy or the allow and deny lists) are merged into one
+    pre-aggregated point rather than overwriting each other. Points that
+    collide across batches still overwrite each other.
+
+    Keys in ``deny`` are always removed. With ``allow`` set, only those keys
+    are kept. Limits are approximate: a batch is checked against the counts
+    from before it, and HyperLogLog counts are estimates (about 1% error).
+    """
+
+    def __init__(self, client, prefix='theia:cardinality', max_series=10000, max_tag_values=1000,
+                 policy='drop', window=3600, limits=(), allow=None, deny=(), max_seen=1000000):
+        if policy not in POLICIES:
+            raise ValueError(f'Invalid cardinality policy: {policy!r}, expected one of {", ".join(POLICIES)}')
+        self.client = client
+        self.prefix = prefix
+        self.max_series = max_series
+        self.max_tag_values = max_tag_values
+        self.policy = policy
+        self.window = window
+        self.limits = list(limits)
+        self.allow = set(allow) if allow else None
+        self.deny = set(deny)
+        self.max_seen = max_seen
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, window_id):
+        self._window_id = window_id
+        self._seen_values = set()  # (name, key, value) counted this window
+        self._seen_series = set()  # (name, sorted tag items) counted this window
+        self._value_counts = {}  # (name, key) -> distinct values
+        self._blocked = {}  # name -> over-limit tag keys
+        self._blocked_at = {}  # name -> series count when a key last went over for the series limit
+
+    def window_id(self, now=None):
+        return int((now or time.time()) // self.window)
+
+    def series_key(self, window_id, name):
+        return f'{self.prefix}:{window_id}:series:{name}'
+
+    def values_key(self, window_id, name, key):
+        # JSON keeps names and tag keys containing ':' unambiguous
+        return f'{self.prefix}:{window_id}:values:{json.dumps([name, key])}'
+
+    def keys_key(self, window_id, name):
+        return f'{self.prefix}:{window_id}:keys:{name}'
+
+    def enforced_key(self, window_id):
+        return f'{self.prefix}:{window_id}:enforced'
+
+    def series_limit(self, name):
+        for pattern, limit in self.limits:
+            if fnmatch.fnmatchcase(name, pattern):
+                return limit
+        return self.max_series
+
+    def _listed(self, tags):
+        """Apply the allow and deny lists; returns the kept tags and whether any were removed"""
+        kept = {
+            key: value for key, value in tags.items()
+            if key not in self.deny and (self.allow is None or key in self.allow)
+        }
+        return kept, len(kept) != len(tags)
+
+    def apply(self, metrics):
+        """Return the Metrics to write, with over-limit tags dropped, stripped or folded
+
+        Returns (metrics, enforced) where enforced counts affected points per
+        (name, key, action). Redis errors let everything through, apart from
+        the allow and deny lists.
+        """
+        prepared = []
+        for metric in metrics:
+            tags, changed = self._listed(series_tags(metric))
+            prepared.append((metric, tags, changed))
+        try:
+            return self._enforce(prepared)
+        except redis.RedisError as e:
+            print(f"Cardinality tracking unavailable, not enforcing limits: {e}")
+            return self._output(prepared), {}
+
+    def _enforce(self, prepared):
+        window_id = self.window_id()
+        with self._lock:
+            if window_id != self._window_id:
+                self._reset(window_id)
+            if len(self._seen_values) + len(self._seen_series) > self.max_seen:
+                # Counting again is harmless: adding to a HyperLogLog is idempotent
+                self._seen_values.clear()
+                self._seen_series.clear()
+            new_values = {
+                (metric.name, key, value) for metric, tags, _ in prepared for key, value in tags.items()
+            } - self._seen_values
+        if new_values:
+            self._count_values(window_id, new_values)
+
+        enforced = {}
+        admitted = []
+        with self._lock:
+            blocked = {name: set(keys) for name, keys in self._blocked.items()}
+        for metric, tags, changed in prepared:
+            name = metric.name
+            dropped = False
+            for key in blocked.get(name, ()) & tags.keys():
+                action = (name, key, self.policy)
+                enforced[action] = enforced.get(action, 0) + 1
+                if self.policy == 'drop':
+                    dropped = True
+                    break
+                if self.policy == 'strip':
+                    del tags[key]
+                else:
+                    tags[key] = OTHER
+                changed = True
+            if not dropped:
+                admitted.append((metric, tags, changed))
+
+        with self._lock:
+            new_series = {(metric.name, tuple(sorted(tags.items()))) for metric, tags, _ in admitted}
+            new_series -= self._seen_series
+        if new_series or enforced:
+            self._count_series(window_id, new_series, enforced)
+        return self._output(admitted), enforced
+
+    def _count_values(self, window_id, new_values):
+        by_key = {}
+        for name, key, value in new_values:
+            by_key.setdefault((name, key), []).append(value)
+        ttl = self.window * 2
+        with self.client.pipeline(transaction=False) as pipe:
+            for (name, key), values in by_key.items():
+                values_key = self.values_key(window_id, name, key)
+                pipe.pfadd(values_key, *values)
+                pipe.pfcount(values_key)
+                pipe.expire(values_key, ttl)
+                pipe.sadd(self.keys_key(window_id, name), key)
+                pipe.expire(self.keys_key(window_id, name), ttl)
+            results = pipe.execute()
+        with self._lock:
+            if window_id != self._window_id:
+                return
+            self._seen_values |= new_values
+            for index, (name, key) in enumerate(by_key):
+                count = results[index * 5 + 1]
+                self._value_counts[(name, key)] = count
+                if count > self.max_tag_values:
+                    self._blocked.setdefault(name, set()).add(key)
+
+    def _count_series(self, window_id, new_series, enforced):
+        by_name = {}
+        for name, items in new_series:
+            by_name.setdefault(name, []).append(json.dumps(items, separators=(',', ':')))
+        with self.client.pipeline(transaction=False) as pipe:
+            for name, series in by_name.items():
+                series_key = self.series_key(window_id, name)
+                pipe.pfadd(series_key, *series)
+                pipe.pfcount(series_key)
+                pipe.expire(series_key, self.window * 2)
+            for action, count in enforced.items():
+                pipe.hincrby(self.enforced_key(window_id), json.dumps(action), count)
+            if enforced:
+                pipe.expire(self.enforced_key(window_id), self.window * 2)
+            results = pipe.execute()
+        with self._lock:
+            if window_id != self._window_id:
+                return
+            self._seen_series |= new_series
+            for index, name in enumerate(by_name):
+                count = results[index * 3 + 1]
+                limit = self.series_limit(name)
+                # Folding a key still creates a few new series, so another key only goes over
+                # once the metric has grown by a further tenth of its limit
+                if count <= max(limit, self._blocked_at.get(name, 0) + limit // 10):
+                    continue
+                # Over the series limit: the tag key with the most values goes over its limit
+                blocked = self._blocked.setdefault(name, set())
+                candidates = [(count, key) for (metric, key), count in self._value_counts.items()
+                              if metric == name and key not in blocked]
+                if candidates:
+                    blocked.add(max(candidates)[1])
+                    self._blocked_at[name] = count
+
+    def _output(self, entries):
+        """Metrics with their changed tags, merging the points that changed into the same series and time"""
+        if not any(changed for _, _, changed in entries):
+            return [metric for metric, _, _ in entries]
+        output = []
+        collisions = {}  # (name, tag items, timestamp) -> positions in output
+        for metric, tags, changed in entries:
+            key = (metric.name, tuple(sorted(tags.items())), metric.timestamp)
+            collisions.setdefault(key, []).append(len(output))
+            output.append((self._rebuild(metric, tags) if changed else metric, changed))
+        merged = set()
+        for positions in collisions.values():
+            if len(positions) > 1 and any(output[position][1] for position in positions):
+                output[positions[0]] = (merge_points([output[position][0] for position in positions]), True)
+                merged.update(positions[1:])
+        return [metric for position, (metric, _) in enumerate(output) if position not in merged]
+
+    @staticmethod
+    def _rebuild(metric, tags):
+        tags = dict(tags)
+        source = tags.pop('source', None)
+        return metric._replace(tags=tags, source=source)
+
+    def report(self, top=20):
+        """The metrics with the most series and enforcement actions in the current window"""
+        window_id = self.window_id()
+        prefix = f'{self.prefix}:{window_id}:series:'
+        names = [key.decode()[len(prefix):] for key in self.client.scan_iter(match=prefix + '*', count=1000)]
+        with self.client.pipeline(transaction=False) as pipe:
+            for name in names:
+                pipe.pfcount(self.series_key(window_id, name))
+            series = dict(zip(names, pipe.execute()))
+
+        enforced = {}
+        for field, count in self.client.hgetall(self.enforced_key(window_id)).items():
+            name, key, action = json.loads(field)
+            actions = enforced.setdefault(name, {}).setdefault(key, {})
+            actions[action] = int(count)
+        # Metrics with enforced limits first, then by series
+        ranked = sorted(set(series) | set(enforced), key=lambda name: (
+            -sum(count for actions in enforced.get(name, {}).values() for count in actions.values()),
+            -series.get(name, 0), name,
+        ))[:top]
+
+        metrics = []
+        for name in ranked:
+            keys = sorted(member.decode() for member in self.client.smembers(self.keys_key(window_id, name)))
+            with self.client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.pfcount(self.values_key(window_id, name, key))
+                values = pipe.execute()
+            metrics.append({
+                'name': name,
+                'series': series.get(name, 0),
+                'series_limit': self.series_limit(name),
+                'tag_keys': sorted((
+                    {'key': key, 'values': count, 'enforced': enforced.get(name, {}).get(key, {})}
+                    for key, count in zip(keys, values)
+                ), key=lambda entry: -entry['values']),
+            })
+        return {
+            'window_start': datetime.fromtimestamp(window_id * self.window, timezone.utc).isoformat(),
+            'window_seconds': self.window,
+            'policy': self.policy,
+            'max_series': self.max_series,
+            'max_tag_values': self.max_tag_values,
+            'metrics': metrics,
+        }
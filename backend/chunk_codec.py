@@ -0,0 +1,118 @@
+"""Compression of series chunks: delta-of-delta timestamps and XOR-encoded values
+
+The scheme follows Gorilla (Pelkonen et al., VLDB 2015), but byte-aligned
+rather than bit-packed, so a whole chunk encodes and decodes with a few
+NumPy operations instead of a Python loop per point:
+
+- Timestamps are kept in the coarsest unit (s, ms, us or ns) that divides
+  all of them, as zigzag-encoded delta-of-deltas cut to their significant
+  bytes. A 4-bit count per point says how many bytes follow; a regular
+  interval takes half a byte per point.
+- Each value is XORed with the previous one, and only the bytes between the
+  XOR's leading and trailing zero bytes are kept, after a byte holding the
+  trailing zero byte count and the kept byte count. A repeated value takes
+  one byte.
+
+A chunk is a header (point count, timestamp unit, first timestamp, first
+value) followed by the timestamp byte counts, the timestamp bytes, the value
+headers and the value bytes.
+"""
+import struct
+
+import numpy as np
+
+HEADER = struct.Struct('<IBqQ')
+UNIT_EXPONENTS = (9, 6, 3, 0)
+_BYTE_POSITIONS = np.arange(8)
+
+
+def byte_length(numbers):
+    """Bytes needed for each uint64, 0 for zero"""
+    length = np.zeros(len(numbers), dtype=np.uint8)
+    for k in range(8):
+        length += numbers >= np.uint64(1 << (8 * k))
+    return length
+
+
+def pack_bytes(numbers, lengths):
+    """The low ``lengths`` bytes of each uint64, little-endian, concatenated"""
+    matrix = numbers.astype('<u8').view(np.uint8).reshape(-1, 8)
+    return matrix[_BYTE_POSITIONS < lengths[:, None]].tobytes()
+
+
+def unpack_bytes(data, lengths):
+    matrix = np.zeros((len(lengths), 8), dtype=np.uint8)
+    matrix[_BYTE_POSITIONS < lengths[:, None]] = data
+    return matrix.view('<u8').ravel()
+
+
+def pack_nibbles(values):
+    if len(values) % 2:
+        values = np.append(values, np.uint8(0))
+    return (values[0::2] | (values[1::2] << 4)).astype(np.uint8).tobytes()
+
+
+def unpack_nibbles(data, count):
+    nibbles = np.empty(len(data) * 2, dtype=np.uint8)
+    nibbles[0::2] = data & 0x0F
+    nibbles[1::2] = data >> 4
+    return nibbles[:count]
+
+
+def encode_chunk(timestamps, values):
+    """Encode sorted int64 nanosecond timestamps and their float64 values as bytes"""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    for exponent in UNIT_EXPONENTS:
+        if not (timestamps % 10 ** exponent).any():
+            break
+    units = timestamps // 10 ** exponent
+    dod = np.diff(np.diff(units), prepend=0)
+    zigzag = ((dod << 1) ^ (dod >> 63)).view(np.uint64)
+    time_lengths = byte_length(zigzag)
+
+    bits = values.view(np.uint64)
+    xors = bits[1:] ^ bits[:-1]
+    trailing = np.zeros(len(xors), dtype=np.uint8)
+    for k in range(1, 8):
+        trailing += (xors & np.uint64((1 << (8 * k)) - 1)) == 0
+    trailing[xors == 0] = 0
+    kept = xors >> (trailing.astype(np.uint64) * np.uint64(8))
+    kept_lengths = byte_length(kept)
+
+    return b''.join([
+        HEADER.pack(len(timestamps), exponent, int(timestamps[0]), int(bits[0])),
+        pack_nibbles(time_lengths),
+        pack_bytes(zigzag, time_lengths),
+        ((trailing << 4) | kept_lengths).tobytes(),
+        pack_bytes(kept, kept_lengths),
+    ])
+
+
+def decode_chunk(buffer, offset=0):
+    """Decode the chunk at offset in a bytes-like object into (int64 timestamps, float64 values)"""
+    count, exponent, first_time, first_bits = HEADER.unpack_from(buffer, offset)
+    position = offset + HEADER.size
+    rest = count - 1
+
+    size = (rest + 1) // 2
+    time_lengths = unpack_nibbles(np.frombuffer(buffer, np.uint8, size, position), rest)
+    position += size
+    size = int(time_lengths.sum(dtype=np.int64))
+    zigzag = unpack_bytes(np.frombuffer(buffer, np.uint8, size, position), time_lengths)
+    position += size
+    dod = (zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(np.int64)
+    scale = 10 ** exponent
+    units = np.empty(count, dtype=np.int64)
+    units[0] = first_time // scale
+    units[1:] = units[0] + np.cumsum(np.cumsum(dod))
+
+    headers = np.frombuffer(buffer, np.uint8, rest, position)
+    position += rest
+    kept_lengths = headers & 0x0F
+    size = int(kept_lengths.sum(dtype=np.int64))
+    kept = unpack_bytes(np.frombuffer(buffer, np.uint8, size, position), kept_lengths)
+    bits = np.empty(count, dtype=np.uint64)
+    bits[0] = first_bits
+    bits[1:] = kept << ((headers >> 4).astype(np.uint64) * np.uint64(8))
+    return units * scale, np.bitwise_xor.accumulate(bits).view(np.float64)
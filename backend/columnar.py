@@ -0,0 +1,125 @@
+"""Columnar encodings (JSON arrays and Arrow IPC) of raw metric query results"""
+import json
+from array import array
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow is optional; only format=arrow needs it
+    pa = None
+
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+# Timestamps are parsed by numpy this many at a time
+TIMESTAMP_CHUNK = 65536
+RESERVED_COLUMNS = ('timestamp', 'value', 'name', 'source')
+
+
+def arrow_available():
+    return pa is not None
+
+
+class ColumnarMetrics:
+    """Metric rows collected into NumPy columns with dictionary-encoded series attributes
+
+    Rows from InfluxDB.iter_metrics(iso_timestamps=False) are folded in
+    without a dict per row: values go into a float64 buffer, timestamps are
+    parsed in chunks to int64 nanoseconds and each row keeps only the index
+    of its series. name, source and every tag key become a dictionary column
+    of distinct values plus one int32 code per row (-1 where a series lacks
+    the tag).
+    """
+
+    def __init__(self, rows):
+        series_index = {}
+        self.series = []
+        codes = array('i')
+        values = array('d')
+        time_chunks = []
+        pending = []
+        for name, value, timestamp, tags, source in rows:
+            # Rows of one series share their tags dict, so its identity is a cheap series key
+            key = (name, source, id(tags))
+            index = series_index.get(key)
+            if index is None:
+                index = series_index[key] = len(self.series)
+                self.series.append((name, source, tags))
+            codes.append(index)
+            values.append(value)
+            pending.append(timestamp)
+            if len(pending) >= TIMESTAMP_CHUNK:
+                time_chunks.append(np.array(pending, dtype='datetime64[ns]').view(np.int64))
+                pending = []
+        if pending:
+            time_chunks.append(np.array(pending, dtype='datetime64[ns]').view(np.int64))
+
+        self.timestamp = np.concatenate(time_chunks) if time_chunks else np.empty(0, dtype=np.int64)
+        self.value = np.frombuffer(values, dtype=np.float64) if values else np.empty(0, dtype=np.float64)
+        self.series_codes = np.frombuffer(codes, dtype=np.intc) if codes else np.empty(0, dtype=np.intc)
+
+    def __len__(self):
+        return len(self.value)
+
+    def dictionary_column(self, attribute):
+        """Return (dictionary, int32 codes per row) for name, source or a tag key"""
+        dictionary = []
+        positions = {}
+        per_series = np.empty(len(self.series), dtype=np.int32)
+        for index, (name, source, tags) in enumerate(self.series):
+            if attribute == 'name':
+                value = name
+            elif attribute == 'source':
+                value = source
+            else:
+                value = tags.get(attribute)
+            if value is None or value == '':
+                # Flux CSV writes a null tag as an empty string
+                per_series[index] = -1
+                continue
+            position = positions.get(value)
+            if position is None:
+                position = positions[value] = len(dictionary)
+                dictionary.append(value)
+            per_series[index] = position
+        return dictionary, per_series[self.series_codes]
+
+    def tag_keys(self):
+        # name and source are reported as their own columns rather than repeated as tags
+        return sorted({key for _, _, tags in self.series for key in tags} - {'name', 'source'})
+
+    def to_json(self):
+        """Encode as JSON arrays: int64 ns timestamps, float values and dictionary columns"""
+        def column(attribute):
+            dictionary, codes = self.dictionary_column(attribute)
+            return {'dictionary': dictionary, 'codes': codes.tolist()}
+
+        return json.dumps({
+            'format': 'columnar',
+            'length': len(self),
+            'timestamp': self.timestamp.tolist(),
+            'value': self.value.tolist(),
+            'name': column('name'),
+            'source': column('source'),
+            'tags': {key: column(key) for key in self.tag_keys()},
+        }, separators=(',', ':'))
+
+    def to_arrow(self):
+        """Encode as an Arrow IPC stream with dictionary-encoded string columns"""
+        if pa is None:
+            raise RuntimeError('format=arrow requires pyarrow')
+        arrays = [
+            pa.array(self.timestamp, type=pa.timestamp('ns', tz='UTC')),
+            pa.array(self.value, type=pa.float64()),
+        ]
+        names = ['timestamp', 'value', 'name', 'source']
+        # Tags are top-level columns, prefixed only if they clash with the fixed ones
+        names += [f'tag.{key}' if key in RESERVED_COLUMNS else key for key in self.tag_keys()]
+        for attribute in ['name', 'source'] + self.tag_keys():
+            dictionary, codes = self.dictionary_column(attribute)
+            indices = pa.array(codes, type=pa.int32(), mask=codes < 0)
+            arrays.append(pa.DictionaryArray.from_arrays(indices, pa.array(dictionary, type=pa.string())))
+        table = pa.Table.from_arrays(arrays, names=names)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
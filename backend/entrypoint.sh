@@ -6,11 +6,13 @@ if [ $# -gt 0 ]; then
     exec "$@"
 fi
 
-echo "Waiting for InfluxDB to be ready..."
-while ! /usr/bin/curl -s http://influxdb:8086/health > /dev/null; do
-  sleep 0.5
-done
-echo "InfluxDB is ready!"
+if [ "${STORAGE_BACKEND:-influxdb}" = "influxdb" ]; then
+  echo "Waiting for InfluxDB to be ready..."
+  while ! /usr/bin/curl -s http://influxdb:8086/health > /dev/null; do
+    sleep 0.5
+  done
+  echo "InfluxDB is ready!"
+fi
 
 echo "Starting Flask application..."
 exec python app.py
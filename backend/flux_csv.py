@@ -0,0 +1,73 @@
+"""Streaming decode of Flux query results read with query_api.query_csv"""
+from influxdb_client import Dialect
+
+# No annotation rows: a header row starts each block of tables sharing a schema
+CSV_DIALECT = Dialect(header=True, delimiter=',', annotations=[], date_time_format='RFC3339Nano')
+
+# Columns that are never reported as tags
+NON_TAG_COLUMNS = ('', 'result', 'table')
+
+
+class FluxQueryError(Exception):
+    """Error table returned by InfluxDB in place of (or part way through) a result"""
+
+
+def rfc3339_to_iso(value):
+    """Rewrite an RFC 3339 UTC time from InfluxDB the way datetime.isoformat() prints it"""
+    seconds, _, fraction = value.rstrip('Z').partition('.')
+    micros = fraction[:6].ljust(6, '0')
+    if micros == '000000':
+        return seconds + '+00:00'
+    return f'{seconds}.{micros}+00:00'
+
+
+def is_header(row):
+    return len(row) > 2 and row[0] == '' and (row[1:3] == ['result', 'table'] or row[1] == 'error')
+
+
+def iter_metric_rows(csv_rows, iso_timestamps=True):
+    """Decode CSV rows into compact (name, value, timestamp, tags, source) tuples
+
+    Column positions are resolved once per header row instead of per record.
+    Rows of the same series share one tags dict, which holds every
+    non-underscore column (including name and source), as the record based
+    decoder did. With iso_timestamps=False the timestamp is InfluxDB's UTC
+    time with the trailing Z dropped, ready for numpy datetime64 parsing.
+    """
+    time_index = value_index = name_index = source_index = None
+    tag_columns = ()
+    tag_indices = ()
+    tags_by_values = {}
+    csv_rows = iter(csv_rows)
+    for row in csv_rows:
+        if is_header(row):
+            if row[1] == 'error':
+                error = next(csv_rows, None)
+                raise FluxQueryError(error[1] if error and len(error) > 1 else 'query failed')
+            positions = {column: index for index, column in enumerate(row)}
+            time_index = positions.get('_time')
+            value_index = positions.get('_value')
+            name_index = positions.get('name')
+            source_index = positions.get('source')
+            tag_columns = tuple(column for column in row if column not in NON_TAG_COLUMNS and not column.startswith('_'))
+            tag_indices = tuple(positions[column] for column in tag_columns)
+            continue
+        if time_index is None or value_index is None:
+            continue
+
+        timestamp = row[time_index]
+        value = row[value_index]
+        if not timestamp or not value:
+            continue
+        tag_values = tuple(row[index] for index in tag_indices)
+        key = (tag_columns, tag_values)
+        tags = tags_by_values.get(key)
+        if tags is None:
+            tags = tags_by_values[key] = dict(zip(tag_columns, tag_values))
+        yield (
+            row[name_index] if name_index is not None else '',
+            float(value),
+            rfc3339_to_iso(timestamp) if iso_timestamps else timestamp.rstrip('Z'),
+            tags,
+            row[source_index] if source_index is not None else '',
+        )
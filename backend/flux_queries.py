@@ -0,0 +1,396 @@
+"""Helpers that compile metric queries into Flux"""
+import re
+from datetime import datetime, timedelta, timezone
+
+from metric_record import AGGREGATE_VALUE_FIELD
+
+DURATION_UNITS = {
+    'us': timedelta(microseconds=1),
+    'ms': timedelta(milliseconds=1),
+    's': timedelta(seconds=1),
+    'm': timedelta(minutes=1),
+    'h': timedelta(hours=1),
+    'd': timedelta(days=1),
+    'w': timedelta(weeks=1),
+}
+
+DURATION_PATTERN = re.compile(r'(\d+)(us|ms|s|m|h|d|w)')
+PERCENTILE_PATTERN = re.compile(r'^p(\d{1,2}(?:\.\d+)?)$')
+
+# Default look-back per window, chosen so a chart shows a few hundred buckets
+DEFAULT_RANGES = {
+    '1m': '-6h',
+    '5m': '-24h',
+    '1h': '-7d',
+    '1d': '-30d',
+}
+MAX_BUCKETS = 300
+
+AGGREGATE_FUNCTIONS = {
+    'mean': 'mean',
+    'avg': 'mean',
+    'sum': 'sum',
+    'max': 'max',
+    'min': 'min',
+    'count': 'count',
+    'last': 'last',
+    'first': 'first',
+    'stddev': 'stddev',
+    'spread': 'spread',
+}
+
+# Aggregates that aggregateWindow cannot run; the backend computes them from raw points
+# with the NumPy engine in aggregation.py
+ENGINE_AGGREGATES = ('rate',)
+
+# Fields of a rollup point and the Flux function that merges them into a coarser window
+ROLLUP_FIELDS = {
+    'count': 'sum',
+    'sum': 'sum',
+    'sumsq': 'sum',
+    'min': 'min',
+    'max': 'max',
+    'first': 'first',
+    'last': 'last',
+}
+
+# What a raw point's value contributes to each rollup field, before it is merged with the same
+# field of pre-aggregated points (see metric_record.encode_line); {} is the stream of values
+RAW_ROLLUP_FIELDS = {
+    'count': '{}\n  |> aggregateWindow(every: {every}, fn: count, timeSrc: "_start", createEmpty: false)\n  |> toFloat()',
+    'sum': '{}',
+    'sumsq': '{}\n  |> map(fn: (r) => ({{r with _value: r._value * r._value}}))',
+    'min': '{}',
+    'max': '{}',
+    'first': '{}',
+    'last': '{}',
+}
+
+# Rollup fields each aggregate is computed from; anything else (percentiles) needs raw points
+ROLLUP_AGGREGATES = {
+    'mean': ('count', 'sum'),
+    'sum': ('count', 'sum'),
+    'count': ('count',),
+    'min': ('count', 'min'),
+    'max': ('count', 'max'),
+    'first': ('count', 'first'),
+    'last': ('count', 'last'),
+    'spread': ('count', 'min', 'max'),
+    'stddev': ('count', 'sum', 'sumsq'),
+}
+
+
+def parse_duration(value):
+    """Parse a Flux duration literal such as '5m' or '1h30m' into a timedelta"""
+    if not isinstance(value, str) or not value:
+        raise ValueError(f'Invalid duration: {value!r}')
+    position = 0
+    total = timedelta(0)
+    for match in DURATION_PATTERN.finditer(value):
+        if match.start() != position:
+            break
+        total += int(match.group(1)) * DURATION_UNITS[match.group(2)]
+        position = match.end()
+    if position != len(value) or total <= timedelta(0):
+        raise ValueError(f'Invalid duration: {value!r}')
+    return total
+
+
+def format_duration(delta):
+    """Format a timedelta as a Flux duration literal"""
+    micros = max(delta // timedelta(microseconds=1), 1)
+    for unit, size in (('d', 86400000000), ('h', 3600000000), ('m', 60000000),
+                       ('s', 1000000), ('ms', 1000)):
+        if micros % size == 0:
+            return f'{micros // size}{unit}'
+    return f'{micros}us'
+
+
+def time_literal(value):
+    """Check a range bound (now(), a negative duration or an ISO 8601 time) and return it as Flux; raises ValueError"""
+    if value == 'now()':
+        return value
+    if value.startswith('-'):
+        parse_duration(value[1:])
+        return value
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'Invalid time: {value!r}')
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def default_range(window):
+    """Pick the look-back range for an aggregation window"""
+    if window in DEFAULT_RANGES:
+        return DEFAULT_RANGES[window]
+    return '-' + format_duration(parse_duration(window) * MAX_BUCKETS)
+
+
+def flux_string(value):
+    """Quote a Python string as a Flux string literal"""
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('${', '\\${')
+    return f'"{escaped}"'
+
+
+def flux_array(values):
+    """Quote Python strings as a Flux array of string literals"""
+    return '[' + ', '.join(flux_string(value) for value in values) + ']'
+
+
+def aggregate_expression(aggregate_fn):
+    """Return the Flux function used as the aggregateWindow fn, or the name of an engine aggregate"""
+    aggregate_fn = (aggregate_fn or 'mean').lower()
+    if aggregate_fn in ENGINE_AGGREGATES:
+        return aggregate_fn
+    if aggregate_fn == 'median':
+        aggregate_fn = 'p50'
+    match = PERCENTILE_PATTERN.match(aggregate_fn)
+    if match:
+        q = float(match.group(1)) / 100
+        if not 0 < q < 1:
+            raise ValueError(f'Invalid percentile: {aggregate_fn}')
+        return f'(column, tables=<-) => tables |> quantile(q: {q}, column: column)'
+    # Unknown functions fall back to mean, as the dashboard always did
+    return AGGREGATE_FUNCTIONS.get(aggregate_fn, 'mean')
+
+
+def tag_predicate(key, expressions):
+    """Compile the filter expressions for one tag into a Flux predicate
+
+    Each expression is ``value`` (equal), ``!value`` (not equal), ``~regex``
+    (matches) or ``!~regex`` (does not match). A series passes when it
+    matches any of the positive expressions and none of the negative ones.
+    """
+    if isinstance(expressions, str):
+        expressions = [expressions]
+    column = f'r[{flux_string(key)}]'
+    matches, excludes = [], []
+    for expression in expressions:
+        negate = expression.startswith('!')
+        if negate:
+            expression = expression[1:]
+        if expression.startswith('~'):
+            pattern = expression[1:]
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f'Invalid regex for tag {key}: {e}')
+            literal = '/' + pattern.replace('/', '\\/') + '/'
+            (excludes if negate else matches).append(f'{column} {"!~" if negate else "=~"} {literal}')
+        else:
+            (excludes if negate else matches).append(f'{column} {"!=" if negate else "=="} {flux_string(expression)}')
+    terms = []
+    if matches:
+        terms.append(matches[0] if len(matches) == 1 else '(' + ' or '.join(matches) + ')')
+    # A series without the tag does not equal (or match) anything
+    terms += [f'(not exists {column} or {exclude})' for exclude in excludes]
+    return ' and '.join(terms)
+
+
+def build_filters(name=None, source=None, tags=None, field='value'):
+    """Build the filter() stages selecting the metric series
+
+    name may be one metric name or a list of them. tags maps each tag key to
+    a filter expression or a list of them (see tag_predicate). field may be
+    one field, a tuple of them, or None for every field.
+    """
+    filters = ['  |> filter(fn: (r) => r["_measurement"] == "metrics")\n']
+    if field:
+        fields = (field,) if isinstance(field, str) else field
+        predicate = ' or '.join(f'r["_field"] == {flux_string(value)}' for value in fields)
+        filters.append(f'  |> filter(fn: (r) => {predicate})\n')
+    names = [name] if isinstance(name, str) else list(name or [])
+    if names:
+        predicate = ' or '.join(f'r["name"] == {flux_string(value)}' for value in names)
+        filters.append(f'  |> filter(fn: (r) => {predicate})\n')
+    if source:
+        filters.append(f'  |> filter(fn: (r) => r["source"] == {flux_string(source)})\n')
+    for key, expressions in (tags or {}).items():
+        filters.append(f'  |> filter(fn: (r) => {tag_predicate(key, expressions)})\n')
+    return ''.join(filters)
+
+
+def group_columns(group_by=None):
+    """Columns a grouped aggregation keeps series apart by: the name plus the group_by tags"""
+    columns = ['name']
+    for key in group_by or ():
+        if not key or key.startswith('_') or key in columns:
+            raise ValueError(f'Invalid group_by tag: {key!r}')
+        columns.append(key)
+    return columns
+
+
+def build_aggregate_query(bucket, window, aggregate_fn='mean', name=None, tags=None,
+                          start_time=None, end_time=None, group_by=None):
+    """Compile an aggregation into a Flux aggregateWindow pipeline
+
+    The result has one row per (name, group_by tags, window start) with the
+    aggregated value in the ``agg`` column and the number of points in
+    ``count``. Used for percentiles, which cannot be merged from the fields of
+    pre-aggregated points, so each of those counts as one value: its mean.
+    """
+    every = format_duration(parse_duration(window))
+    fn = aggregate_expression(aggregate_fn)
+    start = start_time or default_range(window)
+
+    query = f'''
+    data = from(bucket: {flux_string(bucket)})
+      |> range(start: {start}, stop: {end_time or "now()"})
+    '''
+    query += build_filters(name=name, tags=tags, field=('value', AGGREGATE_VALUE_FIELD))
+    query += f'  |> group(columns: {flux_array(group_columns(group_by))})\n'
+    query += f'''
+    agg = data
+      |> aggregateWindow(every: {every}, fn: {fn}, timeSrc: "_start", createEmpty: false)
+      |> toFloat()
+      |> set(key: "_field", value: "agg")
+
+    cnt = data
+      |> aggregateWindow(every: {every}, fn: count, timeSrc: "_start", createEmpty: false)
+      |> toFloat()
+      |> set(key: "_field", value: "count")
+
+    union(tables: [agg, cnt])
+      |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+      |> group()
+      |> sort(columns: ["_time"])
+    '''
+    return query
+
+
+def merged_field_streams(select, every, fields):
+    """Flux streams of rollup fields per window, merged over raw and pre-aggregated points
+
+    select(field) returns the Flux selecting one field of the series to
+    merge, grouped the way they are merged. A raw point contributes its
+    value to every field (1 to count, its square to sumsq); a pre-aggregated
+    point contributes its own count, sum, ... fields, merged as rollup tiers
+    merge theirs.
+    """
+    streams = []
+    for field in fields:
+        raw = RAW_ROLLUP_FIELDS[field].format(select('value'), every=every)
+        stream = f'union(tables: [\n{raw},\n{select(field)}\n])'
+        if field in ('first', 'last'):
+            stream += '\n  |> sort(columns: ["_time"])'
+        stream += f'''
+  |> aggregateWindow(every: {every}, fn: {ROLLUP_FIELDS[field]}, timeSrc: "_start", createEmpty: false)
+  |> toFloat()
+  |> set(key: "_field", value: "{field}")'''
+        streams.append(stream)
+    return streams
+
+
+def build_merged_query(bucket, window, fields, name=None, tags=None, start_time=None, end_time=None,
+                       group_by=None):
+    """Compile an aggregation of raw points into the rollup fields it is computed from
+
+    The result has the same rows as build_rollup_query, so the caller
+    computes the aggregate the same way. Points written by the agent's
+    aggregator are merged by their fields (see merged_field_streams), so
+    sum, count and the rest stay exact.
+    """
+    every = format_duration(parse_duration(window))
+    start = start_time or default_range(window)
+    columns = flux_array(group_columns(group_by))
+
+    def select(field):
+        return (
+            f'from(bucket: {flux_string(bucket)})\n'
+            f'  |> range(start: {start}, stop: {end_time or "now()"})\n'
+            + build_filters(name=name, tags=tags, field=field)
+            + f'  |> group(columns: {columns})'
+        )
+
+    query = f'''
+    union(tables: [
+    {", ".join(merged_field_streams(select, every, fields))}
+    ])
+      |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+      |> group()
+      |> sort(columns: ["_time"])
+    '''
+    return query
+
+
+def build_points_query(bucket, name=None, tags=None, start_time=None, end_time=None, field='value'):
+    """Compile a query for the raw points of the selected series, one table per series and field"""
+    query = f'''
+    from(bucket: {flux_string(bucket)})
+      |> range(start: {start_time}, stop: {end_time or "now()"})
+    '''
+    query += build_filters(name=name, tags=tags, field=field)
+    query += '  |> drop(columns: ["_start", "_stop"])\n'
+    return query
+
+
+def build_rollup_query(bucket, window, fields, name=None, tags=None, start_time=None, end_time=None,
+                       group_by=None):
+    """Compile an aggregation over a rollup tier
+
+    The result has one row per (name, group_by tags, window start) with each requested
+    rollup field merged over the window, from which the caller computes the
+    aggregate.
+    """
+    every = format_duration(parse_duration(window))
+    query = f'''
+    data = from(bucket: {flux_string(bucket)})
+      |> range(start: {start_time or default_range(window)}, stop: {end_time or "now()"})
+    '''
+    query += build_filters(name=name, tags=tags, field=None)
+    query += f'  |> group(columns: {flux_array(group_columns(group_by) + ["_field"])})\n'
+    query += f'''
+    merge = (field, fn) => data
+      |> filter(fn: (r) => r["_field"] == field)
+      |> aggregateWindow(every: {every}, fn: fn, timeSrc: "_start", createEmpty: false)
+
+    union(tables: [{", ".join(f'merge(field: "{field}", fn: {ROLLUP_FIELDS[field]})' for field in fields)}])
+      |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+      |> group()
+      |> sort(columns: ["_time"])
+    '''
+    return query
+
+
+def build_downsample_query(source_bucket, target_bucket, every, start, stop=None, from_raw=True):
+    """Compile the Flux that writes rollup points for every window between start and stop
+
+    From raw points each rollup field is computed as build_merged_query
+    does, merging in the fields of pre-aggregated points. From a finer tier
+    (from_raw=False) the fields of its points are merged instead. Points
+    keep their series tags and are timestamped with their window start.
+    """
+    every = format_duration(parse_duration(every))
+    if from_raw:
+        def select(field):
+            # Without _field in the group key, a series' values and fields merge into one table
+            return (
+                f'from(bucket: {flux_string(source_bucket)})\n'
+                f'  |> range(start: {start}, stop: {stop or "now()"})\n'
+                f'  |> filter(fn: (r) => r["_measurement"] == "metrics" and r["_field"] == {flux_string(field)})\n'
+                '  |> group(columns: ["_field", "_time", "_value"], mode: "except")'
+            )
+
+        query = f'''
+    union(tables: [
+    {", ".join(merged_field_streams(select, every, ROLLUP_FIELDS))}
+    ])
+      |> group(columns: ["_time", "_value"], mode: "except")
+    '''
+    else:
+        query = f'''
+    data = from(bucket: {flux_string(source_bucket)})
+      |> range(start: {start}, stop: {stop or "now()"})
+      |> filter(fn: (r) => r["_measurement"] == "metrics")
+
+    merge = (field, fn) => data
+      |> filter(fn: (r) => r["_field"] == field)
+      |> aggregateWindow(every: {every}, fn: fn, timeSrc: "_start", createEmpty: false)
+
+    union(tables: [{", ".join(f'merge(field: "{field}", fn: {fn})' for field, fn in ROLLUP_FIELDS.items())}])
+    '''
+    query += f'  |> to(bucket: {flux_string(target_bucket)})\n'
+    return query
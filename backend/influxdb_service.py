@@ -2,25 +2,53 @@ from influxdb_client import InfluxDBClient, Point
 from influxdb_client.client.write_api import SYNCHRONOUS
 from influxdb_client.client.exceptions import InfluxDBError
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from flux_queries import (
+    build_aggregate_query, build_merged_query, build_rollup_query, build_points_query, aggregate_expression,
+    default_range, group_columns, parse_duration, flux_string, time_literal, ROLLUP_AGGREGATES, ENGINE_AGGREGATES,
+)
+from flux_csv import CSV_DIALECT, iter_metric_rows
+from rollups import rollup_value, parse_time
+from columnar import ColumnarMetrics
+from aggregation import aggregate, aggregated_row
+from metric_record import AGGREGATE_VALUE_FIELD, encode_line
+from query_cache import EPOCH
+from telemetry import telemetry
 
 class InfluxDB:
-    def __init__(self):
+    def __init__(self, timeout_ms=None, pool_size=None):
         self.url = os.getenv('INFLUXDB_URL', 'http://influxdb:8086')
         self.token = os.getenv('INFLUXDB_TOKEN', 'theia-admin-token-123456')
         self.org = os.getenv('INFLUXDB_ORG', 'theia')
         self.bucket = os.getenv('INFLUXDB_BUCKET', 'theia')
+        # Read timeout per request; a request that times out is closed, and InfluxDB cancels its query
+        self.timeout_ms = timeout_ms or int(os.getenv('INFLUXDB_TIMEOUT_MS', '10000'))
+        self.pool_size = pool_size or int(os.getenv('INFLUXDB_POOL_SIZE', '16'))
         
-        self.client = InfluxDBClient(url=self.url, token=self.token, org=self.org)
+        self.client = InfluxDBClient(
+            url=self.url, token=self.token, org=self.org,
+            timeout=(5000, self.timeout_ms), connection_pool_maxsize=self.pool_size
+        )
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
         self.query_api = self.client.query_api()
+        # RollupManager routing aggregate queries to rollup tiers; None queries raw points only
+        self.rollups = None
     
-    def write_metric(self, name, value, tags=None, timestamp=None, source=None):
-        """Write a single metric to InfluxDB"""
+    def build_point(self, name, value, tags=None, timestamp=None, source=None, fields=None):
+        """Build an InfluxDB point for a single metric"""
         point = Point("metrics")
         point.field("value", float(value))
         point.tag("name", name)
         
+        # Extra fields, e.g. count/sum/min/max from agent-side pre-aggregation
+        if fields:
+            for key, val in fields.items():
+                if val is not None:
+                    point.field(key, float(val))
+        
         if tags:
             for key, val in tags.items():
                 point.tag(key, str(val))
@@ -35,188 +63,275 @@ class InfluxDB:
         else:
             point.time(datetime.utcnow())
         
+        return point
+    
+    def write_metric(self, name, value, tags=None, timestamp=None, source=None):
+        """Write a single metric to InfluxDB"""
+        point = self.build_point(name, value, tags=tags, timestamp=timestamp, source=source)
+        return self.write_points([point])
+    
+    def write_points(self, points):
+        """Write a batch of points to InfluxDB in a single request"""
         try:
-            self.write_api.write(bucket=self.bucket, record=point)
+            self.write_api.write(bucket=self.bucket, record=points)
             return True
         except InfluxDBError as e:
             print(f"Error writing to InfluxDB: {e}")
             return False
     
-    def query_metrics(self, name=None, source=None, start_time=None, end_time=None, limit=1000):
-        """Query metrics from InfluxDB"""
+    def encode_point(self, metric):
+        """Points are written as line protocol"""
+        return encode_line(metric)
+    
+    def write_batch(self, points):
+        """Write encoded points; the storage interface's name for write_points"""
+        return self.write_points(points)
+    
+    def ping(self):
+        return self.client.ping()
+    
+    def query(self, query):
+        """Run a Flux query and return its tables"""
+        with telemetry.timer('flux_query_seconds'):
+            try:
+                return self.query_api.query(query, org=self.org)
+            except Exception:
+                telemetry.incr('query_errors')
+                raise
+    
+    def query_csv(self, query):
+        """Start a Flux query and return its CSV rows, read as they arrive
+        
+        flux_query_seconds covers the time until the response starts, which is
+        mostly Flux execution; decoding is timed by the caller.
+        """
+        with telemetry.timer('flux_query_seconds'):
+            try:
+                return self.query_api.query_csv(query, org=self.org, dialect=CSV_DIALECT)
+            except Exception:
+                telemetry.incr('query_errors')
+                raise
+    
+    def metrics_query(self, name=None, source=None, start_time=None, end_time=None, limit=1000):
+        """Build the Flux query for raw metric points"""
         query = f'''
         from(bucket: "{self.bucket}")
-          |> range(start: {start_time or "-24h"}, stop: {end_time or "now()"})
+          |> range(start: {time_literal(start_time or "-24h")}, stop: {time_literal(end_time or "now()")})
           |> filter(fn: (r) => r["_measurement"] == "metrics")
-          |> filter(fn: (r) => r["_field"] == "value")
+          |> filter(fn: (r) => r["_field"] == "value" or r["_field"] == "{AGGREGATE_VALUE_FIELD}")
         '''
         
         if name:
-            query += f'  |> filter(fn: (r) => r["name"] == "{name}")\n'
+            query += f'  |> filter(fn: (r) => r["name"] == {flux_string(name)})\n'
         if source:
-            query += f'  |> filter(fn: (r) => r["source"] == "{source}")\n'
+            query += f'  |> filter(fn: (r) => r["source"] == {flux_string(source)})\n'
         
         query += f'  |> limit(n: {limit})\n'
         query += '  |> sort(columns: ["_time"], desc: true)'
+        return query
+    
+    def iter_metrics(self, name=None, source=None, start_time=None, end_time=None, limit=1000,
+                     iso_timestamps=True):
+        """Stream raw metrics as compact (name, value, timestamp, tags, source) tuples
         
+        Rows are decoded from the CSV response as it arrives, so memory does not
+        grow with the result size. Query errors are raised.
+        """
+        query = self.metrics_query(name=name, source=source, start_time=start_time, end_time=end_time, limit=limit)
+        return iter_metric_rows(self.query_csv(query), iso_timestamps=iso_timestamps)
+    
+    def query_metrics(self, name=None, source=None, start_time=None, end_time=None, limit=1000):
+        """Query metrics from InfluxDB"""
         try:
-            result = self.query_api.query(org=self.org, query=query)
-            metrics = []
-            for table in result:
-                for record in table.records:
-                    # Use record.values - tags are preserved in the dict
-                    values = record.values if hasattr(record, 'values') else {}
-                    
-                    # Extract metric data - tags like 'name', 'source', 'button', 'page' are in values
-                    # But due to duplicate column names warning, we need to be careful
-                    metric_name = values.get('name', '')
-                    # If name not found, try to get from row list (index 8 based on earlier test)
-                    if not metric_name and hasattr(record, 'row') and isinstance(record.row, list) and len(record.row) > 8:
-                        metric_name = record.row[8] if isinstance(record.row[8], str) else ''
-                    
-                    metric_value = record.get_value()
-                    metric_time = record.get_time()
-                    metric_source = values.get('source', '')
-                    
-                    # Get tags - extract from values, excluding system fields
-                    tags = {}
-                    if isinstance(values, dict):
-                        # Get all non-system fields as tags
-                        for k, v in values.items():
-                            if k not in ['_measurement', '_field', '_time', '_value', '_start', '_stop', 
-                                        'result', 'table', ''] and not k.startswith('_'):
-                                tags[k] = v
-                    
-                    if metric_time and metric_value is not None:
-                        metric = {
-                            'name': metric_name,
-                            'value': float(metric_value),
-                            'timestamp': metric_time.isoformat(),
-                            'tags': tags,
-                            'source': metric_source
-                        }
-                        metrics.append(metric)
-            return metrics
+            return [
+                {'name': name, 'value': value, 'timestamp': timestamp, 'tags': tags, 'source': source}
+                for name, value, timestamp, tags, source in self.iter_metrics(
+                    name=name, source=source, start_time=start_time, end_time=end_time, limit=limit
+                )
+            ]
         except Exception as e:
             print(f"Error querying InfluxDB: {e}")
             import traceback
             traceback.print_exc()
             return []
     
-    def query_aggregated_metrics(self, name=None, window='1h', aggregate_fn='mean'):
-        """Query aggregated metrics grouped by time window"""
-        from collections import defaultdict
-        from datetime import timedelta
-        
-        # Get raw metrics first - use longer time range for aggregation
-        # Use longer range to ensure we have enough data points for the graph
-        time_range_map = {
-            '1m': '-6h',   # 6 hours for 1-minute windows = 360 data points max
-            '5m': '-24h',  # 24 hours for 5-minute windows = 288 data points max
-            '1h': '-7d',   # 7 days for hourly windows = 168 data points max
-            '1d': '-30d'   # 30 days for daily windows = 30 data points max
-        }
-        time_range = time_range_map.get(window, '-24h')
-        raw_metrics = self.query_metrics(name=name, start_time=time_range, limit=50000)
-        
-        if not raw_metrics:
+    def query_aggregated_metrics(self, name=None, window='1h', aggregate_fn='mean', tags=None,
+                                 start_time=None, end_time=None, group_by=None):
+        """Query metrics aggregated server-side into time window buckets"""
+        try:
+            return self.fetch_aggregated_metrics(
+                name=name, window=window, aggregate_fn=aggregate_fn, tags=tags,
+                start_time=start_time, end_time=end_time, group_by=group_by
+            )
+        except ValueError:
+            raise
+        except Exception as e:
+            print(f"Error querying aggregated metrics: {e}")
             return []
+    
+    def fetch_aggregated_metrics(self, name=None, window='1h', aggregate_fn='mean', tags=None,
+                                 start_time=None, end_time=None, group_by=None):
+        """Like query_aggregated_metrics, but query errors are raised instead of returning []
         
-        # Parse window to timedelta
-        window_map = {
-            '1m': timedelta(minutes=1),
-            '5m': timedelta(minutes=5),
-            '1h': timedelta(hours=1),
-            '1d': timedelta(days=1)
-        }
-        window_delta = window_map.get(window, timedelta(hours=1))
+        name may be a list of metric names. With group_by (a list of tag keys)
+        each name is split into one series per combination of those tags, and
+        every row carries them under ``tags``.
+        """
+        segments = [(None, start_time, end_time)]
+        if self.rollups is not None:
+            segments = self.rollups.plan(window, aggregate_fn=aggregate_fn, start_time=start_time, end_time=end_time)
         
-        # Group by time bucket and metric name
-        buckets = defaultdict(lambda: {'values': [], 'name': name or 'unknown'})
+        aggregated = []
+        for tier, start, stop in segments:
+            if tier is None:
+                aggregated += self.fetch_raw_aggregate(name, window, aggregate_fn, tags, start, stop, group_by)
+            else:
+                aggregated += self.fetch_rollup_aggregate(tier, name, window, aggregate_fn, tags, start, stop, group_by)
+        return aggregated
+    
+    def raw_span(self, window, aggregate_fn='mean', start_time=None, end_time=None):
+        """How much time of raw points an aggregate query would scan, as a timedelta"""
+        now = datetime.now(timezone.utc)
+        segments = [(None, start_time, end_time)]
+        if self.rollups is not None:
+            segments = self.rollups.plan(
+                window, aggregate_fn=aggregate_fn, start_time=start_time, end_time=end_time, record=False
+            )
+        return sum((
+            parse_time(stop, now) - parse_time(start or default_range(window), now)
+            for tier, start, stop in segments if tier is None
+        ), timedelta(0))
+    
+    def fetch_raw_aggregate(self, name, window, aggregate_fn, tags, start_time, end_time, group_by=None):
+        """Aggregate raw points with aggregateWindow
         
-        for metric in raw_metrics:
-            try:
-                timestamp = datetime.fromisoformat(metric['timestamp'].replace('Z', '+00:00'))
-                # Round down to window boundary
-                if window_delta >= timedelta(days=1):
-                    # Daily buckets
-                    bucket_time = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
-                elif window_delta >= timedelta(hours=1):
-                    # Hourly buckets
-                    bucket_time = timestamp.replace(minute=0, second=0, microsecond=0)
-                elif window_delta >= timedelta(minutes=5):
-                    # 5-minute buckets
-                    minutes_rounded = (timestamp.minute // 5) * 5
-                    bucket_time = timestamp.replace(minute=minutes_rounded, second=0, microsecond=0)
-                else:
-                    # 1-minute buckets
-                    bucket_time = timestamp.replace(second=0, microsecond=0)
-                
-                metric_name = metric.get('name', name or 'unknown')
-                bucket_key = (bucket_time.isoformat(), metric_name)
-                buckets[bucket_key]['values'].append(metric['value'])
-                buckets[bucket_key]['name'] = metric_name
-            except Exception as e:
-                continue
-        
-        # Calculate aggregation based on function
+        Aggregates that rollups can answer are computed from rollup fields
+        merged over raw points, which also merges the fields of points the
+        agent pre-aggregated. Percentiles aggregate the values directly.
+        """
+        aggregate = aggregate_expression(aggregate_fn)
+        if aggregate in ENGINE_AGGREGATES:
+            return self.fetch_engine_aggregate(name, window, aggregate_fn, tags, start_time, end_time, group_by)
+        if aggregate in ROLLUP_AGGREGATES:
+            query = build_merged_query(
+                self.bucket, window, ROLLUP_AGGREGATES[aggregate], name=name, tags=tags,
+                start_time=start_time, end_time=end_time, group_by=group_by
+            )
+            return self.merged_rows(query, aggregate, name, group_by)
+        query = build_aggregate_query(
+            self.bucket, window, aggregate_fn=aggregate_fn, name=name, tags=tags,
+            start_time=start_time, end_time=end_time, group_by=group_by
+        )
+        
+        aggregated = []
+        for table in self.query(query):
+            for record in table.records:
+                value = record.values.get('agg')
+                if value is None:
+                    continue
+                aggregated.append(aggregated_row(
+                    record.values, name, group_by, record.get_time().isoformat(), value,
+                    record.values.get('count') or 0
+                ))
+        return aggregated
+    
+    def fetch_engine_aggregate(self, name, window, aggregate_fn, tags, start_time, end_time, group_by=None):
+        """Aggregate raw points in the backend with the NumPy engine
+        
+        Only rate runs here, and the sums of pre-aggregated points count as
+        their values.
+        """
+        group_columns(group_by)
+        query = build_points_query(
+            self.bucket, name=name, tags=tags, start_time=start_time or default_range(window), end_time=end_time,
+            field=('value', 'sum')
+        )
+        rows = iter_metric_rows(self.query_csv(query), iso_timestamps=False)
+        with telemetry.timer('decode_seconds'):
+            columns = ColumnarMetrics(rows)
+        # One group per (name, group_by tag values); Flux CSV writes a missing tag as ''
+        groups = {}
+        per_series = np.empty(len(columns.series), dtype=np.int64)
+        for index, (series_name, _, series_tags) in enumerate(columns.series):
+            key = (series_name,) + tuple(series_tags.get(tag) or None for tag in group_by or ())
+            per_series[index] = groups.setdefault(key, len(groups))
+        groups = [dict(zip(['name'] + list(group_by or ()), key)) for key in groups]
+        
+        window_ns = parse_duration(window) // timedelta(microseconds=1) * 1000
+        with telemetry.timer('engine_seconds'):
+            codes, buckets, values, counts = aggregate(
+                columns.timestamp, columns.value, window_ns, aggregate_fn, groups=per_series[columns.series_codes]
+            )
+        return [
+            aggregated_row(
+                groups[code], name, group_by, (EPOCH + timedelta(microseconds=int(bucket) // 1000)).isoformat(),
+                value, count
+            )
+            for code, bucket, value, count in zip(codes, buckets, values, counts)
+        ]
+    
+    def fetch_rollup_aggregate(self, tier, name, window, aggregate_fn, tags, start_time, end_time, group_by=None):
+        """Aggregate by merging the points of a rollup tier"""
+        aggregate = aggregate_expression(aggregate_fn)
+        query = build_rollup_query(
+            tier.bucket, window, ROLLUP_AGGREGATES[aggregate], name=name, tags=tags,
+            start_time=start_time, end_time=end_time, group_by=group_by
+        )
+        return self.merged_rows(query, aggregate, name, group_by)
+    
+    def merged_rows(self, query, aggregate, name, group_by):
+        """Compute an aggregate from the rows of merged rollup fields a query returns"""
         aggregated = []
-        for (time_bucket, metric_name), data in buckets.items():
-            if data['values']:
-                values = data['values']
-                aggregated_value = 0.0
-                
-                if aggregate_fn == 'mean' or aggregate_fn == 'avg':
-                    aggregated_value = sum(values) / len(values)
-                elif aggregate_fn == 'sum':
-                    aggregated_value = sum(values)
-                elif aggregate_fn == 'max':
-                    aggregated_value = max(values)
-                elif aggregate_fn == 'min':
-                    aggregated_value = min(values)
-                elif aggregate_fn == 'count':
-                    aggregated_value = len(values)
-                elif aggregate_fn == 'last':
-                    aggregated_value = values[-1] if values else 0.0
-                else:
-                    # Default to mean
-                    aggregated_value = sum(values) / len(values)
-                
-                aggregated.append({
-                    'name': data['name'],
-                    'time_bucket': time_bucket,
-                    'avg_value': aggregated_value,  # Keep field name for compatibility
-                    'count': len(values)
-                })
-        
-        # Sort by time
-        aggregated.sort(key=lambda x: x['time_bucket'])
+        for table in self.query(query):
+            for record in table.records:
+                if not record.values.get('count'):
+                    continue
+                value = rollup_value(aggregate, record.values)
+                if value is None:
+                    continue
+                aggregated.append(aggregated_row(
+                    record.values, name, group_by, record.get_time().isoformat(), value, record.values['count']
+                ))
         return aggregated
     
     def get_metric_names(self):
         """Get list of all unique metric names"""
-        query = f'''
-        from(bucket: "{self.bucket}")
-          |> range(start: -30d)
-          |> filter(fn: (r) => r["_measurement"] == "metrics")
-          |> filter(fn: (r) => r["_field"] == "value")
-          |> keep(columns: ["name"])
-          |> distinct(column: "name")
-        '''
-        
         try:
-            result = self.query_api.query(org=self.org, query=query)
-            names = []
-            for table in result:
-                for record in table.records:
-                    name = record.values.get('name')
-                    if name and name not in names:
-                        names.append(name)
-            return sorted(names)
+            return self.get_tag_values('name')
         except Exception as e:
             print(f"Error getting metric names: {e}")
             return []
     
+    def get_tag_values(self, tag, name=None, start='-30d'):
+        """Distinct values of a tag, optionally for one metric, using schema.tagValues"""
+        predicate = 'r["_measurement"] == "metrics"'
+        if name is not None:
+            predicate += f' and r["name"] == {flux_string(name)}'
+        query = f'''
+        import "influxdata/influxdb/schema"
+        schema.tagValues(bucket: {flux_string(self.bucket)}, tag: {flux_string(tag)},
+                         predicate: (r) => {predicate}, start: {start})
+        '''
+        return self._distinct_values(query)
+    
+    def get_tag_keys(self, name, start='-30d'):
+        """Tag keys used by one metric, using schema.tagKeys"""
+        query = f'''
+        import "influxdata/influxdb/schema"
+        schema.tagKeys(bucket: {flux_string(self.bucket)},
+                       predicate: (r) => r["_measurement"] == "metrics" and r["name"] == {flux_string(name)},
+                       start: {start})
+        '''
+        return [key for key in self._distinct_values(query) if not key.startswith('_')]
+    
+    def _distinct_values(self, query):
+        values = set()
+        for table in self.query(query):
+            for record in table.records:
+                if record.get_value():
+                    values.add(record.get_value())
+        return sorted(values)
+    
     def close(self):
         """Close the InfluxDB client"""
         self.client.close()
@@ -0,0 +1,351 @@
+"""Live aggregate streams fed by the points the worker publishes after each write"""
+import json
+import math
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import redis
+
+from flux_queries import parse_duration, aggregate_expression, AGGREGATE_FUNCTIONS
+from query_cache import align, closed_before, range_start, flux_time
+
+# Aggregates whose bucket value can be updated point by point from a seeded
+# (value, count) pair; anything else is re-queried for the open buckets
+MERGEABLE = ('mean', 'sum', 'count', 'min', 'max', 'first', 'last')
+
+
+def parse_timestamp(value):
+    """Convert an ISO 8601 string or integer nanoseconds into an aware datetime"""
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1e9, tz=timezone.utc)
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+class Bucket:
+    """Running state of one open bucket"""
+
+    __slots__ = ('count', 'sum', 'min', 'max', 'first', 'first_time', 'last', 'last_time')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.first = None
+        self.first_time = None
+        self.last = None
+        self.last_time = None
+
+    def seed(self, aggregate, value, count, start, now):
+        """Start from the bucket's value as already stored in InfluxDB"""
+        self.count = count
+        if aggregate == 'mean':
+            self.sum = value * count
+        elif aggregate == 'sum':
+            self.sum = value
+        elif aggregate == 'min':
+            self.min = value
+        elif aggregate == 'max':
+            self.max = value
+        elif aggregate == 'first':
+            self.first, self.first_time = value, start
+        elif aggregate == 'last':
+            self.last, self.last_time = value, now
+
+    def add(self, value, timestamp, fields=None):
+        """Fold in a raw point, or a pre-aggregated one through its count, sum, min, max, first and last fields"""
+        if fields:
+            self.count += int(fields['count'])
+            self.sum += fields.get('sum', value * fields['count'])
+            low, high = fields.get('min', value), fields.get('max', value)
+            first, last = fields.get('first', value), fields.get('last', value)
+        else:
+            self.count += 1
+            self.sum += value
+            low = high = first = last = value
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+        if self.first_time is None or timestamp < self.first_time:
+            self.first, self.first_time = first, timestamp
+        if self.last_time is None or timestamp >= self.last_time:
+            self.last, self.last_time = last, timestamp
+
+    def value(self, aggregate):
+        if aggregate == 'mean':
+            return self.sum / self.count
+        if aggregate == 'sum':
+            return self.sum
+        if aggregate == 'count':
+            return float(self.count)
+        if aggregate == 'min':
+            return self.min
+        if aggregate == 'max':
+            return self.max
+        if aggregate == 'first':
+            return self.first
+        return self.last
+
+
+class LiveAggregation:
+    """Open buckets of one (name, window, aggregate) stream, shared by all its viewers"""
+
+    def __init__(self, influxdb, name, window, aggregate_fn, grace):
+        self.influxdb = influxdb
+        self.name = name
+        self.window = window
+        self.every = parse_duration(window)
+        self.aggregate_fn = aggregate_fn
+        # Validates the aggregate the same way the REST endpoint does
+        expression = aggregate_expression(aggregate_fn)
+        self.aggregate = expression if expression in AGGREGATE_FUNCTIONS.values() else None
+        self.mergeable = self.aggregate in MERGEABLE
+        self.grace = grace
+        self.subscribers = set()
+        self.buckets = {}
+        self.dirty = set()
+        self.requery = False
+        # Points received while a seed query runs, replayed once it is loaded; None when not seeding
+        self.pending = None
+
+    def query(self):
+        """Fetch the buckets that can still change from storage"""
+        start = closed_before(self.window, datetime.now(timezone.utc), self.grace)
+        return self.influxdb.fetch_aggregated_metrics(
+            name=self.name, window=self.window, aggregate_fn=self.aggregate_fn, start_time=flux_time(start)
+        )
+
+    def load(self, rows):
+        """Replace the open buckets with queried rows, then replay the points received meanwhile"""
+        now = datetime.now(timezone.utc)
+        start = closed_before(self.window, now, self.grace)
+        buckets = {}
+        bucket_start = start
+        while bucket_start <= now:
+            buckets[bucket_start] = Bucket()
+            bucket_start += self.every
+        for row in rows:
+            bucket_start = datetime.fromisoformat(row['time_bucket'])
+            bucket = buckets.setdefault(bucket_start, Bucket())
+            if self.mergeable:
+                bucket.seed(self.aggregate, row['avg_value'], row['count'], bucket_start, now)
+        self.buckets = buckets
+        pending, self.pending = self.pending or [], None
+        for point in pending:
+            self.add(*point)
+
+    def add(self, value, timestamp, fields=None):
+        """Fold one point in; returns False for points in buckets that are already closed"""
+        if self.pending is not None:
+            self.pending.append((value, timestamp, fields))
+            return True
+        bucket_start = align(timestamp, self.every)
+        if bucket_start < closed_before(self.window, datetime.now(timezone.utc), self.grace):
+            return False
+        if self.mergeable:
+            bucket = self.buckets.get(bucket_start)
+            if bucket is None:
+                bucket = self.buckets[bucket_start] = Bucket()
+            bucket.add(value, timestamp, fields)
+            self.dirty.add(bucket_start)
+        else:
+            self.requery = True
+        return True
+
+    def updates(self):
+        """Return rows for buckets changed since the last call and drop closed buckets"""
+        rows = []
+        for bucket_start in sorted(self.dirty):
+            bucket = self.buckets.get(bucket_start)
+            if bucket is None or not bucket.count:
+                continue
+            rows.append({
+                'name': self.name,
+                'time_bucket': bucket_start.isoformat(),
+                'avg_value': float(bucket.value(self.aggregate)),
+                'count': bucket.count,
+            })
+        self.dirty = set()
+        boundary = closed_before(self.window, datetime.now(timezone.utc), self.grace)
+        for bucket_start in [start for start in self.buckets if start < boundary]:
+            del self.buckets[bucket_start]
+        return rows
+
+
+class LiveHub:
+    """Subscribes once to the worker's live channel and fans bucket updates out to streams
+
+    Each (name, window, aggregate) has one LiveAggregation however many
+    clients watch it. Incoming points are folded into it as they arrive and
+    changed buckets are pushed to every subscriber queue every
+    ``push_interval`` seconds. Aggregates that cannot be updated point by
+    point (percentiles, stddev, spread) re-query their open buckets instead,
+    at most once per interval and only when new points arrived.
+
+    A stream is registered before its seed query runs and buffers the points
+    received until the query returns, so none are lost in between. A point
+    published while the query starts may be counted twice. Seed queries run
+    on ``executor`` (a QueryExecutor) when given, under its deadline.
+    """
+
+    def __init__(self, influxdb, redis_url, channel, push_interval=0.5, grace=30.0, queue_size=1000, executor=None):
+        self.influxdb = influxdb
+        self.executor = executor
+        self.redis_url = redis_url
+        self.channel = channel
+        self.push_interval = push_interval
+        self.grace = timedelta(seconds=grace)
+        self.queue_size = queue_size
+        self._aggregations = {}
+        self._by_name = {}
+        self._lock = threading.Lock()
+        self._threads = None
+        self.points_received = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads is None:
+                self._threads = [
+                    threading.Thread(target=self._listen, name='live-listener', daemon=True),
+                    threading.Thread(target=self._push, name='live-push', daemon=True),
+                ]
+                for thread in self._threads:
+                    thread.start()
+        return self
+
+    def subscribe(self, name, window, aggregate_fn):
+        """Register a viewer; returns (key, queue of update lists)"""
+        self.start()
+        key = (name, window, aggregate_fn)
+        updates = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            aggregation = self._aggregations.get(key)
+            created = aggregation is None
+            if created:
+                aggregation = self._aggregations[key] = LiveAggregation(
+                    self.influxdb, name, window, aggregate_fn, self.grace
+                )
+                self._by_name.setdefault(name, set()).add(aggregation)
+            aggregation.subscribers.add(updates)
+        if created:
+            try:
+                self._seed(aggregation)
+            except Exception:
+                self.unsubscribe(key, updates)
+                with self._lock:
+                    # Viewers that joined meanwhile get a seed from the push thread
+                    aggregation.requery = True
+                raise
+        return key, updates
+
+    def _seed(self, aggregation):
+        """Query an aggregation's open buckets, buffering the points that arrive meanwhile; returns the rows"""
+        with self._lock:
+            aggregation.pending = []
+        try:
+            if self.executor is not None:
+                rows = self.executor.run(aggregation.query)
+            else:
+                rows = aggregation.query()
+        except Exception:
+            with self._lock:
+                # Points received meanwhile are in the next seed
+                aggregation.pending = None
+            raise
+        with self._lock:
+            aggregation.load(rows)
+        return rows
+
+    def unsubscribe(self, key, updates):
+        with self._lock:
+            aggregation = self._aggregations.get(key)
+            if aggregation is None:
+                return
+            aggregation.subscribers.discard(updates)
+            if not aggregation.subscribers:
+                del self._aggregations[key]
+                self._by_name[aggregation.name].discard(aggregation)
+                if not self._by_name[aggregation.name]:
+                    del self._by_name[aggregation.name]
+
+    def _listen(self):
+        while True:
+            try:
+                client = redis.Redis.from_url(self.redis_url)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self._receive(message['data'])
+            except redis.RedisError as e:
+                print(f"Live channel connection lost, reconnecting: {e}")
+                time.sleep(1)
+
+    def _receive(self, data):
+        try:
+            points = json.loads(data)
+        except ValueError as e:
+            print(f"Ignoring malformed live update: {e}")
+            return
+        with self._lock:
+            for point in points:
+                aggregations = self._by_name.get(point.get('name'))
+                if not aggregations:
+                    continue
+                try:
+                    value = float(point['value'])
+                    timestamp = parse_timestamp(point['timestamp'])
+                    # Pre-aggregated points carry the fields of the points they stand for
+                    fields = {key: float(field) for key, field in (point.get('fields') or {}).items()
+                              if field is not None}
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if 'count' not in fields:
+                    fields = None
+                self.points_received += 1
+                for aggregation in aggregations:
+                    aggregation.add(value, timestamp, fields)
+
+    def _push(self):
+        while True:
+            time.sleep(self.push_interval)
+            with self._lock:
+                aggregations = list(self._aggregations.values())
+            for aggregation in aggregations:
+                try:
+                    with self._lock:
+                        requery, aggregation.requery = aggregation.requery, False
+                        rows = aggregation.updates()
+                    if requery:
+                        # Points arriving meanwhile are replayed, setting requery again for aggregates that need it
+                        rows = self._seed(aggregation)
+                except Exception as e:
+                    print(f"Error updating live aggregation {aggregation.name}: {e}")
+                    with self._lock:
+                        aggregation.requery = True
+                    continue
+                if not rows:
+                    continue
+                event = {
+                    'buckets': rows,
+                    'range_start': range_start(aggregation.window, datetime.now(timezone.utc)).isoformat(),
+                }
+                with self._lock:
+                    subscribers = list(aggregation.subscribers)
+                for updates in subscribers:
+                    try:
+                        updates.put_nowait(event)
+                    except queue.Full:
+                        # A stalled viewer misses updates; its reconnect resyncs from the REST API
+                        pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': len(self._aggregations),
+                'viewers': sum(len(aggregation.subscribers) for aggregation in self._aggregations.values()),
+                'points_received': self.points_received,
+            }
@@ -0,0 +1,806 @@
+"""Embedded time-series store: the storage interface of InfluxDB on local files, with no server
+
+One directory holds everything, shared by the processes that write to it
+(workers) and read from it (the backend):
+
+  store.json              the partition length, fixed when the store is created
+  series.log              one JSON line [id, name, tags, source, field] per series, append-only
+  wal/<writer>.<n>.wal    each writer's recent points as (series, time, value) records
+  <start>/chunks.dat      compressed chunks (see chunk_codec) of the points in one time partition
+  <start>/chunks.idx      one record per chunk: series, time range, offset, length and point count
+
+A writer appends each batch to its own write-ahead log and keeps the points
+in a head per series. A head is cut into a chunk when it holds chunk_points
+points, or when its oldest point arrived head_seconds ago, so that chunks
+hold enough points to compress well. Readers see a point as soon as it is
+in a log. A log segment is deleted once every point in it is in a chunk.
+Points of a series with the same time are deduplicated, keeping the one
+written last, as InfluxDB overwrites them. As in InfluxDB, each field of a
+metric is its own series: 'value' for raw points, and 'mean' plus the
+count, sum, ... fields for pre-aggregated ones (see metric_record.encode_line).
+
+Appends to the chunk files and to series.log are serialized across processes
+with flock. Chunk bytes are written before the index records pointing at
+them, so readers only see whole chunks. Partitions past the retention period
+are deleted whole. A log left by a writer that died, and so no longer holds
+its lock, is cut into chunks by the next writer that finds it.
+"""
+import contextlib
+import fcntl
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from aggregation import aggregate, aggregate_spec, aggregated_row
+from chunk_codec import decode_chunk, encode_chunk
+from flux_queries import ROLLUP_AGGREGATES, ROLLUP_FIELDS, default_range, group_columns, parse_duration
+from metric_record import AGGREGATE_VALUE_FIELD
+from query_cache import EPOCH
+from rollups import parse_time, rollup_value
+from telemetry import telemetry
+
+INDEX_RECORD = np.dtype([
+    ('series', '<u4'), ('min_time', '<i8'), ('max_time', '<i8'), ('offset', '<u8'), ('length', '<u4'),
+    ('count', '<u4'),
+])
+WAL_RECORD = np.dtype([('series', '<u4'), ('time', '<i8'), ('value', '<f8')])
+# A writer starts a new log segment at this size, or after head_seconds / 2
+WAL_SEGMENT_BYTES = 64 * 1024 ** 2
+
+
+def nanoseconds(moment):
+    delta = moment - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+
+def duration_ns(value):
+    return parse_duration(value) // timedelta(microseconds=1) * 1000
+
+
+def tag_matcher(key, expressions):
+    """A predicate on a series' columns with the semantics of flux_queries.tag_predicate"""
+    if isinstance(expressions, str):
+        expressions = [expressions]
+    matches, excludes = [], []
+    for expression in expressions:
+        negate = expression.startswith('!')
+        if negate:
+            expression = expression[1:]
+        if expression.startswith('~'):
+            try:
+                test = re.compile(expression[1:]).search
+            except re.error as e:
+                raise ValueError(f'Invalid regex for tag {key}: {e}')
+        else:
+            test = expression.__eq__
+        (excludes if negate else matches).append(test)
+
+    def match(columns):
+        value = columns.get(key)
+        if matches and (value is None or not any(test(value) for test in matches)):
+            return False
+        # A series without the tag does not equal (or match) anything
+        return value is None or not any(test(value) for test in excludes)
+
+    return match
+
+
+def deduplicate(series, times, values, ranks=None):
+    """Sort points by series and time, keeping the last (or highest ranked) of any with the same series and time"""
+    order = np.lexsort((times, series) if ranks is None else (ranks, times, series))
+    series, times, values = series[order], times[order], values[order]
+    last = np.ones(len(series), dtype=bool)
+    last[:-1] = (series[1:] != series[:-1]) | (times[1:] != times[:-1])
+    return series[last], times[last], values[last]
+
+
+def point_fields(metric):
+    """(metric, field, value) of each field a Metric with extra fields is stored as, like encode_line"""
+    fields = {key: float(value) for key, value in metric.fields.items() if value is not None}
+    fields[AGGREGATE_VALUE_FIELD if 'count' in fields else 'value'] = metric.value
+    return [(metric, field, value) for field, value in sorted(fields.items()) if math.isfinite(value)]
+
+
+def iso_times(times):
+    """Format int64 nanoseconds the way datetime.isoformat() prints UTC times"""
+    return [
+        (text[:-7] if text.endswith('.000000') else text) + '+00:00'
+        for text in np.datetime_as_string(times.astype('datetime64[ns]').astype('datetime64[us]'))
+    ]
+
+
+class Partition:
+    """Index and mapped chunk data of one time partition, refreshed as writers append to them"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = np.empty(0, dtype=INDEX_RECORD)
+        self.data = None
+        self.mapped = 0
+
+    def refresh(self):
+        """Read index records appended since the last refresh; raises FileNotFoundError once deleted"""
+        with open(os.path.join(self.directory, 'chunks.idx'), 'rb') as f:
+            f.seek(len(self.index) * INDEX_RECORD.itemsize)
+            data = f.read()
+        whole = len(data) - len(data) % INDEX_RECORD.itemsize
+        if whole:
+            self.index = np.concatenate([self.index, np.frombuffer(data[:whole], dtype=INDEX_RECORD)])
+        needed = int((self.index['offset'] + self.index['length']).max()) if len(self.index) else 0
+        if needed > self.mapped:
+            # Queries decoding from the previous map keep it alive until they finish
+            with open(os.path.join(self.directory, 'chunks.dat'), 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped = len(self.data)
+        return self.index, self.data
+
+
+class LocalStore:
+    """Metrics stored in local files, queried with the same methods and results as InfluxDB
+
+    See the module docstring for the file layout. Rollup tiers are not
+    supported, so aggregates always run over raw points with the NumPy
+    engine, as rate and percentiles do on InfluxDB. Each field of a
+    pre-aggregated point is stored as its own series and merged with raw
+    values at query time.
+    """
+
+    def __init__(self, path, partition='1d', retention=None, chunk_points=1024, head_seconds=300.0, fsync=False):
+        self.path = path
+        self.retention = duration_ns(retention) if retention else None
+        self.chunk_points = chunk_points
+        self.head_seconds = head_seconds
+        self.fsync = fsync
+        self.rollups = None
+        os.makedirs(os.path.join(path, 'wal'), exist_ok=True)
+        self.partition = self._partition_length(duration_ns(partition))
+
+        self._lock = threading.RLock()
+        self._lock_fd = None
+        self._lock_pid = None
+        # Series index, loaded from series.log as other processes append to it
+        self._series = []  # id -> (name, columns): columns holds the tags plus name and source
+        self._series_fields = []  # id -> field
+        self._series_ids = {}
+        self._series_by_name = {}
+        self._series_read = 0
+        # Reader caches
+        self._partitions = {}
+        self._wal = {}  # file name -> [bytes read, record arrays]
+        # Writer state, set up by the first write
+        self._writer = None
+        self._segments = {}  # segment number -> (fd, opened at)
+        self._segment = None
+        self._head = []
+        self._head_counts = {}
+        self._head_started = {}  # series id -> (arrival time, segment) of its oldest pending point
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def _partition_length(self, requested):
+        meta_path = os.path.join(self.path, 'store.json')
+        try:
+            with open(meta_path) as f:
+                length = json.load(f)['partition_ns']
+            if length != requested:
+                print(f"Local store {self.path} keeps its partition length of {length // 1000000000}s")
+            return length
+        except FileNotFoundError:
+            with self._exclusive(meta_path + '.lock'):
+                if not os.path.exists(meta_path):
+                    with open(meta_path + '.tmp', 'w') as f:
+                        json.dump({'partition_ns': requested}, f)
+                    os.replace(meta_path + '.tmp', meta_path)
+            return self._partition_length(requested)
+
+    @contextlib.contextmanager
+    def _exclusive(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def _store_lock(self):
+        """Hold the store's file lock, serializing chunk and series appends across processes"""
+        with self._lock:
+            # A forked child must not share its parent's open lock file, which would share the lock too
+            if self._lock_fd is None or self._lock_pid != os.getpid():
+                self._lock_fd = os.open(os.path.join(self.path, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+                self._lock_pid = os.getpid()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # Series index
+
+    def _load_series(self):
+        """Read the series other processes appended to series.log"""
+        with self._lock:
+            try:
+                with open(os.path.join(self.path, 'series.log'), 'rb') as f:
+                    f.seek(self._series_read)
+                    data = f.read()
+            except FileNotFoundError:
+                return
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                # Stores written before fields were kept hold only values
+                series_id, name, tags, source, field = (json.loads(line) + ['value'])[:5]
+                self._add_series(series_id, name, tags, source, field)
+            self._series_read += end
+
+    def _add_series(self, series_id, name, tags, source, field):
+        if series_id != len(self._series):
+            raise ValueError(f'Corrupt series log: expected series {len(self._series)}, found {series_id}')
+        columns = dict(tags)
+        columns['name'] = name
+        if source:
+            columns['source'] = source
+        self._series.append((name, columns))
+        self._series_fields.append(field)
+        self._series_ids[(name, tuple(sorted(tags.items())), source or None, field)] = series_id
+        self._series_by_name.setdefault(name, []).append(series_id)
+
+    def _series_for(self, entries):
+        """Series id of each (metric, field), adding new series to series.log"""
+        # Empty tags are left out, as in line protocol
+        keys = [
+            (metric.name, tuple(sorted((key, value) for key, value in (metric.tags or {}).items() if key and value)),
+             metric.source or None, field)
+            for metric, field in entries
+        ]
+        ids = self._series_ids
+        if any(key not in ids for key in keys):
+            with self._store_lock():
+                self._load_series()
+                lines = []
+                for key in keys:
+                    if key not in ids:
+                        name, tags, source, field = key
+                        series_id = len(self._series)
+                        self._add_series(series_id, name, dict(tags), source, field)
+                        lines.append(json.dumps([series_id, name, dict(tags), source, field]) + '\n')
+                with open(os.path.join(self.path, 'series.log'), 'ab') as f:
+                    f.write(''.join(lines).encode('utf-8'))
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+                self._series_read = os.path.getsize(os.path.join(self.path, 'series.log'))
+        return [ids[key] for key in keys]
+
+    # Writing
+
+    def encode_point(self, metric):
+        """Points are stored as Metric records"""
+        return metric
+
+    def write_batch(self, metrics):
+        """Append Metrics to this process's write-ahead log; returns False if they could not be stored"""
+        if not metrics:
+            return True
+        try:
+            entries = []
+            for metric in metrics:
+                if metric.fields:
+                    entries.extend(point_fields(metric))
+                else:
+                    entries.append((metric, 'value', metric.value))
+            with self._lock:
+                records = np.empty(len(entries), dtype=WAL_RECORD)
+                records['series'] = self._series_for([(metric, field) for metric, field, _ in entries])
+                records['time'] = [metric.timestamp for metric, _, _ in entries]
+                records['value'] = [value for _, _, value in entries]
+                self._append_wal(records)
+                self._add_to_head(records)
+            self._start_flusher()
+            return True
+        except (OSError, ValueError) as e:
+            print(f"Error writing to local store: {e}")
+            return False
+
+    def _open_segment(self):
+        if self._writer is None:
+            self._writer = uuid.uuid4().hex[:12]
+        number = self._segment + 1 if self._segment is not None else 0
+        path = os.path.join(self.path, 'wal', f'{self._writer}.{number}')
+        # Locked under a temporary name, so a recovering writer never takes a live segment for an orphan
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(path + '.tmp', path + '.wal')
+        self._segments[number] = (fd, time.monotonic())
+        self._segment = number
+
+    def _append_wal(self, records):
+        if self._segment is None:
+            self._open_segment()
+        fd = self._segments[self._segment][0]
+        os.write(fd, records.tobytes())
+        if self.fsync:
+            os.fsync(fd)
+
+    def _add_to_head(self, records):
+        self._head.append(records)
+        now = time.monotonic()
+        full = []
+        series, counts = np.unique(records['series'], return_counts=True)
+        for series_id, count in zip(series.tolist(), counts.tolist()):
+            total = self._head_counts.get(series_id, 0) + count
+            self._head_counts[series_id] = total
+            self._head_started.setdefault(series_id, (now, self._segment))
+            if total >= self.chunk_points:
+                full.append(series_id)
+        if full:
+            self._cut(full)
+
+    def _cut(self, series_ids):
+        """Move the head points of these series into chunks"""
+        head = np.concatenate(self._head) if len(self._head) > 1 else self._head[0]
+        selected = np.isin(head['series'], np.array(series_ids, dtype=np.uint32))
+        self._write_chunks(head[selected])
+        self._head = [head[~selected]] if not selected.all() else []
+        for series_id in series_ids:
+            self._head_counts.pop(series_id, None)
+            self._head_started.pop(series_id, None)
+
+    def _write_chunks(self, records):
+        """Encode points as one chunk per series and partition, at most chunk_points each, and append them"""
+        if not len(records):
+            return
+        series, times, values = deduplicate(records['series'], records['time'], records['value'])
+        partitions = times // self.partition
+        starts = np.flatnonzero(np.concatenate((
+            [True], (series[1:] != series[:-1]) | (partitions[1:] != partitions[:-1])
+        )))
+        ends = np.append(starts[1:], len(series))
+        expired = nanoseconds(datetime.now(timezone.utc)) - self.retention if self.retention else None
+        chunks = {}
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            partition = int(partitions[start]) * self.partition
+            if expired is not None and partition + self.partition <= expired:
+                continue
+            for first in range(start, end, self.chunk_points):
+                last = min(first + self.chunk_points, end)
+                chunks.setdefault(partition, []).append((
+                    int(series[first]), int(times[first]), int(times[last - 1]), last - first,
+                    encode_chunk(times[first:last], values[first:last]),
+                ))
+        with self._store_lock():
+            for partition, partition_chunks in chunks.items():
+                self._append_chunks(partition, partition_chunks)
+
+    def _append_chunks(self, partition, chunks):
+        directory = os.path.join(self.path, str(partition))
+        os.makedirs(directory, exist_ok=True)
+        index = np.empty(len(chunks), dtype=INDEX_RECORD)
+        with open(os.path.join(directory, 'chunks.dat'), 'ab') as f:
+            offset = os.fstat(f.fileno()).st_size
+            for position, (series_id, min_time, max_time, count, data) in enumerate(chunks):
+                index[position] = (series_id, min_time, max_time, offset, len(data), count)
+                offset += len(data)
+            f.write(b''.join(chunk[4] for chunk in chunks))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        with open(os.path.join(directory, 'chunks.idx'), 'ab') as f:
+            f.write(index.tobytes())
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is None and not self._stop.is_set():
+                self._flusher = threading.Thread(target=self._run, name='local-store-flusher', daemon=True)
+                self._flusher.start()
+
+    def _run(self):
+        interval = max(min(self.head_seconds / 4, 15.0), 0.05)
+        while not self._stop.wait(interval):
+            try:
+                self.maintain()
+            except (OSError, ValueError) as e:
+                print(f"Error maintaining local store: {e}")
+
+    def maintain(self):
+        """Cut heads that are too old, retire log segments, expire partitions and recover orphaned logs"""
+        with self._lock:
+            now = time.monotonic()
+            aged = [
+                series_id for series_id, (arrived, _) in self._head_started.items()
+                if now - arrived >= self.head_seconds
+            ]
+            if aged:
+                self._cut(aged)
+            if self._segment is not None:
+                fd, opened = self._segments[self._segment]
+                if now - opened >= self.head_seconds / 2 or os.fstat(fd).st_size >= WAL_SEGMENT_BYTES:
+                    self._open_segment()
+                self._retire_segments()
+        self._expire()
+        self._recover()
+
+    def _retire_segments(self):
+        """Delete this writer's log segments whose points are all in chunks"""
+        oldest = min((segment for _, segment in self._head_started.values()), default=self._segment)
+        for number in sorted(self._segments):
+            if number >= oldest or number == self._segment:
+                break
+            fd, _ = self._segments.pop(number)
+            os.unlink(os.path.join(self.path, 'wal', f'{self._writer}.{number}.wal'))
+            os.close(fd)
+
+    def _expire(self):
+        if not self.retention:
+            return
+        expired = nanoseconds(datetime.now(timezone.utc)) - self.retention
+        with self._store_lock():
+            for partition in self._partition_starts():
+                if partition + self.partition <= expired:
+                    shutil.rmtree(os.path.join(self.path, str(partition)), ignore_errors=True)
+
+    def _recover(self):
+        """Cut the logs of writers that died into chunks"""
+        directory = os.path.join(self.path, 'wal')
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith('.wal') or file_name.startswith(f'{self._writer}.'):
+                continue
+            try:
+                fd = os.open(os.path.join(directory, file_name), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if not os.path.exists(os.path.join(directory, file_name)):
+                    continue
+                with open(fd, 'rb', closefd=False) as f:
+                    data = f.read()
+                whole = len(data) - len(data) % WAL_RECORD.itemsize
+                self._load_series()
+                with self._lock:
+                    self._write_chunks(np.frombuffer(data[:whole], dtype=WAL_RECORD))
+                os.unlink(os.path.join(directory, file_name))
+                print(f"Recovered {whole // WAL_RECORD.itemsize} points from {file_name}")
+            finally:
+                os.close(fd)
+
+    def close(self):
+        """Cut every head into chunks and delete this writer's logs"""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=10)
+        with self._lock:
+            if self._head_started:
+                self._cut(list(self._head_started))
+            for number, (fd, _) in sorted(self._segments.items()):
+                os.unlink(os.path.join(self.path, 'wal', f'{self._writer}.{number}.wal'))
+                os.close(fd)
+            self._segments = {}
+            self._segment = None
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    # Reading
+
+    def _partition_starts(self):
+        return sorted(int(name) for name in os.listdir(self.path) if name.isdigit())
+
+    def _partition_snapshots(self, start, stop):
+        """(index, data) of every partition that may hold points in [start, stop)"""
+        snapshots = []
+        for partition in self._partition_starts():
+            if partition + self.partition <= start or partition >= stop:
+                continue
+            with self._lock:
+                cached = self._partitions.get(partition)
+                if cached is None:
+                    cached = self._partitions[partition] = Partition(os.path.join(self.path, str(partition)))
+                try:
+                    index, data = cached.refresh()
+                except (FileNotFoundError, ValueError):
+                    # Expired, or created but not yet written to
+                    self._partitions.pop(partition, None)
+                    continue
+            if len(index):
+                snapshots.append((index, data))
+        return snapshots
+
+    def _wal_snapshot(self):
+        """Every writer's logged points, in the order they were written"""
+        directory = os.path.join(self.path, 'wal')
+        names = [name for name in sorted(os.listdir(directory)) if name.endswith('.wal')]
+        with self._lock:
+            for name in list(self._wal):
+                if name not in names:
+                    del self._wal[name]
+            for name in names:
+                cached = self._wal.setdefault(name, [0, []])
+                try:
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        f.seek(cached[0])
+                        data = f.read()
+                except FileNotFoundError:
+                    del self._wal[name]
+                    continue
+                whole = len(data) - len(data) % WAL_RECORD.itemsize
+                if whole:
+                    cached[1].append(np.frombuffer(data[:whole], dtype=WAL_RECORD))
+                    cached[0] += whole
+                    if len(cached[1]) > 16:
+                        cached[1] = [np.concatenate(cached[1])]
+            arrays = [array for _, chunks in self._wal.values() for array in chunks]
+        return np.concatenate(arrays) if arrays else np.empty(0, dtype=WAL_RECORD)
+
+    def _scan(self, series_ids, start, stop):
+        """(series, time, value) arrays of the points of these series in [start, stop), sorted and deduplicated
+
+        Chunks are decoded in (series, first time) order, so the points only
+        need sorting when chunks of a series overlap or some are still in a
+        log. Then points with the same series and time are ranked by when
+        they were written: chunks in the order they were appended, and logged
+        points after all chunks.
+        """
+        wanted = np.array(sorted(series_ids), dtype=np.uint32)
+        with telemetry.timer('scan_seconds'):
+            hits = []
+            for index, data in self._partition_snapshots(start, stop):
+                found = index[
+                    np.isin(index['series'], wanted) & (index['max_time'] >= start) & (index['min_time'] < stop)
+                ]
+                hits += [(int(chunk['series']), int(chunk['min_time']), len(hits) + rank, data, int(chunk['offset']))
+                         for rank, chunk in enumerate(found)]
+            hits.sort()
+            parts = []
+            for series_id, _, _, data, offset in hits:
+                times, values = decode_chunk(data, offset)
+                parts.append((np.full(len(times), series_id, dtype=np.uint32), times, values))
+            wal = self._wal_snapshot()
+            wal = wal[np.isin(wal['series'], wanted)]
+            parts.append((wal['series'], wal['time'], wal['value']))
+            series = np.concatenate([part[0] for part in parts])
+            times = np.concatenate([part[1] for part in parts])
+            values = np.concatenate([part[2] for part in parts])
+            selected = (times >= start) & (times < stop)
+            ordered = not len(wal) and bool(np.all(
+                (series[1:] > series[:-1]) | ((series[1:] == series[:-1]) & (times[1:] > times[:-1]))
+            ))
+            if ordered:
+                return series[selected], times[selected], values[selected]
+            ranks = np.repeat(
+                np.array([hit[2] for hit in hits] + [len(hits)], dtype=np.int64), [len(part[1]) for part in parts]
+            )
+            return deduplicate(series[selected], times[selected], values[selected], ranks[selected])
+
+    def _select(self, name=None, source=None, matchers=(), fields=None):
+        """Ids of the series with one of the names (all if none) that pass the source, tag and field filters"""
+        self._load_series()
+        names = [name] if isinstance(name, str) else list(name or [])
+        with self._lock:
+            if names:
+                candidates = [series_id for value in names for series_id in self._series_by_name.get(value, ())]
+            else:
+                candidates = range(len(self._series))
+            selected = []
+            for series_id in candidates:
+                columns = self._series[series_id][1]
+                if source and columns.get('source') != source:
+                    continue
+                if fields and self._series_fields[series_id] not in fields:
+                    continue
+                if all(match(columns) for match in matchers):
+                    selected.append(series_id)
+        return selected
+
+    def _range(self, start_time, end_time, default_start):
+        now = datetime.now(timezone.utc)
+        return (nanoseconds(parse_time(start_time or default_start, now)),
+                nanoseconds(parse_time(end_time, now)))
+
+    def iter_metrics(self, name=None, source=None, start_time=None, end_time=None, limit=1000,
+                     iso_timestamps=True):
+        """Stream raw metrics as (name, value, timestamp, tags, source) tuples, like InfluxDB.iter_metrics
+
+        As the Flux query does, each series contributes its first ``limit``
+        points in the range, newest first. The points are read before this
+        returns, so errors are raised here rather than while iterating.
+        """
+        start, stop = self._range(start_time, end_time, '-24h')
+        selected = self._select(name, source=source, fields=('value', AGGREGATE_VALUE_FIELD))
+        series, times, values = self._scan(selected, start, stop)
+        firsts = np.flatnonzero(np.concatenate(([True], series[1:] != series[:-1]))) if len(series) else []
+        runs = sorted(
+            zip(np.asarray(firsts).tolist(), np.append(firsts[1:], len(series)).tolist()),
+            key=lambda run: self._sort_key(int(series[run[0]]))
+        )
+        return self._rows(series, times, values, runs, limit, iso_timestamps)
+
+    def _rows(self, series, times, values, runs, limit, iso_timestamps):
+        for first, end in runs:
+            name, columns = self._series[int(series[first])]
+            source = columns.get('source', '')
+            segment = slice(min(end, first + limit) - 1, first - 1 if first else None, -1)
+            if iso_timestamps:
+                texts = iso_times(times[segment])
+            else:
+                texts = np.datetime_as_string(times[segment].astype('datetime64[ns]')).tolist()
+            for value, text in zip(values[segment].tolist(), texts):
+                yield name, value, text, columns, source
+
+    def _sort_key(self, series_id):
+        name, columns = self._series[series_id]
+        return name, sorted(columns.items())
+
+    def query_metrics(self, name=None, source=None, start_time=None, end_time=None, limit=1000):
+        """Query raw metrics as dicts"""
+        try:
+            return [
+                {'name': name, 'value': value, 'timestamp': timestamp, 'tags': tags, 'source': source}
+                for name, value, timestamp, tags, source in self.iter_metrics(
+                    name=name, source=source, start_time=start_time, end_time=end_time, limit=limit
+                )
+            ]
+        except Exception as e:
+            print(f"Error querying local store: {e}")
+            return []
+
+    def fetch_aggregated_metrics(self, name=None, window='1h', aggregate_fn='mean', tags=None,
+                                 start_time=None, end_time=None, group_by=None):
+        """Aggregate raw points into time window buckets, with the same rows as InfluxDB's
+
+        Pre-aggregated points are merged with raw ones as InfluxDB merges
+        them: through their rollup fields for the aggregates rollups serve,
+        their sum for rate and their mean for percentiles.
+        """
+        columns = group_columns(group_by)
+        window_ns = duration_ns(window)
+        matchers = [tag_matcher(key, expressions) for key, expressions in (tags or {}).items()]
+        start, stop = self._range(start_time, end_time, default_range(window))
+        fn, _ = aggregate_spec(aggregate_fn)
+
+        # One group per (name, group_by tag values)
+        groups = {}
+
+        def scan(fields):
+            series, times, values = self._scan(self._select(name, matchers=matchers, fields=fields), start, stop)
+            codes = np.zeros(int(series.max()) + 1 if len(series) else 0, dtype=np.int64)
+            for series_id in np.unique(series).tolist():
+                series_columns = self._series[series_id][1]
+                key = tuple(series_columns.get(column) or None for column in columns)
+                codes[series_id] = groups.setdefault(key, len(groups))
+            return codes[series], times, values
+
+        def bucket_time(bucket):
+            return (EPOCH + timedelta(microseconds=bucket // 1000)).isoformat()
+
+        if fn in ROLLUP_AGGREGATES and self._select(name, matchers=matchers, fields=('count',)):
+            cells = self._merged_cells(scan, window_ns, ROLLUP_AGGREGATES[fn])
+            keys = [dict(zip(columns, key)) for key in groups]
+            rows = []
+            for (code, bucket), row in cells:
+                value = rollup_value(fn, row)
+                if value is not None:
+                    rows.append(aggregated_row(keys[code], name, group_by, bucket_time(bucket), value, row['count']))
+            return rows
+
+        if fn == 'rate':
+            fields = ('value', 'sum')
+        elif fn == 'quantile':
+            fields = ('value', AGGREGATE_VALUE_FIELD)
+        else:
+            fields = ('value',)
+        codes, times, values = scan(fields)
+        keys = [dict(zip(columns, key)) for key in groups]
+        with telemetry.timer('engine_seconds'):
+            codes, buckets, results, counts = aggregate(times, values, window_ns, aggregate_fn, groups=codes)
+        return [
+            aggregated_row(keys[code], name, group_by, bucket_time(bucket), value, count)
+            for code, bucket, value, count in zip(codes.tolist(), buckets.tolist(), results.tolist(), counts.tolist())
+        ]
+
+    def _merged_cells(self, scan, window_ns, fields):
+        """((group, bucket), {field: merged value}) per cell, merging raw values with pre-aggregated fields
+
+        A raw value counts as a rollup of one point (1 to count, its square
+        to sumsq, itself to the rest), as in flux_queries.merged_field_streams.
+        """
+        raw_codes, raw_times, raw_values = scan(('value',))
+        merged = {}
+        with telemetry.timer('engine_seconds'):
+            for field in fields:
+                codes, times, values = scan((field,))
+                if field == 'count':
+                    contribution = np.ones(len(raw_values))
+                elif field == 'sumsq':
+                    contribution = raw_values * raw_values
+                else:
+                    contribution = raw_values
+                codes, buckets, results, _ = aggregate(
+                    np.concatenate((raw_times, times)), np.concatenate((contribution, values)), window_ns,
+                    ROLLUP_FIELDS[field], groups=np.concatenate((raw_codes, codes))
+                )
+                merged[field] = dict(zip(zip(codes.tolist(), buckets.tolist()), results.tolist()))
+        cells = []
+        for cell in merged['count']:
+            row = {field: values.get(cell) for field, values in merged.items()}
+            if None not in row.values():
+                cells.append((cell, row))
+        return cells
+
+    def query_aggregated_metrics(self, name=None, window='1h', aggregate_fn='mean', tags=None,
+                                 start_time=None, end_time=None, group_by=None):
+        """Like fetch_aggregated_metrics, but errors other than invalid parameters return []"""
+        try:
+            return self.fetch_aggregated_metrics(
+                name=name, window=window, aggregate_fn=aggregate_fn, tags=tags,
+                start_time=start_time, end_time=end_time, group_by=group_by
+            )
+        except ValueError:
+            raise
+        except Exception as e:
+            print(f"Error querying aggregated metrics: {e}")
+            return []
+
+    def raw_span(self, window, aggregate_fn='mean', start_time=None, end_time=None):
+        """How much time of raw points an aggregate query would scan, as a timedelta"""
+        now = datetime.now(timezone.utc)
+        return parse_time(end_time, now) - parse_time(start_time or default_range(window), now)
+
+    def _recent_series(self, name=None, start='-30d'):
+        """Series with points since start"""
+        since = nanoseconds(parse_time(start, datetime.now(timezone.utc)))
+        recent = set()
+        for index, _ in self._partition_snapshots(since, np.iinfo(np.int64).max):
+            recent.update(np.unique(index['series'][index['max_time'] >= since]).tolist())
+        wal = self._wal_snapshot()
+        recent.update(np.unique(wal['series'][wal['time'] >= since]).tolist())
+        return [series_id for series_id in self._select(name) if series_id in recent]
+
+    def get_metric_names(self):
+        """Get list of all unique metric names"""
+        try:
+            return self.get_tag_values('name')
+        except Exception as e:
+            print(f"Error getting metric names: {e}")
+            return []
+
+    def get_tag_values(self, tag, name=None, start='-30d'):
+        """Distinct values of a tag, optionally for one metric, over the series with points since start"""
+        values = {self._series[series_id][1].get(tag) for series_id in self._recent_series(name, start)}
+        return sorted(value for value in values if value)
+
+    def get_tag_keys(self, name, start='-30d'):
+        """Tag keys used by one metric, including name and source"""
+        keys = set()
+        for series_id in self._recent_series(name, start):
+            keys.update(self._series[series_id][1])
+        return sorted(keys)
+
+    def ping(self):
+        os.stat(self.path)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'series': len(self._series),
+                'head_points': sum(self._head_counts.values()),
+                'wal_segments': len(self._segments),
+                'partitions': len(self._partitions),
+            }
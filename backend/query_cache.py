@@ -0,0 +1,181 @@
+"""Cache of aggregate query results that only re-queries the open trailing buckets"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+
+from flux_queries import parse_duration, default_range
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def align(moment, window):
+    """Floor a datetime to the start of its epoch-aligned window, as aggregateWindow does"""
+    return moment - (moment - EPOCH) % window
+
+
+def range_start(window, now):
+    """Start of the first bucket in the default look-back range of window"""
+    every = parse_duration(window)
+    look_back = parse_duration(default_range(window).lstrip('-'))
+    return align(now - look_back, every)
+
+
+def closed_before(window, now, grace):
+    """Boundary before which every bucket has ended at least grace ago"""
+    return align(now - grace, parse_duration(window))
+
+
+def flux_time(moment):
+    """Format a datetime as a Flux time literal"""
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def row_size(row):
+    """Rough memory footprint of one cached row"""
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+
+
+class CacheEntry:
+    """Closed buckets of one query, plus the last result for the still-open buckets"""
+
+    __slots__ = ('closed', 'closed_until', 'tail', 'tail_fetched', 'size')
+
+    def __init__(self, closed_until):
+        self.closed = []  # (bucket start, row), oldest first
+        self.closed_until = closed_until  # buckets starting before this are final
+        self.tail = []
+        self.tail_fetched = None
+        self.size = 0
+
+
+class AggregateCache:
+    """LRU cache in front of InfluxDB.fetch_aggregated_metrics
+
+    Entries are keyed on (name, window, aggregate, tags, group_by). A
+    bucket is closed once its window ended more than ``grace`` seconds ago,
+    leaving time for late points to land. Closed buckets are kept until they fall out of the
+    look-back range. Only the buckets after the last closed one are
+    re-queried, and at most once every ``tail_ttl`` seconds. Concurrent
+    misses for the same key share one query. Least recently used entries are
+    evicted once the cache holds more than ``max_bytes``.
+    """
+
+    def __init__(self, influxdb, max_bytes=64 * 1024 ** 2, grace=30.0, tail_ttl=5.0):
+        self.influxdb = influxdb
+        self.max_bytes = max_bytes
+        self.grace = timedelta(seconds=grace)
+        self.tail_ttl = tail_ttl
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'refreshes': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    def key(self, name=None, window='1h', aggregate_fn='mean', tags=None, group_by=None):
+        return (
+            name if isinstance(name, str) or name is None else tuple(name),
+            window,
+            aggregate_fn,
+            tuple(sorted((key, value if isinstance(value, str) else tuple(value)) for key, value in (tags or {}).items())),
+            tuple(group_by or ()),
+        )
+
+    def next_start(self, name=None, window='1h', aggregate_fn='mean', tags=None, group_by=None):
+        """Where the next query() for these parameters would start reading, or None if it is served from memory"""
+        now = datetime.now(timezone.utc)
+        start = range_start(window, now)
+        with self._lock:
+            entry = self._entries.get(self.key(name, window, aggregate_fn, tags, group_by))
+            if entry is None:
+                return start
+            if time.monotonic() - entry.tail_fetched < self.tail_ttl:
+                return None
+            return max(entry.closed_until, start)
+
+    def query(self, name=None, window='1h', aggregate_fn='mean', tags=None, group_by=None):
+        """Return the same rows as influxdb.query_aggregated_metrics"""
+        key = self.key(name, window, aggregate_fn, tags, group_by)
+        now = datetime.now(timezone.utc)
+        start = range_start(window, now)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if time.monotonic() - entry.tail_fetched < self.tail_ttl:
+                    self._stats['hits'] += 1
+                    return self._rows(entry, start)
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = Future()
+            else:
+                self._stats['coalesced'] += 1
+
+        if not owner:
+            return pending.result()
+        try:
+            rows = self._refresh(key, entry, name, window, aggregate_fn, tags, group_by, now, start)
+            pending.set_result(rows)
+            return rows
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+    def _refresh(self, key, entry, name, window, aggregate_fn, tags, group_by, now, start):
+        """Query the open buckets and fold the newly closed ones into the entry"""
+        query_start = start if entry is None else max(entry.closed_until, start)
+        tail = self.influxdb.fetch_aggregated_metrics(
+            name=name, window=window, aggregate_fn=aggregate_fn, tags=tags, start_time=flux_time(query_start),
+            group_by=group_by
+        )
+        closed_until = max(closed_before(window, now, self.grace), query_start)
+
+        with self._lock:
+            self._stats['misses' if entry is None else 'refreshes'] += 1
+            if entry is None:
+                entry = CacheEntry(closed_until)
+            else:
+                # The entry may have been evicted while the query ran
+                self._size -= entry.size if self._entries.get(key) is entry else 0
+            entry.tail = []
+            for row in tail:
+                bucket_start = datetime.fromisoformat(row['time_bucket'])
+                if bucket_start < closed_until:
+                    entry.closed.append((bucket_start, row))
+                else:
+                    entry.tail.append(row)
+            entry.closed_until = closed_until
+            entry.tail_fetched = time.monotonic()
+            rows = self._rows(entry, start)
+            entry.size = sum(row_size(row) for row in rows)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._size += entry.size
+            self._evict()
+            return rows
+
+    def _rows(self, entry, start):
+        """Drop closed buckets that left the look-back range and return all rows"""
+        expired = 0
+        while expired < len(entry.closed) and entry.closed[expired][0] < start:
+            expired += 1
+        if expired:
+            del entry.closed[:expired]
+        return [row for _, row in entry.closed] + entry.tail
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+            self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._size)
@@ -0,0 +1,126 @@
+"""Bounded execution of InfluxDB queries with deadlines and admission control"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from telemetry import telemetry
+
+
+class QueryTimeout(Exception):
+    """A query did not finish before its deadline"""
+
+
+class QueryRejected(Exception):
+    """Admission control turned an expensive query away because all heavy slots stayed busy"""
+
+
+class QueryExecutor:
+    """Runs queries on a bounded thread pool instead of the request threads
+
+    At most ``max_workers`` queries are in flight against InfluxDB. Queries
+    marked heavy (long raw-point scans) also need one of ``heavy_slots``
+    permits, so a burst of expensive aggregations occupies at most that many
+    workers and cheap queries always find one free. A heavy query that waits
+    more than ``queue_timeout`` seconds for a permit is rejected rather than
+    queued behind the others.
+
+    Callers wait at most ``timeout`` seconds. A query that has not started by
+    then is cancelled. A running one is abandoned. The InfluxDB client's read
+    timeout matches the deadline, so its connection is closed soon after,
+    which makes InfluxDB cancel the query.
+    """
+
+    def __init__(self, max_workers=16, heavy_slots=4, timeout=30.0, queue_timeout=10.0):
+        self.max_workers = max_workers
+        self.heavy_slots = heavy_slots
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='query')
+        self._heavy = threading.BoundedSemaphore(heavy_slots)
+        self._lock = threading.Lock()
+        self._running = {'light': 0, 'heavy': 0}
+        self._stats = {'completed': 0, 'failed': 0, 'timeouts': 0, 'rejected': 0, 'heavy': 0}
+
+    def submit(self, fn, *args, heavy=False, **kwargs):
+        """Schedule fn(*args, **kwargs); raises QueryRejected when no heavy slot frees up in time"""
+        if heavy:
+            if not self._heavy.acquire(timeout=self.queue_timeout):
+                with self._lock:
+                    self._stats['rejected'] += 1
+                raise QueryRejected(f'Too many expensive queries running, retry in {self.queue_timeout:g}s')
+        try:
+            return self._pool.submit(self._call, fn, args, kwargs, heavy, time.perf_counter())
+        except Exception:
+            if heavy:
+                self._heavy.release()
+            raise
+
+    def _call(self, fn, args, kwargs, heavy, submitted):
+        telemetry.observe('executor_wait_seconds', time.perf_counter() - submitted)
+        kind = 'heavy' if heavy else 'light'
+        with self._lock:
+            self._running[kind] += 1
+        try:
+            result = fn(*args, **kwargs)
+            with self._lock:
+                self._stats['completed'] += 1
+            return result
+        except Exception:
+            with self._lock:
+                self._stats['failed'] += 1
+            raise
+        finally:
+            with self._lock:
+                self._running[kind] -= 1
+                self._stats['heavy'] += heavy
+            if heavy:
+                self._heavy.release()
+
+    def result(self, future, deadline=None):
+        """Wait for a submitted query until deadline (a time.monotonic() value) or the default timeout"""
+        timeout = self.timeout if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise QueryTimeout(f'Query did not finish within {self.timeout:g}s')
+
+    def run(self, fn, *args, heavy=False, **kwargs):
+        """Run fn on the pool and wait for its result"""
+        return self.result(self.submit(fn, *args, heavy=heavy, **kwargs))
+
+    def run_all(self, calls):
+        """Run independent (fn, heavy) calls in parallel under one deadline
+
+        Returns one result per call, or the exception it raised (including
+        QueryRejected and QueryTimeout), in order.
+        """
+        deadline = time.monotonic() + self.timeout
+        futures = []
+        for fn, heavy in calls:
+            try:
+                futures.append(self.submit(fn, heavy=heavy))
+            except QueryRejected as e:
+                futures.append(e)
+        results = []
+        for future in futures:
+            if isinstance(future, Exception):
+                results.append(future)
+                continue
+            try:
+                results.append(self.result(future, deadline))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._stats,
+                running=self._running['light'] + self._running['heavy'],
+                running_heavy=self._running['heavy'],
+                max_workers=self.max_workers,
+                heavy_slots=self.heavy_slots,
+            )
@@ -0,0 +1,260 @@
+"""Rollup tiers: continuous downsampling of raw metrics, and routing of aggregate queries to them"""
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from influxdb_client import BucketRetentionRules, TaskCreateRequest
+from influxdb_client.domain.task_update_request import TaskUpdateRequest
+
+from flux_queries import (
+    parse_duration, format_duration, default_range, aggregate_expression, build_downsample_query,
+    flux_string, ROLLUP_AGGREGATES,
+)
+from query_cache import align, flux_time
+
+# How long after its scheduled time a tier's task is assumed to have finished
+TASK_MARGIN = timedelta(minutes=1)
+
+
+def parse_time(value, now):
+    """Resolve a Flux time literal (RFC 3339, a negative duration or now()) to a datetime"""
+    if value in (None, 'now()'):
+        return now
+    if value.startswith('-'):
+        return now - parse_duration(value[1:])
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def rollup_value(aggregate, row):
+    """Compute an aggregate from the merged rollup fields of one bucket"""
+    count = row['count']
+    if aggregate == 'mean':
+        return row['sum'] / count
+    if aggregate == 'count':
+        return count
+    if aggregate == 'spread':
+        return row['max'] - row['min']
+    if aggregate == 'stddev':
+        # Sample standard deviation, as Flux's stddev(); undefined for a single point
+        if count < 2:
+            return None
+        return math.sqrt(max(row['sumsq'] - row['sum'] ** 2 / count, 0.0) / (count - 1))
+    return row[aggregate]
+
+
+class Tier:
+    """One rollup tier: points merged into ``every`` windows and kept for ``retention``"""
+
+    def __init__(self, every, retention, bucket, offset, source=None):
+        self.name = every
+        self.every = parse_duration(every)
+        self.retention = parse_duration(retention)
+        self.bucket = bucket
+        self.offset = offset
+        self.source = source  # the finer Tier this one is merged from, None for raw points
+        self.coverage = None  # complete from this time on; None until known
+        self.queries = 0
+
+    def watermark(self, now):
+        """Windows starting before this have been rolled up by the tier's task"""
+        return align(now - self.offset - TASK_MARGIN, self.every)
+
+    def usable_from(self, now):
+        if self.coverage is None:
+            return None
+        # InfluxDB may drop points as soon as they pass the retention period
+        return max(self.coverage, align(now - self.retention, self.every) + self.every)
+
+
+def parse_tiers(spec, raw_bucket, grace=30.0):
+    """Parse 'every:retention,...' (e.g. '1m:14d,1h:180d,1d:1825d') into tiers, finest first
+
+    Each tier is merged from the one before, so its window must be a multiple
+    of the previous one. Tasks are offset so a tier runs after the tier it
+    reads from has finished the same windows.
+    """
+    tiers = []
+    for index, item in enumerate(sorted(filter(None, (part.strip() for part in spec.split(','))),
+                                        key=lambda part: parse_duration(part.partition(':')[0]))):
+        every, _, retention = item.partition(':')
+        source = tiers[-1] if tiers else None
+        tier = Tier(every, retention or '30d', f'{raw_bucket}_{every}',
+                    offset=timedelta(seconds=grace) + index * TASK_MARGIN, source=source)
+        if source is not None and tier.every % source.every:
+            raise ValueError(f'Rollup tier {every} is not a multiple of {source.name}')
+        tiers.append(tier)
+    return tiers
+
+
+class RollupManager:
+    """Keeps the rollup tiers in InfluxDB and plans aggregate queries across them
+
+    ensure() creates a bucket per tier with the tier's retention and an
+    InfluxDB task that rolls up the last ``lookback_windows`` windows of the
+    tier below it (or of raw points) every window. The tasks run inside
+    InfluxDB, so tiers keep filling while the backend is down. Data written
+    before a tier existed is backfilled from raw points once, newest first,
+    and a tier is only queried back to where its data is complete.
+    """
+
+    def __init__(self, influxdb, tiers, backfill=timedelta(days=30), backfill_chunk=timedelta(days=1),
+                 lookback_windows=5):
+        self.influxdb = influxdb
+        self.tiers = tiers
+        self.backfill_range = backfill
+        self.backfill_chunk = backfill_chunk
+        self.lookback_windows = lookback_windows
+        self.raw_queries = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rollup-setup', daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.ensure()
+                for tier in self.tiers:
+                    if tier.coverage is None:
+                        tier.coverage = self.earliest(tier)
+                    self.backfill(tier)
+                print(f"Rollup tiers ready: {', '.join(tier.name for tier in self.tiers)}")
+                return
+            except Exception as e:
+                print(f"Error setting up rollup tiers, retrying: {e}")
+                time.sleep(30)
+
+    def task_name(self, tier):
+        return f'{tier.bucket} rollup'
+
+    def task_flux(self, tier):
+        """Flux of the task that keeps tier up to date"""
+        query = build_downsample_query(
+            tier.source.bucket if tier.source else self.influxdb.bucket, tier.bucket, tier.name,
+            start=f'-{format_duration(tier.every * self.lookback_windows)}', from_raw=tier.source is None,
+        )
+        return (f'option task = {{name: {flux_string(self.task_name(tier))}, '
+                f'every: {format_duration(tier.every)}, offset: {format_duration(tier.offset)}}}\n' + query)
+
+    def ensure(self):
+        """Create or update the bucket and downsampling task of every tier"""
+        buckets_api = self.influxdb.client.buckets_api()
+        tasks_api = self.influxdb.client.tasks_api()
+        for tier in self.tiers:
+            rules = BucketRetentionRules(type='expire', every_seconds=int(tier.retention.total_seconds()))
+            bucket = buckets_api.find_bucket_by_name(tier.bucket)
+            if bucket is None:
+                buckets_api.create_bucket(bucket_name=tier.bucket, retention_rules=rules, org=self.influxdb.org,
+                                          description=f'Theia {tier.name} rollups')
+            elif [rule.every_seconds for rule in bucket.retention_rules] != [rules.every_seconds]:
+                bucket.retention_rules = [rules]
+                buckets_api.update_bucket(bucket)
+
+            flux = self.task_flux(tier)
+            tasks = tasks_api.find_tasks(name=self.task_name(tier), org=self.influxdb.org)
+            if not tasks:
+                tasks_api.create_task(task_create_request=TaskCreateRequest(
+                    org=self.influxdb.org, flux=flux, status='active', description=f'Theia {tier.name} rollups'
+                ))
+            elif tasks[0].flux != flux or tasks[0].status != 'active':
+                tasks_api.update_task_request(tasks[0].id, TaskUpdateRequest(flux=flux, status='active'))
+
+    def earliest(self, tier):
+        """Time of the oldest rollup point in tier, or None if it is empty"""
+        query = f'''
+        from(bucket: {flux_string(tier.bucket)})
+          |> range(start: -{format_duration(tier.retention)})
+          |> filter(fn: (r) => r["_field"] == "count")
+          |> first()
+          |> group()
+          |> min(column: "_time")
+        '''
+        for table in self.influxdb.query_api.query(query, org=self.influxdb.org):
+            for record in table.records:
+                return record.get_time()
+        return None
+
+    def backfill(self, tier):
+        """Roll raw points up into tier, newest first, back to the backfill range"""
+        now = datetime.now(timezone.utc)
+        horizon = align(now - min(self.backfill_range, tier.retention), tier.every)
+        stop = min(tier.coverage or tier.watermark(now), tier.watermark(now))
+        chunk = max(self.backfill_chunk, tier.every)
+        while stop > horizon:
+            start = max(align(stop - chunk, tier.every), horizon)
+            query = build_downsample_query(self.influxdb.bucket, tier.bucket, tier.name,
+                                           start=flux_time(start), stop=flux_time(stop))
+            # Return a single count rather than every point written
+            self.influxdb.query_api.query(query + '  |> group()\n  |> count()\n', org=self.influxdb.org)
+            tier.coverage = stop = start
+
+    def plan(self, window, aggregate_fn='mean', start_time=None, end_time=None, record=True):
+        """Split an aggregate query into (tier or None for raw points, start, stop) segments
+
+        Each bucket is read from the coarsest tier that has rolled it up and
+        whose window divides the requested one. A partial first bucket and
+        the buckets after the tiers' watermarks are aggregated from raw points.
+        Percentiles cannot be merged from rollups, so they always read raw
+        points. With record=False the plan is not counted in stats().
+        """
+        raw = [(None, start_time, end_time)]
+        if aggregate_expression(aggregate_fn) not in ROLLUP_AGGREGATES:
+            return self._count(raw, record)
+        every = parse_duration(window)
+        now = datetime.now(timezone.utc)
+        try:
+            start = parse_time(start_time or default_range(window), now)
+            stop = parse_time(end_time, now)
+        except ValueError:
+            return self._count(raw, record)
+
+        segments = []
+        position = align(start, every)
+        if position < start:
+            position += every
+        for tier in reversed(self.tiers):
+            usable_from = tier.usable_from(now)
+            if every % tier.every or usable_from is None or position < usable_from:
+                continue
+            until = min(align(tier.watermark(now), every), stop)
+            if until > position:
+                segments.append((tier, flux_time(position), flux_time(until)))
+                position = until
+        if not segments:
+            return self._count(raw, record)
+        if parse_time(segments[0][1], now) > start:
+            segments.insert(0, (None, start_time, segments[0][1]))
+        if position < stop:
+            segments.append((None, flux_time(position), end_time))
+        return self._count(segments, record)
+
+    def _count(self, segments, record):
+        if not record:
+            return segments
+        with self._lock:
+            for tier, _, _ in segments:
+                if tier is None:
+                    self.raw_queries += 1
+                else:
+                    tier.queries += 1
+        return segments
+
+    def stats(self):
+        with self._lock:
+            return {
+                'raw_queries': self.raw_queries,
+                'tiers': [{
+                    'every': tier.name,
+                    'bucket': tier.bucket,
+                    'retention': format_duration(tier.retention),
+                    'complete_from': tier.coverage.isoformat() if tier.coverage else None,
+                    'queries': tier.queries,
+                } for tier in self.tiers],
+            }
@@ -0,0 +1,149 @@
+"""Redis index of metric names, tag keys and tag values, maintained on write"""
+import json
+import threading
+import time
+
+
+def prefix_range(prefix):
+    """ZRANGEBYLEX bounds matching every member that starts with prefix
+
+    All members are added with score 0, so each set is ordered by member and
+    a prefix search is a range lookup rather than a scan.
+    """
+    if not prefix:
+        return '-', '+'
+    # 0xff never occurs in UTF-8, so it sorts after every continuation of prefix
+    encoded = prefix.encode('utf-8')
+    return b'[' + encoded, b'[' + encoded + b'\xff'
+
+
+class SeriesIndex:
+    """Metric names, tag keys per metric and tag values per (metric, key) in Redis sorted sets
+
+    The worker calls record() after each successful write. It remembers what
+    it has already indexed, so Redis is only touched for new names, keys or
+    values. The backend reads the sets, and reconcile() periodically rebuilds
+    them from InfluxDB's schema functions to pick up data written before the
+    index existed and to drop series that aged out of retention.
+    """
+
+    def __init__(self, client, prefix='theia:index', seen_ttl=600.0, max_seen=1000000):
+        self.client = client
+        self.prefix = prefix
+        self.seen_ttl = seen_ttl
+        self.max_seen = max_seen
+        self._seen = set()
+        self._seen_since = time.monotonic()
+        self._lock = threading.Lock()
+
+    def names_key(self):
+        return f'{self.prefix}:names'
+
+    def tags_key(self, name):
+        return f'{self.prefix}:tags:{name}'
+
+    def values_key(self, name, key):
+        # JSON keeps names and tag keys containing ':' unambiguous
+        return f'{self.prefix}:values:{json.dumps([name, key])}'
+
+    def record(self, metrics):
+        """Index the names, tag keys and tag values of written metrics"""
+        entries = set()
+        for metric in metrics:
+            name = metric.name
+            entries.add((name, None, None))
+            tags = dict(metric.tags)
+            if metric.source:
+                tags['source'] = metric.source
+            for key, value in tags.items():
+                entries.add((name, key, str(value)))
+
+        with self._lock:
+            # Forget what was indexed now and then, so entries dropped by reconcile() come back
+            if time.monotonic() - self._seen_since > self.seen_ttl or len(self._seen) > self.max_seen:
+                self._seen = set()
+                self._seen_since = time.monotonic()
+            new_entries = entries - self._seen
+        if not new_entries:
+            return
+
+        with self.client.pipeline(transaction=False) as pipe:
+            for name, key, value in new_entries:
+                if key is None:
+                    pipe.zadd(self.names_key(), {name: 0})
+                else:
+                    pipe.zadd(self.tags_key(name), {key: 0})
+                    pipe.zadd(self.values_key(name, key), {value: 0})
+            pipe.execute()
+        with self._lock:
+            self._seen |= new_entries
+
+    def _search(self, key, prefix=None, limit=None):
+        low, high = prefix_range(prefix)
+        if limit:
+            members = self.client.zrangebylex(key, low, high, start=0, num=limit)
+        else:
+            members = self.client.zrangebylex(key, low, high)
+        return [member.decode('utf-8') for member in members]
+
+    def names(self, prefix=None, limit=None):
+        return self._search(self.names_key(), prefix, limit)
+
+    def tag_keys(self, name, prefix=None, limit=None):
+        return self._search(self.tags_key(name), prefix, limit)
+
+    def tag_values(self, name, key, prefix=None, limit=None):
+        return self._search(self.values_key(name, key), prefix, limit)
+
+    def is_empty(self):
+        return not self.client.exists(self.names_key())
+
+    def reconcile(self, influxdb):
+        """Rebuild the index from InfluxDB; returns the number of metric names indexed"""
+        names = influxdb.get_tag_values('name')
+        keys_to_write = {self.names_key(): names}
+        for name in names:
+            tag_keys = [key for key in influxdb.get_tag_keys(name) if key != 'name']
+            keys_to_write[self.tags_key(name)] = tag_keys
+            for key in tag_keys:
+                keys_to_write[self.values_key(name, key)] = influxdb.get_tag_values(key, name=name)
+
+        stale = set(self.client.scan_iter(match=f'{self.prefix}:*', count=1000)) - {
+            key.encode('utf-8') for key in keys_to_write
+        }
+        with self.client.pipeline(transaction=True) as pipe:
+            for key, members in keys_to_write.items():
+                pipe.delete(key)
+                if members:
+                    pipe.zadd(key, {member: 0 for member in members})
+            if stale:
+                pipe.delete(*stale)
+            pipe.execute()
+        return len(names)
+
+
+class IndexReconciler:
+    """Background thread running SeriesIndex.reconcile every interval seconds"""
+
+    def __init__(self, index, influxdb, interval=3600.0):
+        self.index = index
+        self.influxdb = influxdb
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='series-index-reconcile', daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                count = self.index.reconcile(self.influxdb)
+                print(f"Series index reconciled: {count} metric names")
+            except Exception as e:
+                print(f"Error reconciling series index: {e}")
+            time.sleep(self.interval)
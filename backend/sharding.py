@@ -0,0 +1,126 @@
+"""Assignment of ingest queue shards to the live workers"""
+import hashlib
+import threading
+
+import redis
+
+
+def shard_queue(queue, shard):
+    return f'{queue}.{shard}'
+
+
+def owners(shard, members, replicas=1):
+    """The members owning a shard, by rendezvous (highest random weight) hashing
+
+    Every worker computes the same owners from the same member list. When a
+    member joins or leaves, only the shards it gains or held change owner.
+    """
+    def weight(member):
+        return hashlib.blake2b(f'{shard}:{member}'.encode('utf-8'), digest_size=8).digest()
+
+    return sorted(members, key=weight, reverse=True)[:replicas]
+
+
+def live_members(client, prefix):
+    """Return (now, sorted members whose heartbeat has not expired)"""
+    # Redis time, so the workers' clocks need not agree
+    seconds, micros = client.time()
+    now = seconds + micros / 1e6
+    key = f'{prefix}:members'
+    with client.pipeline(transaction=False) as pipe:
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zrange(key, 0, -1)
+        members = pipe.execute()[1]
+    return now, sorted(member.decode() for member in members)
+
+
+def assignment(shards, members, replicas=1):
+    """Shard index -> owning members"""
+    return {shard: owners(shard, members, replicas) for shard in range(shards)}
+
+
+class ShardCoordinator:
+    """Keep this worker's set of consumed shard queues in step with the live workers
+
+    Each worker heartbeats into a Redis sorted set scored with its expiry
+    time, every ``heartbeat`` seconds. A worker that misses three heartbeats
+    drops out. On each heartbeat, the worker computes each shard's owners
+    from the live members and calls on_assign(shard) or on_revoke(shard)
+    for the shards it gained or lost. No lock or leader is needed.
+
+    While a shard moves, its old and new owner may both consume it for up to
+    one heartbeat. Tasks are acked late, so delivery stays at least once.
+    """
+
+    def __init__(self, client, member, shards, on_assign, on_revoke, replicas=1, prefix='theia:shards',
+                 heartbeat=5.0):
+        self.client = client
+        self.member = member
+        self.shards = shards
+        self.on_assign = on_assign
+        self.on_revoke = on_revoke
+        self.replicas = replicas
+        self.prefix = prefix
+        self.heartbeat = heartbeat
+        self.owned = set()
+        self.rebalances = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def members_key(self):
+        return f'{self.prefix}:members'
+
+    def tick(self):
+        """Heartbeat, then take on or give up shards to match the current members"""
+        now, members = live_members(self.client, self.prefix)
+        self.client.zadd(self.members_key(), {self.member: now + self.heartbeat * 3})
+        if self.member not in members:
+            members = sorted(members + [self.member])
+        wanted = {
+            shard for shard, shard_owners in assignment(self.shards, members, self.replicas).items()
+            if self.member in shard_owners
+        }
+        with self._lock:
+            added, removed = wanted - self.owned, self.owned - wanted
+            self.owned = wanted
+            if added or removed:
+                self.rebalances += 1
+        for shard in sorted(removed):
+            self.on_revoke(shard)
+        for shard in sorted(added):
+            self.on_assign(shard)
+        return added, removed
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='shard-coordinator', daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except redis.RedisError as e:
+                # Keep consuming the shards already owned; other workers take them over if this persists
+                print(f"Error updating shard membership: {e}")
+            self._stop.wait(self.heartbeat)
+
+    def stop(self):
+        """Leave the member set right away, so the other workers take over without waiting for expiry"""
+        self._stop.set()
+        try:
+            self.client.zrem(self.members_key(), self.member)
+        except redis.RedisError as e:
+            print(f"Error leaving shard membership: {e}")
+        with self._lock:
+            removed, self.owned = self.owned, set()
+        for shard in sorted(removed):
+            self.on_revoke(shard)
+
+    def stats(self):
+        with self._lock:
+            return {'owned': len(self.owned), 'rebalances': self.rebalances}
+
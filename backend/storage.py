@@ -0,0 +1,41 @@
+"""Choice of storage backend for the worker and the backend
+
+STORAGE_BACKEND picks where metrics are stored: 'influxdb' (the default) or
+'local', the embedded store in local_store. Both provide the same methods:
+
+  encode_point(metric)      a Metric in the form write_batch takes
+  write_batch(points)       store encoded points; returns False if they were not stored
+  iter_metrics(...)         raw points in a time range, as (name, value, timestamp, tags, source)
+  fetch_aggregated_metrics  points reduced into time buckets, per name and group_by tags
+  get_metric_names()        and get_tag_keys / get_tag_values for discovery
+  raw_span, ping, close     and the rollups attribute (None when aggregates read raw points only)
+
+With the local store, the worker and the backend must share LOCAL_STORE_PATH.
+"""
+import os
+
+from influxdb_service import InfluxDB
+from local_store import LocalStore
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'influxdb').lower()
+LOCAL_STORE_PATH = os.getenv('LOCAL_STORE_PATH', '/data/theia')
+# Length of the time partitions; fixed when the store is created
+LOCAL_STORE_PARTITION = os.getenv('LOCAL_STORE_PARTITION', '1d')
+# Partitions older than this are deleted ('' keeps everything)
+LOCAL_STORE_RETENTION = os.getenv('LOCAL_STORE_RETENTION', '')
+# A series' recent points are compressed into a chunk once it has this many, or after LOCAL_STORE_HEAD_SECONDS
+LOCAL_STORE_CHUNK_POINTS = int(os.getenv('LOCAL_STORE_CHUNK_POINTS', '1024'))
+LOCAL_STORE_HEAD_SECONDS = float(os.getenv('LOCAL_STORE_HEAD_SECONDS', '300'))
+LOCAL_STORE_FSYNC = os.getenv('LOCAL_STORE_FSYNC', 'false').lower() in ('1', 'true', 'yes')
+
+
+def open_storage(**influxdb_options):
+    """The configured storage backend; influxdb_options are passed to InfluxDB"""
+    if STORAGE_BACKEND == 'local':
+        return LocalStore(
+            LOCAL_STORE_PATH, partition=LOCAL_STORE_PARTITION, retention=LOCAL_STORE_RETENTION or None,
+            chunk_points=LOCAL_STORE_CHUNK_POINTS, head_seconds=LOCAL_STORE_HEAD_SECONDS, fsync=LOCAL_STORE_FSYNC,
+        )
+    if STORAGE_BACKEND != 'influxdb':
+        raise ValueError(f'Unknown STORAGE_BACKEND: {STORAGE_BACKEND}')
+    return InfluxDB(**influxdb_options)
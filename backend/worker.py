@@ -1,46 +1,333 @@
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown, worker_ready, worker_shutdown
 from datetime import datetime
+import json
 import os
+import socket
+import threading
+import time
+import redis
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from influxdb_service import InfluxDB
+from storage import open_storage
+from batch_writer import BatchWriter
+from series_index import SeriesIndex
+from cardinality import CardinalityGuard, parse_keys, parse_limits
+from metric_record import as_record
+from sharding import ShardCoordinator, shard_queue
+from telemetry import telemetry, Reporter
 
-influxdb = InfluxDB()
+telemetry.service = 'worker'
+storage = open_storage()
 
+# Micro-batching: points from concurrent tasks are written in one request.
+# Run the worker with a thread pool (--pool threads) so tasks can share a batch.
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '5000'))
+WRITE_LINGER_MS = int(os.getenv('WRITE_LINGER_MS', '200'))
+WRITE_MAX_RETRIES = int(os.getenv('WRITE_MAX_RETRIES', '5'))
+WRITE_RETRY_BACKOFF_MS = int(os.getenv('WRITE_RETRY_BACKOFF_MS', '100'))
+WRITE_TIMEOUT = float(os.getenv('WRITE_TIMEOUT', '60'))
+WRITE_STATS_INTERVAL = int(os.getenv('WRITE_STATS_INTERVAL', '60'))
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+# Failed metrics are pushed here instead of being stored as task results
+DEAD_LETTER_QUEUE = os.getenv('DEAD_LETTER_QUEUE', 'theia:dead_letter')
+DEAD_LETTER_MAX_LENGTH = int(os.getenv('DEAD_LETTER_MAX_LENGTH', '100000'))
+# Messages reserved per worker process; with acks_late this bounds unacked messages
+WORKER_PREFETCH_MULTIPLIER = int(os.getenv('WORKER_PREFETCH_MULTIPLIER', '4'))
+# Unacked messages are redelivered after this many seconds
+BROKER_VISIBILITY_TIMEOUT = int(os.getenv('BROKER_VISIBILITY_TIMEOUT', '3600'))
+# Written points are published here for the backend's live streams ('' disables)
+LIVE_CHANNEL = os.getenv('LIVE_CHANNEL', 'theia:live')
+# Redis key prefix of the metric name / tag index kept up to date on write ('' disables)
+SERIES_INDEX_PREFIX = os.getenv('SERIES_INDEX_PREFIX', 'theia:index')
+# Telemetry snapshots are stored under <prefix>:worker:<host>:<pid> every TELEMETRY_INTERVAL seconds for
+# the backend's /internal/metrics/workers; with SELF_METRICS they are also written as theia.worker.* metrics
+TELEMETRY_PREFIX = os.getenv('TELEMETRY_PREFIX', 'theia:telemetry')
+TELEMETRY_INTERVAL = float(os.getenv('TELEMETRY_INTERVAL', '10'))
+SELF_METRICS = os.getenv('SELF_METRICS', 'false').lower() in ('1', 'true', 'yes')
+# Redis key prefix of the series cardinality counts; limits are enforced before writing ('' disables)
+CARDINALITY_PREFIX = os.getenv('CARDINALITY_PREFIX', 'theia:cardinality')
+CARDINALITY_MAX_SERIES = int(os.getenv('CARDINALITY_MAX_SERIES', '10000'))
+CARDINALITY_MAX_TAG_VALUES = int(os.getenv('CARDINALITY_MAX_TAG_VALUES', '1000'))
+# Per-metric series limits as pattern=limit pairs, e.g. 'api.requests=50000,debug.*=100'
+CARDINALITY_LIMITS = os.getenv('CARDINALITY_LIMITS', '')
+# What happens to points carrying an over-limit tag: drop, strip or aggregate
+CARDINALITY_POLICY = os.getenv('CARDINALITY_POLICY', 'drop')
+CARDINALITY_WINDOW = int(os.getenv('CARDINALITY_WINDOW', '3600'))
+# Comma-separated tag keys; denied keys are always removed, and if any are allowed only those are kept
+CARDINALITY_TAG_ALLOWLIST = os.getenv('CARDINALITY_TAG_ALLOWLIST', '')
+CARDINALITY_TAG_DENYLIST = os.getenv('CARDINALITY_TAG_DENYLIST', '')
+# Ingest queues the agent spreads series over (<queue>.0 ... <queue>.N-1); must match the agent's INGEST_SHARDS.
+# Workers divide the shards among themselves, SHARD_REPLICAS workers per shard, and rebalance as they come and go
+INGEST_SHARDS = int(os.getenv('INGEST_SHARDS', '1'))
+SHARD_REPLICAS = int(os.getenv('SHARD_REPLICAS', '1'))
+SHARD_HEARTBEAT = float(os.getenv('SHARD_HEARTBEAT', '5'))
+SHARD_PREFIX = os.getenv('SHARD_PREFIX', 'theia:shards')
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def write_points(points):
+    """storage.write_batch, timed per attempt"""
+    with telemetry.timer('write_seconds'):
+        written = storage.write_batch(points)
+    if written:
+        telemetry.incr('points_written', len(points))
+    else:
+        telemetry.incr('write_errors')
+    return written
+
+
+def get_writer():
+    """Return the per-process batch writer, starting it on first use"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BatchWriter(
+                write_points,
+                max_batch_size=WRITE_BATCH_SIZE,
+                max_linger_ms=WRITE_LINGER_MS,
+                max_retries=WRITE_MAX_RETRIES,
+                retry_backoff_ms=WRITE_RETRY_BACKOFF_MS,
+                stats_interval=WRITE_STATS_INTERVAL,
+            ).start()
+        return _writer
+
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def flush_writer(**kwargs):
+    """Flush pending points before the worker exits"""
+    if _writer is not None:
+        _writer.close()
+    storage.close()
+
+
+# Ingest tasks are fire-and-forget: there is no result backend, so return
+# values are never written to Redis. Failures go to the dead-letter queue.
 celery_app = Celery(
     'theia_worker',
-    broker=os.getenv('REDIS_URL', 'redis://redis:6379/0'),
-    backend=os.getenv('REDIS_URL', 'redis://redis:6379/0')
+    broker=REDIS_URL
 )
 
 celery_app.conf.update(
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
+    task_serializer='msgpack',
+    accept_content=['msgpack', 'json'],
+    task_ignore_result=True,
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    worker_prefetch_multiplier=WORKER_PREFETCH_MULTIPLIER,
+    broker_transport_options={'visibility_timeout': BROKER_VISIBILITY_TIMEOUT},
     timezone='UTC',
     enable_utc=True,
 )
 
+INGEST_QUEUE = celery_app.conf.task_default_queue
+redis_client = redis.Redis.from_url(REDIS_URL)
+series_index = SeriesIndex(redis_client, prefix=SERIES_INDEX_PREFIX) if SERIES_INDEX_PREFIX else None
+# Set in the main worker process when INGEST_SHARDS > 1
+coordinator = None
+cardinality = CardinalityGuard(
+    redis_client, prefix=CARDINALITY_PREFIX, max_series=CARDINALITY_MAX_SERIES,
+    max_tag_values=CARDINALITY_MAX_TAG_VALUES, policy=CARDINALITY_POLICY, window=CARDINALITY_WINDOW,
+    limits=parse_limits(CARDINALITY_LIMITS), allow=parse_keys(CARDINALITY_TAG_ALLOWLIST),
+    deny=parse_keys(CARDINALITY_TAG_DENYLIST)
+) if CARDINALITY_PREFIX else None
 
-@celery_app.task(name='process_metric')
-def process_metric(metric_data):
-    """Process a metric and store it in InfluxDB"""
+
+def dead_letter(task_name, payload, error, count=1):
+    """Park a payload of count metrics that could not be stored so it can be inspected or replayed"""
+    telemetry.incr('dead_letters', count)
+    record = json.dumps({
+        'task': task_name,
+        'payload': payload,
+        'error': str(error),
+        'failed_at': datetime.utcnow().isoformat()
+    }, default=str)
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.lpush(DEAD_LETTER_QUEUE, record)
+            pipe.ltrim(DEAD_LETTER_QUEUE, 0, DEAD_LETTER_MAX_LENGTH - 1)
+            pipe.execute()
+    except redis.RedisError as e:
+        print(f"Error writing to dead-letter queue: {e}")
+
+
+def publish_live(metrics):
+    """Announce written metrics to live stream subscribers; best effort"""
+    if not LIVE_CHANNEL or not metrics:
+        return
+    message = json.dumps([
+        {'name': metric.name, 'value': metric.value, 'timestamp': metric.timestamp, 'fields': metric.fields}
+        if metric.fields else {'name': metric.name, 'value': metric.value, 'timestamp': metric.timestamp}
+        for metric in metrics
+    ])
+    try:
+        redis_client.publish(LIVE_CHANNEL, message)
+    except redis.RedisError as e:
+        print(f"Error publishing live update: {e}")
+
+
+def index_series(metrics):
+    """Add new metric names, tag keys and tag values to the series index; best effort"""
+    if series_index is None or not metrics:
+        return
+    try:
+        series_index.record(metrics)
+    except redis.RedisError as e:
+        print(f"Error updating series index: {e}")
+
+
+CARDINALITY_COUNTERS = {'drop': 'cardinality_dropped', 'strip': 'cardinality_stripped',
+                        'aggregate': 'cardinality_aggregated'}
+
+
+def limit_cardinality(metrics):
+    """The metrics to write after the cardinality limits and tag allow/deny lists are applied"""
+    if cardinality is None:
+        return metrics
+    with telemetry.timer('cardinality_seconds'):
+        admitted, enforced = cardinality.apply(metrics)
+    for (name, key, action), count in enforced.items():
+        telemetry.incr(CARDINALITY_COUNTERS[action], count)
+    return admitted
+
+
+def record_queue_wait(request):
+    """Time from the agent publishing a task to a worker starting it, from the enqueued_at header"""
+    enqueued_at = request.get('enqueued_at')
+    if enqueued_at and not request.retries:
+        telemetry.observe('queue_wait_seconds', max(time.time() - enqueued_at, 0.0))
+
+
+def publish_snapshot(snapshot):
+    """Store this process's telemetry for /internal/metrics/workers; it expires if the process stops"""
+    key = f'{TELEMETRY_PREFIX}:worker:{socket.gethostname()}:{os.getpid()}'
+    redis_client.set(key, json.dumps(snapshot), ex=max(int(TELEMETRY_INTERVAL * 3), 1))
+
+
+def write_self_metrics(metrics):
+    """Write theia.worker.* metrics through the batch writer without waiting for them"""
+    get_writer().submit([storage.encode_point(metric) for metric in metrics])
+
+
+def queue_depth():
+    """Tasks waiting in the ingest queue and all its shards"""
+    with redis_client.pipeline(transaction=False) as pipe:
+        for queue in [INGEST_QUEUE] + [shard_queue(INGEST_QUEUE, shard) for shard in range(INGEST_SHARDS)
+                                       if INGEST_SHARDS > 1]:
+            pipe.llen(queue)
+        return sum(pipe.execute())
+
+
+telemetry.gauge('queue_depth', queue_depth)
+telemetry.gauge_group('writer', lambda: _writer.stats() if _writer is not None else {})
+if hasattr(storage, 'stats'):
+    telemetry.gauge_group('storage', storage.stats)
+reporter = Reporter(
+    telemetry, interval=TELEMETRY_INTERVAL, publish=publish_snapshot if TELEMETRY_PREFIX else None,
+    write=write_self_metrics if SELF_METRICS else None
+)
+
+
+@worker_ready.connect
+@worker_process_init.connect
+def start_reporter(**kwargs):
+    reporter.start()
+
+
+def decode_metrics(task_name, payload):
+    """Read task payload items back into Metrics; malformed items are dead-lettered"""
+    metrics = []
+    for item in payload:
+        try:
+            metrics.append(as_record(item))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            dead_letter(task_name, item, e)
+    return metrics
+
+
+def encode_metrics(task_name, metrics):
+    """Encode Metrics for the storage backend; returns (points, metrics encoded) and dead-letters the rest"""
+    started = time.perf_counter()
+    points = []
+    encoded = []
+    for metric in metrics:
+        try:
+            points.append(storage.encode_point(metric))
+            encoded.append(metric)
+        except (TypeError, ValueError) as e:
+            dead_letter(task_name, metric.as_dict(), e)
+    telemetry.observe('build_seconds', time.perf_counter() - started)
+    return points, encoded
+
+
+def shard_consumers(consumer):
+    """Start consuming the shards assigned to this worker, and follow rebalances"""
+    global coordinator
+    control = celery_app.control
+    destination = [consumer.hostname]
+
+    def assign(shard):
+        print(f"Consuming shard {shard}")
+        control.add_consumer(shard_queue(INGEST_QUEUE, shard), destination=destination, reply=False)
+
+    def revoke(shard):
+        print(f"Handing over shard {shard}")
+        control.cancel_consumer(shard_queue(INGEST_QUEUE, shard), destination=destination, reply=False)
+
+    coordinator = ShardCoordinator(
+        redis_client, consumer.hostname, INGEST_SHARDS, assign, revoke, replicas=SHARD_REPLICAS,
+        prefix=SHARD_PREFIX, heartbeat=SHARD_HEARTBEAT
+    ).start()
+    telemetry.gauge_group('shards', coordinator.stats)
+
+
+@worker_ready.connect
+def start_shard_consumers(sender=None, **kwargs):
+    if INGEST_SHARDS > 1:
+        shard_consumers(sender)
+
+
+@worker_shutdown.connect
+def stop_shard_consumers(**kwargs):
+    if coordinator is not None:
+        coordinator.stop()
+
+
+def store(task, task_name, payload):
+    """Write a task's metrics and ack only once they are stored; retries, then dead-letters, on failure"""
+    record_queue_wait(task.request)
+    points, written = encode_metrics(task_name, limit_cardinality(decode_metrics(task_name, payload)))
+    if not points:
+        return
     try:
-        success = influxdb.write_metric(
-            name=metric_data['name'],
-            value=metric_data['value'],
-            tags=metric_data.get('tags', {}),
-            timestamp=metric_data.get('timestamp'),
-            source=metric_data.get('source')
-        )
-        if success:
-            return {'status': 'success'}
-        else:
-            return {'status': 'error', 'message': 'Failed to write to InfluxDB'}
+        with telemetry.timer('batch_wait_seconds'):
+            get_writer().submit(points).result(timeout=WRITE_TIMEOUT)
     except Exception as e:
-        return {'status': 'error', 'message': str(e)}
+        if task.request.retries < task.max_retries:
+            telemetry.incr('task_retries')
+            raise task.retry(exc=e, countdown=2 ** task.request.retries)
+        dead_letter(task_name, payload, e, count=len(payload))
+        return
+    publish_live(written)
+    index_series(written)
+
+
+@celery_app.task(name='process_metric', bind=True, max_retries=WRITE_MAX_RETRIES)
+def process_metric(self, metric):
+    """Process a metric and store it in InfluxDB"""
+    store(self, 'process_metric', [metric])
+
+
+@celery_app.task(name='process_metric_batch', bind=True, max_retries=WRITE_MAX_RETRIES)
+def process_metric_batch(self, metrics):
+    """Store a chunk of metrics in InfluxDB as one multi-point write"""
+    store(self, 'process_metric_batch', metrics)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Load-test harness comparing the Flask agent (app.py) with the async agent (asgi.py)
+
+Starts both agents against the same Redis (a local server, or an in-process
+fakeredis server with --fakeredis), drives each with a fixed number of
+concurrent clients and reports requests/s and latency percentiles.
+
+    python benchmarks/agent_load.py --fakeredis --duration 10 --concurrency 64
+    python benchmarks/agent_load.py --redis-url redis://localhost:6379/0 --endpoint batch
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
+
+AGENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'agent')
+
+
+def start_fakeredis(port):
+    """Serve an in-process fakeredis instance on localhost:port"""
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_agents(redis_url, flask_port, asgi_port):
+    """Launch both agents as subprocesses and return {label: (process, url)}"""
+    env = dict(os.environ, REDIS_URL=redis_url)
+    commands = {
+        'flask': [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(flask_port),
+                  '--with-threads'],
+        'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(asgi_port),
+                 '--log-level', 'warning'],
+    }
+    ports = {'flask': flask_port, 'asgi': asgi_port}
+    agents = {}
+    for label, command in commands.items():
+        process = subprocess.Popen(command, cwd=AGENT_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        agents[label] = (process, f'http://127.0.0.1:{ports[label]}')
+    return agents
+
+
+async def wait_healthy(session, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f'{url}/health') as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f'Agent at {url} did not become healthy')
+
+
+def make_payload(endpoint, batch_size):
+    def metric():
+        return {
+            'name': random.choice(['button_clicks', 'api_requests', 'page_views']),
+            'value': random.random() * 100,
+            'tags': {'page': random.choice(['home', 'dashboard', 'settings'])},
+            'source': 'loadtest',
+        }
+    if endpoint == 'batch':
+        return '/metrics/batch', {'metrics': [metric() for _ in range(batch_size)]}
+    return '/metrics', metric()
+
+
+async def run_load(url, endpoint, concurrency, duration, batch_size):
+    """Drive url with concurrent clients for duration seconds and collect latencies"""
+    latencies = []
+    statuses = {}
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_healthy(session, url)
+        deadline = time.monotonic() + duration
+
+        async def client():
+            while time.monotonic() < deadline:
+                path, payload = make_payload(endpoint, batch_size)
+                started = time.perf_counter()
+                try:
+                    async with session.post(url + path, json=payload) as response:
+                        await response.read()
+                        status = response.status
+                except aiohttp.ClientError:
+                    status = 'error'
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    latencies.sort()
+
+    def percentile(q):
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000 if latencies else None
+
+    return {
+        'requests': len(latencies),
+        'requests_per_second': len(latencies) / elapsed,
+        'metrics_per_second': len(latencies) * (batch_size if endpoint == 'batch' else 1) / elapsed,
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99),
+        'max_ms': latencies[-1] * 1000 if latencies else None,
+        'statuses': {str(key): value for key, value in statuses.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/0')
+    parser.add_argument('--fakeredis', action='store_true', help='serve an in-process fakeredis instead')
+    parser.add_argument('--fakeredis-port', type=int, default=16379)
+    parser.add_argument('--flask-port', type=int, default=18000)
+    parser.add_argument('--asgi-port', type=int, default=18001)
+    parser.add_argument('--endpoint', choices=['metrics', 'batch'], default='metrics')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    redis_url = args.redis_url
+    if args.fakeredis:
+        start_fakeredis(args.fakeredis_port)
+        redis_url = f'redis://127.0.0.1:{args.fakeredis_port}/0'
+
+    agents = start_agents(redis_url, args.flask_port, args.asgi_port)
+    results = {}
+    try:
+        for label, (_, url) in agents.items():
+            results[label] = asyncio.run(run_load(url, args.endpoint, args.concurrency, args.duration,
+                                                  args.batch_size))
+    finally:
+        for process, _ in agents.values():
+            process.terminate()
+            process.wait()
+
+    print(f"{'agent':<8}{'req/s':>12}{'metrics/s':>14}{'p50 ms':>10}{'p99 ms':>10}  statuses")
+    for label, result in results.items():
+        print(f"{label:<8}{result['requests_per_second']:>12.1f}{result['metrics_per_second']:>14.1f}"
+              f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}  {result['statuses']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Benchmark the NumPy aggregation engine against the original per-row Python loop
+
+  loop          the aggregation loop query_aggregated_metrics used before it moved into
+                Flux: a dict per point, datetime.fromisoformat per timestamp, lists per bucket
+  engine        aggregation.aggregate on int64 ns timestamps and float64 values
+  engine+parse  the same, including parsing the ISO timestamps into a datetime64 array
+
+Points are synthetic, spread over the 1m look-back range (6h) across --names
+metric names. The loop holds a dict per point, so it only runs up to
+--loop-max points (about 450 bytes per point).
+
+    python benchmarks/aggregation.py --sizes 100000,1000000,10000000 --aggregate mean
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+sys.path.insert(0, BACKEND_DIR)
+
+from aggregation import aggregate  # noqa: E402
+
+WINDOWS = {
+    '1m': timedelta(minutes=1),
+    '5m': timedelta(minutes=5),
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1),
+}
+
+
+def synthetic_points(size, names, seed=1):
+    """Return (int64 ns timestamps, float64 values, name codes) over the last 6 hours"""
+    rng = np.random.default_rng(seed)
+    end = np.datetime64('2024-01-01T06:00:00', 'ns').astype(np.int64)
+    timestamps = np.sort(rng.integers(end - 6 * 3600 * 10 ** 9, end, size))
+    return timestamps, rng.gamma(2.0, 50.0, size), rng.integers(0, names, size)
+
+
+def legacy_aggregate(raw_metrics, window, aggregate_fn, name=None):
+    """The original loop, verbatim apart from taking the raw metrics as an argument"""
+    window_delta = WINDOWS.get(window, timedelta(hours=1))
+    buckets = defaultdict(lambda: {'values': [], 'name': name or 'unknown'})
+
+    for metric in raw_metrics:
+        try:
+            timestamp = datetime.fromisoformat(metric['timestamp'].replace('Z', '+00:00'))
+            if window_delta >= timedelta(days=1):
+                bucket_time = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+            elif window_delta >= timedelta(hours=1):
+                bucket_time = timestamp.replace(minute=0, second=0, microsecond=0)
+            elif window_delta >= timedelta(minutes=5):
+                minutes_rounded = (timestamp.minute // 5) * 5
+                bucket_time = timestamp.replace(minute=minutes_rounded, second=0, microsecond=0)
+            else:
+                bucket_time = timestamp.replace(second=0, microsecond=0)
+
+            metric_name = metric.get('name', name or 'unknown')
+            bucket_key = (bucket_time.isoformat(), metric_name)
+            buckets[bucket_key]['values'].append(metric['value'])
+            buckets[bucket_key]['name'] = metric_name
+        except Exception:
+            continue
+
+    aggregated = []
+    for (time_bucket, metric_name), data in buckets.items():
+        if data['values']:
+            values = data['values']
+            if aggregate_fn == 'mean' or aggregate_fn == 'avg':
+                aggregated_value = sum(values) / len(values)
+            elif aggregate_fn == 'sum':
+                aggregated_value = sum(values)
+            elif aggregate_fn == 'max':
+                aggregated_value = max(values)
+            elif aggregate_fn == 'min':
+                aggregated_value = min(values)
+            elif aggregate_fn == 'count':
+                aggregated_value = len(values)
+            elif aggregate_fn == 'last':
+                aggregated_value = values[-1] if values else 0.0
+            else:
+                aggregated_value = sum(values) / len(values)
+            aggregated.append({
+                'name': data['name'],
+                'time_bucket': time_bucket,
+                'avg_value': aggregated_value,
+                'count': len(values)
+            })
+
+    aggregated.sort(key=lambda x: x['time_bucket'])
+    return aggregated
+
+
+def timed(function, repeat):
+    """Best of repeat runs, in seconds, and the last result"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run(size, args):
+    timestamps, values, codes = synthetic_points(size, args.names)
+    window_ns = int(WINDOWS[args.window].total_seconds()) * 10 ** 9
+    results = {}
+
+    seconds, (_, _, engine_values, _) = timed(
+        lambda: aggregate(timestamps, values, window_ns, args.aggregate, groups=codes), args.repeat
+    )
+    results['engine'] = seconds
+
+    iso = np.datetime_as_string(timestamps.astype('datetime64[ns]'), unit='us')
+    results['engine+parse'], _ = timed(
+        lambda: aggregate(iso.astype('datetime64[ns]').view(np.int64), values, window_ns, args.aggregate,
+                          groups=codes),
+        args.repeat,
+    )
+
+    if size <= args.loop_max:
+        names = [f'metric_{code}' for code in range(args.names)]
+        raw_metrics = [
+            {'name': names[code], 'value': value, 'timestamp': timestamp + 'Z'}
+            for code, value, timestamp in zip(codes.tolist(), values.tolist(), iso.tolist())
+        ]
+        results['loop'], legacy = timed(lambda: legacy_aggregate(raw_metrics, args.window, args.aggregate), 1)
+        del raw_metrics
+        if len(legacy) != len(engine_values):
+            raise SystemExit(f'bucket count differs: loop {len(legacy)}, engine {len(engine_values)}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100000,1000000,10000000', help='comma-separated point counts')
+    parser.add_argument('--names', type=int, default=5, help='distinct metric names')
+    parser.add_argument('--window', choices=sorted(WINDOWS), default='1m')
+    parser.add_argument('--aggregate', default='mean', choices=['mean', 'sum', 'max', 'min', 'count', 'last'])
+    parser.add_argument('--repeat', type=int, default=3, help='engine runs per size (best is reported)')
+    parser.add_argument('--loop-max', type=int, default=1000000, help='largest size the loop runs at')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    report = {}
+    print(f"{'points':>10}{'loop s':>10}{'engine s':>10}{'+parse s':>10}{'loop/engine':>13}{'Mpoints/s':>11}")
+    for size in (int(size) for size in args.sizes.split(',')):
+        results = report[size] = run(size, args)
+        loop = results.get('loop')
+        print(f"{size:>10}{loop if loop is not None else float('nan'):>10.3f}{results['engine']:>10.3f}"
+              f"{results['engine+parse']:>10.3f}"
+              f"{(loop / results['engine'] if loop else float('nan')):>12.0f}x"
+              f"{size / results['engine'] / 1e6:>11.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
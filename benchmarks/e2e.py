@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark: ingest throughput, ingest-to-queryable latency and query latency
+
+Drives the agent with loadgen.py for --duration seconds. Meanwhile a probe
+metric (one name per run, its sequence number in a ``probe`` tag) is sent
+every --probe-interval seconds and timed until it can be read back. After
+the load, query_latency.py measures the backend's query endpoints.
+
+Against a running stack (docker compose, or services started by hand):
+
+    python benchmarks/e2e.py --agent-url http://localhost:8000 --backend-url http://localhost:5001
+
+With --in-process, Redis is an in-process fakeredis server and InfluxDB is a
+stand-in that accepts writes and records when each probe lands. The agent
+(asgi.py by default) and a Celery worker run as subprocesses. Latency is
+then measured up to the write reaching the stand-in, and the query phase
+only runs if --backend-url points at a backend with real data:
+
+    python benchmarks/e2e.py --in-process --duration 20 --endpoint batch --batch-size 500
+
+Results are written as JSON with --output. --baseline compares against an
+earlier result file and exits with status 1 when throughput drops, or probe
+or query latency rises, by more than --tolerance.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+
+from agent_load import start_fakeredis, wait_healthy
+from loadgen import add_workload_arguments, generate, percentiles, workload_from
+from query_latency import measure, print_table
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+AGENT_DIR = os.path.join(ROOT, 'agent')
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+PROBE_TAG = re.compile(rb'[,]probe=(\d+)')
+
+
+class InfluxStandIn:
+    """Accepts InfluxDB writes on localhost, counting points and timing probe arrivals"""
+
+    def __init__(self, port, probe_name):
+        self.port = port
+        # Tags are written in key order, so name comes first
+        self.probe_prefix = f'metrics,name={probe_name},'.encode()
+        self.points = 0
+        self.writes = 0
+        self.arrivals = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def record(self, body):
+        points = 0
+        arrivals = {}
+        now = time.monotonic()
+        for line in body.splitlines():
+            if not line or line.startswith(b'#'):
+                continue
+            points += 1
+            if line.startswith(self.probe_prefix):
+                match = PROBE_TAG.search(line)
+                if match:
+                    arrivals[int(match.group(1))] = now
+        with self._lock:
+            self.points += points
+            self.writes += 1
+            for seq, arrived in arrivals.items():
+                self.arrivals.setdefault(seq, arrived)
+
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.path.startswith('/api/v2/write'):
+                    if self.headers.get('Content-Encoding') == 'gzip':
+                        body = gzip.decompress(body)
+                    stand_in.record(body)
+                    self.send_response(204)
+                else:
+                    self.send_response(501)
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path.startswith(('/ping', '/health')):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.end_headers()
+                    self.wfile.write(b'{"status": "pass"}')
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='influx-stand-in', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def start_stack(args, stand_in):
+    """Start fakeredis, the InfluxDB stand-in, a worker and an agent; return the subprocesses"""
+    start_fakeredis(args.fakeredis_port)
+    stand_in.start()
+    env = dict(os.environ, REDIS_URL=f'redis://127.0.0.1:{args.fakeredis_port}/0',
+               INFLUXDB_URL=f'http://127.0.0.1:{args.influx_port}', STORAGE_BACKEND='influxdb')
+    worker = subprocess.Popen(
+        [sys.executable, '-m', 'celery', '-A', 'worker.celery_app', 'worker', '--pool', 'threads',
+         '--concurrency', str(args.worker_concurrency), '--loglevel', 'warning'],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    if args.agent == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(args.agent_port),
+                   '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(args.agent_port),
+                   '--with-threads']
+    agent = subprocess.Popen(command, cwd=AGENT_DIR, env=env, stdout=subprocess.DEVNULL,
+                             stderr=None if args.verbose else subprocess.DEVNULL)
+    return [agent, worker]
+
+
+class Probes:
+    """Sends probe metrics and tracks when each becomes visible"""
+
+    def __init__(self, name):
+        self.name = name
+        self.sent = {}
+        self.seen = {}
+
+    async def send(self, session, agent_url, interval, deadline):
+        seq = 0
+        while time.monotonic() < deadline:
+            self.sent[seq] = time.monotonic()
+            try:
+                async with session.post(f'{agent_url}/metrics', json={
+                    'name': self.name, 'value': seq, 'tags': {'probe': str(seq)}, 'source': 'e2e-probe',
+                }) as response:
+                    await response.read()
+                    if response.status != 202:
+                        del self.sent[seq]
+            except aiohttp.ClientError:
+                del self.sent[seq]
+            seq += 1
+            await asyncio.sleep(interval)
+
+    async def poll_backend(self, session, backend_url, interval, load_end, deadline):
+        """Read the probe metric back through /api/metrics until every probe has been seen"""
+        params = {'name': self.name, 'start_time': '-1h', 'limit': 100000}
+        while time.monotonic() < deadline and (time.monotonic() < load_end or self.pending()):
+            try:
+                async with session.get(f'{backend_url}/api/metrics', params=params) as response:
+                    rows = await response.json() if response.status == 200 else []
+                now = time.monotonic()
+                for row in rows:
+                    seq = int((row.get('tags') or {}).get('probe', -1))
+                    self.seen.setdefault(seq, now)
+            except (aiohttp.ClientError, ValueError):
+                pass
+            await asyncio.sleep(interval)
+
+    def pending(self):
+        return [seq for seq in self.sent if seq not in self.seen]
+
+    def result(self):
+        latencies = [self.seen[seq] - sent for seq, sent in self.sent.items() if seq in self.seen]
+        return dict(sent=len(self.sent), seen=len(latencies), **percentiles(latencies))
+
+
+async def worker_points_written(session, backend_url):
+    """Total points written by all workers, from their telemetry; None when unavailable"""
+    try:
+        async with session.get(f'{backend_url}/internal/metrics/workers') as response:
+            snapshots = await response.json()
+        return sum(snapshot['counters'].get('points_written', 0) for snapshot in snapshots.values())
+    except (aiohttp.ClientError, ValueError, KeyError, AttributeError):
+        return None
+
+
+async def run(args, probe_name, stand_in=None):
+    workload = workload_from(args)
+    probes = Probes(probe_name)
+    report = {'series': workload.series}
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency + 8)) as session:
+        await wait_healthy(session, args.agent_url, timeout=60)
+        written_before = None if args.backend_url is None else await worker_points_written(session, args.backend_url)
+        if stand_in is not None:
+            written_before = stand_in.points
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        tasks = [probes.send(session, args.agent_url, args.probe_interval, deadline)]
+        if stand_in is None and args.backend_url:
+            tasks.append(probes.poll_backend(session, args.backend_url, args.poll_interval, deadline,
+                                             deadline + args.settle))
+        load, *_ = await asyncio.gather(
+            generate(args.agent_url, workload, args.endpoint, args.concurrency, args.duration, args.rate,
+                     session=session),
+            *tasks,
+        )
+        report['ingest'] = load
+
+        # Wait for the pipeline to drain, then measure how many points were written over the whole run
+        settle_deadline = time.monotonic() + args.settle
+        expected = written_before + load['metrics_accepted'] + len(probes.sent) if written_before is not None else None
+        while time.monotonic() < settle_deadline:
+            written = stand_in.points if stand_in is not None else (
+                await worker_points_written(session, args.backend_url) if args.backend_url else None
+            )
+            if written is None or written >= expected:
+                break
+            await asyncio.sleep(0.2)
+        if stand_in is not None:
+            probes.seen = dict(stand_in.arrivals)
+            written = stand_in.points
+        if written_before is not None and written is not None:
+            elapsed = time.monotonic() - started
+            report['ingest']['points_written'] = written - written_before
+            report['ingest']['written_per_second'] = (written - written_before) / elapsed
+        report['e2e_latency'] = probes.result()
+
+        if args.backend_url and not args.skip_queries:
+            report['queries'] = await measure(args.backend_url, args.query_iterations, args.query_concurrency,
+                                              session=session)
+    return report
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit or None, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+
+def regressions(report, baseline, tolerance):
+    """Describe every figure that got worse than the baseline by more than tolerance"""
+    found = []
+
+    def check(label, current, previous, higher_is_better):
+        if current is None or not previous:
+            return
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            found.append(f'{label}: {previous:.2f} -> {current:.2f} ({change:+.0%})')
+
+    check('ingest metrics/s', report['ingest']['metrics_per_second'],
+          baseline.get('ingest', {}).get('metrics_per_second'), True)
+    check('ingest p99 ms', report['ingest']['p99_ms'], baseline.get('ingest', {}).get('p99_ms'), False)
+    check('e2e p99 ms', report['e2e_latency']['p99_ms'], baseline.get('e2e_latency', {}).get('p99_ms'), False)
+    for label, result in report.get('queries', {}).items():
+        check(f'query {label} p50 ms', result['p50_ms'],
+              baseline.get('queries', {}).get(label, {}).get('p50_ms'), False)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--agent-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--backend-url', help='backend base URL; enables read-back probes and the query phase')
+    parser.add_argument('--in-process', action='store_true', help='start the agent and a worker on stand-ins')
+    parser.add_argument('--agent', choices=['asgi', 'flask'], default='asgi', help='agent started by --in-process')
+    parser.add_argument('--agent-port', type=int, default=18100)
+    parser.add_argument('--fakeredis-port', type=int, default=16380)
+    parser.add_argument('--influx-port', type=int, default=18086)
+    parser.add_argument('--worker-concurrency', type=int, default=64)
+    add_workload_arguments(parser)
+    parser.add_argument('--probe-interval', type=float, default=0.25, help='seconds between probe metrics')
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='seconds between read-back polls')
+    parser.add_argument('--settle', type=float, default=30.0, help='seconds to wait for the pipeline to drain')
+    parser.add_argument('--query-iterations', type=int, default=20)
+    parser.add_argument('--query-concurrency', type=int, default=4)
+    parser.add_argument('--skip-queries', action='store_true')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='earlier --output file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (default 0.2)')
+    parser.add_argument('--verbose', action='store_true', help='show agent and worker logs')
+    args = parser.parse_args()
+
+    probe_name = f'bench.probe.{uuid.uuid4().hex[:8]}'
+    stand_in = None
+    processes = []
+    if args.in_process:
+        args.agent_url = f'http://127.0.0.1:{args.agent_port}'
+        stand_in = InfluxStandIn(args.influx_port, probe_name)
+        processes = start_stack(args, stand_in)
+    try:
+        report = asyncio.run(run(args, probe_name, stand_in))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if stand_in is not None:
+            stand_in.stop()
+
+    ingest, latency = report['ingest'], report['e2e_latency']
+    print(f"{report['series']} series, {ingest['requests']} requests in {ingest['seconds']:.1f}s, "
+          f"statuses {ingest['statuses']}")
+    print(f"ingest: {ingest['metrics_per_second']:.0f} metrics/s accepted, "
+          f"{ingest.get('written_per_second', float('nan')):.0f} points/s written, "
+          f"request p50 {ingest['p50_ms']:.2f}ms p99 {ingest['p99_ms']:.2f}ms")
+    if latency['seen']:
+        print(f"ingest to {'stored' if stand_in is not None else 'queryable'}: {latency['seen']}/{latency['sent']} "
+              f"probes, p50 {latency['p50_ms']:.0f}ms p90 {latency['p90_ms']:.0f}ms p99 {latency['p99_ms']:.0f}ms")
+    else:
+        print(f"ingest to queryable: {latency['sent']} probes sent, none read back"
+              f"{'' if args.backend_url or stand_in is not None else ' (pass --backend-url)'}")
+    if 'queries' in report:
+        print_table(report['queries'])
+
+    report = {'config': vars(args), 'environment': environment(), **report}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print(f'REGRESSION {line}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Per-metric CPU cost of the ingest pipeline, with dict metrics and with Metric records
+
+  agent   validate a decoded JSON metric and msgpack-encode a task body of --chunk metrics
+  worker  msgpack-decode that body and encode every metric as line protocol
+
+The legacy stages are the code the agent and worker ran before Metric
+records: normalize_metric returning a dict with an ISO timestamp from
+datetime.utcnow(), and build_point creating an influxdb_client Point that
+the write API then turns into line protocol. Each stage runs --repeat times
+and the fastest run is reported, in CPU microseconds per metric.
+
+    python benchmarks/ingest_model.py --count 100000 --tags 3
+    python benchmarks/ingest_model.py --timestamps iso --output ingest_model.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import msgpack
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+sys.path.insert(0, BACKEND_DIR)
+
+from influxdb_client import Point  # noqa: E402
+from metric_record import as_record, encode_line, validate  # noqa: E402
+
+
+def legacy_normalize_metric(metric, default_source=None):
+    """The agent's normalize_metric before Metric records, verbatim"""
+    if not isinstance(metric, dict):
+        return None, 'Metric must be an object'
+    if 'name' not in metric or 'value' not in metric:
+        return None, 'Missing required fields: name and value'
+
+    name = metric['name']
+    if not isinstance(name, str) or not name:
+        return None, 'Metric name must be a non-empty string'
+
+    value = metric['value']
+    if isinstance(value, bool):
+        return None, 'Metric value must be numeric'
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None, 'Metric value must be numeric'
+    if not math.isfinite(value):
+        return None, 'Metric value must be finite'
+
+    tags = metric.get('tags') or {}
+    if not isinstance(tags, dict):
+        return None, 'Metric tags must be an object'
+
+    timestamp = metric.get('timestamp') or datetime.utcnow().isoformat()
+    if not isinstance(timestamp, str):
+        return None, 'Metric timestamp must be an ISO 8601 string'
+
+    return {
+        'name': name,
+        'value': value,
+        'tags': {str(key): str(val) for key, val in tags.items()},
+        'timestamp': timestamp,
+        'source': metric.get('source', default_source)
+    }, None
+
+
+def legacy_build_point(name, value, tags=None, timestamp=None, source=None, fields=None):
+    """InfluxDB.build_point as the worker used it, verbatim"""
+    point = Point("metrics")
+    point.field("value", float(value))
+    point.tag("name", name)
+
+    if fields:
+        for key, val in fields.items():
+            if val is not None:
+                point.field(key, float(val))
+
+    if tags:
+        for key, val in tags.items():
+            point.tag(key, str(val))
+
+    if source:
+        point.tag("source", source)
+
+    if timestamp:
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        point.time(timestamp)
+    else:
+        point.time(datetime.utcnow())
+
+    return point
+
+
+def client_metrics(count, tags, timestamps, seed=1):
+    """Metrics as a client sends them, already decoded from JSON"""
+    rng = random.Random(seed)
+    now = time.time()
+    metrics = []
+    for index in range(count):
+        metric = {
+            'name': f'service.requests_{index % 20}',
+            'value': rng.random() * 100,
+            'tags': {f'tag_{key}': f'value_{rng.randrange(50)}' for key in range(tags)},
+            'source': 'host-1',
+        }
+        if timestamps == 'iso':
+            metric['timestamp'] = datetime.utcfromtimestamp(now - index / 1000).isoformat() + 'Z'
+        metrics.append(metric)
+    return metrics
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def legacy_agent(metrics, chunk):
+    bodies = []
+    for part in chunked(metrics, chunk):
+        bodies.append(msgpack.packb([legacy_normalize_metric(metric, '10.0.0.1')[0] for metric in part],
+                                    use_bin_type=True))
+    return bodies
+
+
+def record_agent(metrics, chunk):
+    bodies = []
+    for part in chunked(metrics, chunk):
+        bodies.append(msgpack.packb([validate(metric, '10.0.0.1') for metric in part], use_bin_type=True))
+    return bodies
+
+
+def legacy_worker(bodies):
+    lines = []
+    for body in bodies:
+        for metric_data in msgpack.unpackb(body, raw=False):
+            point = legacy_build_point(
+                name=metric_data['name'],
+                value=metric_data['value'],
+                tags=metric_data.get('tags', {}),
+                timestamp=metric_data.get('timestamp'),
+                source=metric_data.get('source'),
+                fields=metric_data.get('fields')
+            )
+            lines.append(point.to_line_protocol())
+    return lines
+
+
+def record_worker(bodies):
+    lines = []
+    for body in bodies:
+        lines.extend(encode_line(as_record(item)) for item in msgpack.unpackb(body, raw=False))
+    return lines
+
+
+def cpu_time(fn, *args, repeat=3):
+    """Return (fastest CPU seconds, result) over repeat runs"""
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        result = fn(*args)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=100000, help='metrics per run')
+    parser.add_argument('--tags', type=int, default=3, help='tags per metric')
+    parser.add_argument('--chunk', type=int, default=1000, help='metrics per task body')
+    parser.add_argument('--timestamps', choices=['none', 'iso'], default='none',
+                        help='whether clients send ISO timestamps or leave them to the agent')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    metrics = client_metrics(args.count, args.tags, args.timestamps)
+    results = {}
+    for label, agent, worker in (('legacy', legacy_agent, legacy_worker), ('record', record_agent, record_worker)):
+        agent_seconds, bodies = cpu_time(agent, metrics, args.chunk, repeat=args.repeat)
+        worker_seconds, lines = cpu_time(worker, bodies, repeat=args.repeat)
+        results[label] = {
+            'agent_us_per_metric': agent_seconds / args.count * 1e6,
+            'worker_us_per_metric': worker_seconds / args.count * 1e6,
+            'body_bytes_per_metric': sum(len(body) for body in bodies) / args.count,
+            'line_bytes_per_metric': sum(len(line) + 1 for line in lines) / args.count,
+        }
+
+    print(f"{args.count} metrics, {args.tags} tags, timestamps {args.timestamps}")
+    print(f"{'':<8}{'agent us':>10}{'worker us':>11}{'body bytes':>12}{'line bytes':>12}")
+    for label, result in results.items():
+        print(f"{label:<8}{result['agent_us_per_metric']:>10.2f}{result['worker_us_per_metric']:>11.2f}"
+              f"{result['body_bytes_per_metric']:>12.1f}{result['line_bytes_per_metric']:>12.1f}")
+    legacy, record = results['legacy'], results['record']
+    print(f"speedup: agent {legacy['agent_us_per_metric'] / record['agent_us_per_metric']:.1f}x, "
+          f"worker {legacy['worker_us_per_metric'] / record['worker_us_per_metric']:.1f}x")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
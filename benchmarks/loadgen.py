@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Async load generator for the agent's /metrics and /metrics/batch endpoints
+
+Metrics are drawn from --names metric names, each with --tag-keys tags of
+--tag-values values, so up to names * tag_values ** tag_keys series. With
+--shape zipf a few series receive most of the points, as with real hot
+paths; uniform spreads them evenly.
+
+By default every client sends as fast as the agent answers (closed loop).
+With --rate the clients together send that many requests per second, and
+latency is measured from when each request was due, so a stalled agent
+shows up as latency instead of as a lower send rate.
+
+    python benchmarks/loadgen.py --url http://localhost:8000 --endpoint batch --batch-size 500 --duration 30
+    python benchmarks/loadgen.py --url http://localhost:8000 --rate 2000 --tag-keys 3 --tag-values 20 --shape zipf
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+
+
+class Workload:
+    """Shape of the generated metrics"""
+
+    def __init__(self, names=10, tag_keys=2, tag_values=10, shape='uniform', batch_size=100, prefix='bench',
+                 seed=1):
+        self.names = [f'{prefix}.metric_{index}' for index in range(names)]
+        self.tag_keys = [f'tag_{index}' for index in range(tag_keys)]
+        self.tag_values = [f'value_{index}' for index in range(tag_values)]
+        self.shape = shape
+        self.batch_size = batch_size
+        self.rng = random.Random(seed)
+        # Zipf weights with exponent 1.1 over names and over each tag's values
+        self.name_weights = self._weights(len(self.names))
+        self.value_weights = self._weights(len(self.tag_values))
+
+    def _weights(self, count):
+        if self.shape != 'zipf':
+            return None
+        return [1 / (rank + 1) ** 1.1 for rank in range(count)]
+
+    @property
+    def series(self):
+        return len(self.names) * len(self.tag_values) ** len(self.tag_keys)
+
+    def _choice(self, values, weights):
+        return self.rng.choices(values, weights)[0] if weights else self.rng.choice(values)
+
+    def metric(self):
+        return {
+            'name': self._choice(self.names, self.name_weights),
+            'value': self.rng.random() * 100,
+            'tags': {key: self._choice(self.tag_values, self.value_weights) for key in self.tag_keys},
+            'source': 'loadgen',
+        }
+
+    def request(self, endpoint):
+        """Return (path, body, metric count) of the next request"""
+        if endpoint == 'batch':
+            return '/metrics/batch', {'metrics': [self.metric() for _ in range(self.batch_size)]}, self.batch_size
+        return '/metrics', self.metric(), 1
+
+
+def percentiles(latencies):
+    """p50/p90/p99/max in milliseconds of a list of seconds"""
+    if not latencies:
+        return {'p50_ms': None, 'p90_ms': None, 'p99_ms': None, 'max_ms': None}
+    latencies = sorted(latencies)
+
+    def at(q):
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000
+
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': latencies[-1] * 1000}
+
+
+async def generate(url, workload, endpoint='metrics', concurrency=64, duration=10.0, rate=None, session=None):
+    """Send load to an agent for duration seconds and return throughput and latency figures"""
+    latencies = []
+    statuses = {}
+    totals = {'requests': 0, 'metrics_sent': 0, 'metrics_accepted': 0}
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+    interval = concurrency / rate if rate else 0.0
+    started = time.monotonic()
+    deadline = started + duration
+
+    async def client(index):
+        due = started + interval * index / concurrency
+        while True:
+            if interval:
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                due = time.monotonic()
+            if due >= deadline:
+                return
+            path, body, count = workload.request(endpoint)
+            try:
+                async with session.post(url + path, json=body) as response:
+                    await response.read()
+                    status = response.status
+            except aiohttp.ClientError:
+                status = 'error'
+            latencies.append(time.monotonic() - due)
+            statuses[status] = statuses.get(status, 0) + 1
+            totals['requests'] += 1
+            totals['metrics_sent'] += count
+            if status == 202:
+                totals['metrics_accepted'] += count
+            due += interval
+
+    try:
+        await asyncio.gather(*(client(index) for index in range(concurrency)))
+    finally:
+        if own_session:
+            await session.close()
+    elapsed = time.monotonic() - started
+    return dict(
+        totals,
+        seconds=elapsed,
+        requests_per_second=totals['requests'] / elapsed,
+        metrics_per_second=totals['metrics_accepted'] / elapsed,
+        statuses={str(key): value for key, value in statuses.items()},
+        **percentiles(latencies),
+    )
+
+
+def add_workload_arguments(parser):
+    parser.add_argument('--endpoint', choices=['metrics', 'batch'], default='batch')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--names', type=int, default=10, help='distinct metric names')
+    parser.add_argument('--tag-keys', type=int, default=2, help='tags per metric')
+    parser.add_argument('--tag-values', type=int, default=10, help='distinct values per tag')
+    parser.add_argument('--shape', choices=['uniform', 'zipf'], default='uniform', help='series popularity')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--rate', type=float, help='requests per second across all clients (default: unpaced)')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def workload_from(args):
+    return Workload(names=args.names, tag_keys=args.tag_keys, tag_values=args.tag_values, shape=args.shape,
+                    batch_size=args.batch_size, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='agent base URL')
+    add_workload_arguments(parser)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    workload = workload_from(args)
+    result = asyncio.run(generate(args.url, workload, args.endpoint, args.concurrency, args.duration, args.rate))
+    print(f"{workload.series} series, {result['requests']} requests in {result['seconds']:.1f}s: "
+          f"{result['requests_per_second']:.1f} req/s, {result['metrics_per_second']:.1f} metrics/s accepted, "
+          f"p50 {result['p50_ms']:.2f}ms, p99 {result['p99_ms']:.2f}ms, statuses {result['statuses']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'series': workload.series, 'results': result}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Benchmark decoding /api/metrics query results: FluxRecord tables vs streaming CSV
+
+  records   query_api.query() tables, a dict per record, then one json.dumps (the original path)
+  stream    query_csv rows decoded by flux_csv.iter_metric_rows and encoded by app.encode_metrics
+  columnar  the same rows collected by columnar.ColumnarMetrics and encoded as format=columnar
+  arrow     as columnar, encoded as format=arrow (skipped when pyarrow is not installed)
+
+Each decoder runs in its own subprocess so peak RSS is measured independently
+(reported as the growth over the process peak before decoding). By default
+the response is a synthetic Flux CSV body held in memory. With --influx the
+query runs against the InfluxDB configured by the INFLUXDB_* variables.
+
+    python benchmarks/query_decode.py --rows 50000 --series 20
+    python benchmarks/query_decode.py --influx --rows 50000
+"""
+import argparse
+import codecs
+import csv
+import importlib.util
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+DECODERS = ('records', 'stream', 'columnar', 'arrow')
+
+
+def synthetic_csv(rows, series, annotated):
+    """Write a Flux CSV response with one table per series into a buffer"""
+    body = io.BytesIO()
+    if annotated:
+        body.write(b'#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,double,string,'
+                   b'string,string,string,string,string\n')
+        body.write(b'#group,false,false,true,true,false,false,true,true,true,true,true,true\n')
+        body.write(b'#default,_result,,,,,,,,,,,\n')
+    body.write(b',result,table,_start,_stop,_time,_value,_field,_measurement,button,name,page,source\n')
+    for i in range(rows):
+        table = i % series
+        seconds = i // series % 86400
+        body.write((
+            f',,{table},2024-01-01T00:00:00Z,2024-01-02T00:00:00Z,'
+            f'2024-01-01T{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}.{i % 1000:03d}456789Z,'
+            f'{(i * 7919) % 1000 / 10},value,metrics,button{table % 4},metric_{table % 5},page{table},web-app\n'
+        ).encode('utf-8'))
+    return body.getvalue()
+
+
+def decode_records(body):
+    """The original path: FluxTables of FluxRecords, a dict per record, one json.dumps"""
+    from influxdb_client.client.flux_csv_parser import FluxCsvParser, FluxSerializationMode
+
+    parser = FluxCsvParser(response=io.BytesIO(body), serialization_mode=FluxSerializationMode.tables)
+    list(parser.generator())
+    metrics = []
+    for table in parser.table_list():
+        for record in table.records:
+            values = record.values
+            tags = {}
+            for k, v in values.items():
+                if k not in ['_measurement', '_field', '_time', '_value', '_start', '_stop',
+                             'result', 'table', ''] and not k.startswith('_'):
+                    tags[k] = v
+            metrics.append({
+                'name': values.get('name', ''),
+                'value': float(record.get_value()),
+                'timestamp': record.get_time().isoformat(),
+                'tags': tags,
+                'source': values.get('source', ''),
+            })
+    return len(metrics), len(json.dumps(metrics, sort_keys=True, separators=(',', ':')))
+
+
+def decode_stream(body):
+    """The streaming path: CSV rows to compact tuples to JSON chunks"""
+    from flux_csv import iter_metric_rows
+    from app import encode_metrics
+
+    csv_rows = (row for row in csv.reader(codecs.iterdecode(io.BytesIO(body), 'utf-8')) if row)
+    rows = size = 0
+    for chunk in encode_metrics(iter_metric_rows(csv_rows)):
+        rows += chunk.count('"timestamp"')
+        size += len(chunk)
+    return rows, size
+
+
+def decode_columnar(body, encoding):
+    """The format=columnar / format=arrow path"""
+    from flux_csv import iter_metric_rows
+    from columnar import ColumnarMetrics
+
+    csv_rows = (row for row in csv.reader(codecs.iterdecode(io.BytesIO(body), 'utf-8')) if row)
+    columns = ColumnarMetrics(iter_metric_rows(csv_rows, iso_timestamps=False))
+    encoded = columns.to_arrow() if encoding == 'arrow' else columns.to_json()
+    return len(columns), len(encoded)
+
+
+def decode_influx(decoder, limit):
+    """Run the /api/metrics query against a real InfluxDB with the given decoder"""
+    from influxdb_service import InfluxDB
+
+    influxdb = InfluxDB()
+    query = influxdb.metrics_query(limit=limit)
+    if decoder == 'records':
+        tables = influxdb.query_api.query(query, org=influxdb.org)
+        metrics = [{'value': record.get_value(), 'timestamp': record.get_time().isoformat(),
+                    'tags': dict(record.values)} for table in tables for record in table.records]
+        return len(metrics), len(json.dumps(metrics, default=str))
+    if decoder in ('columnar', 'arrow'):
+        from columnar import ColumnarMetrics
+        columns = ColumnarMetrics(influxdb.iter_metrics(limit=limit, iso_timestamps=False))
+        return len(columns), len(columns.to_arrow() if decoder == 'arrow' else columns.to_json())
+    from app import encode_metrics
+    rows = size = 0
+    for chunk in encode_metrics(influxdb.iter_metrics(limit=limit)):
+        rows += chunk.count('"timestamp"')
+        size += len(chunk)
+    return rows, size
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(args):
+    """Run one decoder in this process and print its result as JSON"""
+    sys.path.insert(0, BACKEND_DIR)
+    if args.influx:
+        # Import the client first so its footprint is not counted as decode memory
+        importlib.import_module('influxdb_service')
+        importlib.import_module('app')
+        baseline = peak_rss_mb()
+        started = time.perf_counter()
+        rows, size = decode_influx(args.child, args.rows)
+    else:
+        body = synthetic_csv(args.rows, args.series, annotated=args.child == 'records')
+        importlib.import_module('influxdb_client.client.flux_csv_parser')
+        importlib.import_module('app')
+        baseline = peak_rss_mb()
+        started = time.perf_counter()
+        if args.child == 'records':
+            rows, size = decode_records(body)
+        elif args.child == 'stream':
+            rows, size = decode_stream(body)
+        else:
+            rows, size = decode_columnar(body, args.child)
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        'rows': rows,
+        'output_bytes': size,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed,
+        'peak_rss_growth_mb': peak_rss_mb() - baseline,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000, help='rows to decode (the query limit with --influx)')
+    parser.add_argument('--series', type=int, default=20)
+    parser.add_argument('--influx', action='store_true', help='query the InfluxDB from INFLUXDB_* instead')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', choices=DECODERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    # The backend modules read their config at import; keep them off the network
+    env = dict(os.environ, LIVE_CHANNEL='', QUERY_CACHE_MAX_BYTES='0')
+    results = {}
+    for decoder in DECODERS:
+        if decoder == 'arrow' and importlib.util.find_spec('pyarrow') is None:
+            continue
+        command = [sys.executable, os.path.abspath(__file__), '--child', decoder,
+                   '--rows', str(args.rows), '--series', str(args.series)]
+        if args.influx:
+            command.append('--influx')
+        output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+        results[decoder] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"{'decoder':<10}{'rows':>10}{'rows/s':>12}{'seconds':>10}{'peak RSS +MB':>14}{'output MB':>11}")
+    for decoder, result in results.items():
+        print(f"{decoder:<10}{result['rows']:>10}{result['rows_per_second']:>12.0f}{result['seconds']:>10.3f}"
+              f"{result['peak_rss_growth_mb']:>14.1f}{result['output_bytes'] / 1e6:>11.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
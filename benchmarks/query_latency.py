@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Latency of each backend query endpoint
+
+Picks metric names (and a tag key of the first one) from the backend itself,
+then requests every query --iterations times with --concurrency in flight.
+The first request of a query is reported separately as ``first_ms``, since
+it runs against a cold query cache; percentiles cover the rest.
+
+    python benchmarks/query_latency.py --url http://localhost:5001 --iterations 50
+    python benchmarks/query_latency.py --url http://localhost:5001 --name bench.metric_0 --output queries.json
+"""
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import quote, urlencode
+
+import aiohttp
+
+from loadgen import percentiles
+
+
+async def get_json(session, url):
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def build_queries(session, url, names=None):
+    """Return {label: (method, path, body)} covering every query endpoint"""
+    names = names or (await get_json(session, f'{url}/api/metrics/names'))[:5]
+    if not names:
+        raise SystemExit('The backend has no metrics yet; ingest some first or pass --name')
+    name = names[0]
+    tag_keys = [key for key in await get_json(session, f'{url}/api/metrics/{quote(name, safe="")}/tags')
+                if key != 'source']
+
+    def aggregate(**params):
+        return '/api/metrics/aggregate?' + urlencode(dict({'name': name}, **params), doseq=True)
+
+    queries = {
+        'raw json': ('GET', '/api/metrics?' + urlencode({'name': name, 'limit': 1000}), None),
+        'raw columnar': ('GET', '/api/metrics?' + urlencode({'name': name, 'limit': 1000, 'format': 'columnar'}),
+                         None),
+        'aggregate 1m mean': ('GET', aggregate(window='1m'), None),
+        'aggregate 5m max': ('GET', aggregate(window='5m', aggregate='max'), None),
+        'aggregate 1h p95': ('GET', aggregate(window='1h', aggregate='p95'), None),
+        'aggregate 1d mean': ('GET', aggregate(window='1d'), None),
+        'aggregate 1m rate': ('GET', aggregate(window='1m', aggregate='rate'), None),
+        'aggregate names': ('GET', '/api/metrics/aggregate?' + urlencode({'name': names, 'window': '5m'}, doseq=True),
+                            None),
+        'aggregate batch': ('POST', '/api/metrics/aggregate/batch',
+                            {'queries': [{'name': each, 'window': '5m'} for each in names]}),
+        'names': ('GET', '/api/metrics/names', None),
+        'name prefix': ('GET', '/api/metrics/names?' + urlencode({'prefix': name[:3]}), None),
+        'tag keys': ('GET', f'/api/metrics/{quote(name, safe="")}/tags', None),
+    }
+    if tag_keys:
+        queries['aggregate group_by'] = ('GET', aggregate(window='5m', group_by=tag_keys[0]), None)
+        queries['aggregate top 3'] = ('GET', aggregate(window='5m', group_by=tag_keys[0], top=3), None)
+        queries['tag values'] = ('GET', f'/api/metrics/{quote(name, safe="")}/tags/{quote(tag_keys[0], safe="")}'
+                                        f'/values', None)
+    return queries
+
+
+async def request(session, url, method, path, body):
+    started = time.perf_counter()
+    async with session.request(method, url + path, json=body) as response:
+        payload = await response.read()
+        return time.perf_counter() - started, response.status, len(payload)
+
+
+async def measure(url, iterations=20, concurrency=4, names=None, session=None):
+    """Return {label: latency summary} for every query"""
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+    try:
+        queries = await build_queries(session, url, names)
+        results = {}
+        for label, (method, path, body) in queries.items():
+            first, status, size = await request(session, url, method, path, body)
+            latencies = []
+            statuses = {str(status): 1}
+            remaining = iter(range(iterations - 1))
+
+            async def worker():
+                for _ in remaining:
+                    elapsed, status, _ = await request(session, url, method, path, body)
+                    latencies.append(elapsed)
+                    statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            results[label] = dict(path=path, first_ms=first * 1000, response_bytes=size, statuses=statuses,
+                                  **percentiles(latencies))
+        return results
+    finally:
+        if own_session:
+            await session.close()
+
+
+def print_table(results):
+    print(f"{'query':<22}{'first ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'bytes':>10}  statuses")
+    for label, result in results.items():
+        print(f"{label:<22}{result['first_ms']:>10.1f}{result['p50_ms'] or 0:>10.1f}{result['p99_ms'] or 0:>10.1f}"
+              f"{result['response_bytes']:>10}  {result['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5001', help='backend base URL')
+    parser.add_argument('--name', action='append', help='metric name to query (repeatable; default: from the backend)')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    results = asyncio.run(measure(args.url, args.iterations, args.concurrency, args.name))
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
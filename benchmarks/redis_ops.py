@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Benchmark Redis operations per ingested metric, before and after fire-and-forget ingest
+
+Runs a Celery worker subprocess with no-op ingest tasks under two configurations:
+
+  legacy          JSON payloads, Redis result backend, results stored (the original setup)
+  fire_and_forget msgpack payloads, no result backend, acks_late with prefetch tuning
+
+and counts every Redis command issued by the producer and the worker while N
+metrics flow through. By default Redis is an in-process fakeredis whose
+command dispatch is instrumented. With --redis-url the counts come from
+INFO commandstats on a real server.
+
+    python benchmarks/redis_ops.py --metrics 2000
+    python benchmarks/redis_ops.py --redis-url redis://localhost:6379/15
+"""
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import redis
+
+MODES = ('legacy', 'fire_and_forget')
+
+# When imported by the worker subprocess (celery -A redis_ops), build the app for BENCH_MODE
+if os.getenv('BENCH_MODE'):
+    from celery import Celery
+
+    _url = os.environ['BENCH_REDIS_URL']
+    if os.environ['BENCH_MODE'] == 'legacy':
+        celery_app = Celery('bench', broker=_url, backend=_url)
+        celery_app.conf.update(task_serializer='json', accept_content=['json'], result_serializer='json')
+    else:
+        celery_app = Celery('bench', broker=_url)
+        celery_app.conf.update(
+            task_serializer='msgpack',
+            accept_content=['msgpack', 'json'],
+            task_ignore_result=True,
+            task_acks_late=True,
+            worker_prefetch_multiplier=4,
+        )
+
+    @celery_app.task(name='process_metric')
+    def process_metric(metric_data):
+        return {'status': 'success'}
+
+
+class CommandCounter:
+    """Count commands executed by an in-process fakeredis server"""
+
+    def __init__(self, port):
+        from fakeredis import TcpFakeServer
+        from fakeredis._socket._base import BaseFakeSocket
+
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        original = BaseFakeSocket._process_command
+        counter = self
+
+        def counting(sock, fields):
+            if fields:
+                with counter._lock:
+                    counter.counts[fields[0].decode().upper()] += 1
+            return original(sock, fields)
+
+        BaseFakeSocket._process_command = counting
+        server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return collections.Counter(self.counts)
+
+
+class CommandStats:
+    """Count commands on a real Redis server through INFO commandstats"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def reset(self):
+        self.client.config_resetstat()
+
+    def snapshot(self):
+        stats = self.client.info('commandstats')
+        return collections.Counter({key.split('_', 1)[1].upper(): value['calls'] for key, value in stats.items()})
+
+
+def make_producer(mode, url):
+    from celery import Celery
+    if mode == 'legacy':
+        app = Celery('bench_agent', broker=url, backend=url)
+        app.conf.update(task_serializer='json', accept_content=['json'], result_serializer='json')
+    else:
+        app = Celery('bench_agent', broker=url)
+        app.conf.update(task_serializer='msgpack', accept_content=['msgpack', 'json'], task_ignore_result=True)
+    return app
+
+
+def run_mode(mode, url, counter, client, metrics):
+    client.flushdb()
+    env = dict(os.environ, BENCH_MODE=mode, BENCH_REDIS_URL=url)
+    worker = subprocess.Popen(
+        [sys.executable, '-m', 'celery', '-A', 'redis_ops', 'worker', '--pool', 'solo', '--loglevel', 'warning',
+         '--without-heartbeat', '--without-gossip', '--without-mingle'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        time.sleep(3)
+        producer = make_producer(mode, url)
+        payload = {'name': 'button_clicks', 'value': 1.0, 'tags': {'button': 'submit', 'page': 'home'},
+                   'timestamp': '2024-01-01T00:00:00', 'source': 'web-app'}
+        # Measure a quiet interval first so idle polling can be subtracted
+        counter.reset()
+        time.sleep(2)
+        idle_rate = sum(counter.snapshot().values()) / 2
+
+        counter.reset()
+        started = time.monotonic()
+        for _ in range(metrics):
+            producer.send_task('process_metric', args=[payload])
+        while client.llen('celery') or client.hlen('unacked'):
+            time.sleep(0.1)
+        time.sleep(1)
+        elapsed = time.monotonic() - started
+        counts = counter.snapshot()
+    finally:
+        worker.terminate()
+        worker.wait()
+
+    total = sum(counts.values()) - idle_rate * elapsed
+    result_keys = len(client.keys('celery-task-meta-*'))
+    return {
+        'commands': total,
+        'commands_per_metric': total / metrics,
+        'result_keys': result_keys,
+        'top_commands': dict(counts.most_common(8)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--metrics', type=int, default=2000)
+    parser.add_argument('--redis-url', help='use a real Redis (the database is flushed) instead of fakeredis')
+    parser.add_argument('--fakeredis-port', type=int, default=16400)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.redis_url:
+        url = args.redis_url
+        client = redis.Redis.from_url(url)
+        counter = CommandStats(client)
+    else:
+        url = f'redis://127.0.0.1:{args.fakeredis_port}/0'
+        counter = CommandCounter(args.fakeredis_port)
+        client = redis.Redis.from_url(url)
+
+    results = {mode: run_mode(mode, url, counter, client, args.metrics) for mode in MODES}
+
+    print(f"{'mode':<18}{'redis ops':>12}{'ops/metric':>12}{'result keys':>13}")
+    for mode, result in results.items():
+        print(f"{mode:<18}{result['commands']:>12.0f}{result['commands_per_metric']:>12.2f}{result['result_keys']:>13}")
+    for mode, result in results.items():
+        print(f"{mode} top commands: {result['top_commands']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'metrics': args.metrics, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Head-to-head benchmark of the storage backends: InfluxDB and the embedded local store
+
+Writes the same synthetic points to each backend through the storage
+interface (encode_point + write_batch, in --batch-size batches), then runs
+the same queries against both:
+
+  ingest    points/s through write_batch, and the local store's final flush on close
+  disk      bytes per point: the local store's directory, and InfluxDB's with --influxdb-data-dir
+  queries   latency of raw reads, aggregates and name listing over the written range
+
+Points are regular --interval samples of a random walk rounded to 2 decimals,
+over --series series (--names names times hosts), ending now. The local store
+is written to a temporary directory (or --path) and always runs; InfluxDB
+runs with --influxdb, using the INFLUXDB_* settings. Its metric names are
+prefixed with the run's start time, so runs do not read each other's points.
+
+    python benchmarks/storage.py --points 1000000 --series 200
+    python benchmarks/storage.py --influxdb --influxdb-data-dir /var/lib/influxdb2 --output storage.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+sys.path.insert(0, BACKEND_DIR)
+
+from loadgen import percentiles  # noqa: E402
+from local_store import LocalStore  # noqa: E402
+from metric_record import Metric  # noqa: E402
+
+
+def directory_bytes(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, file_name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def synthetic_metrics(args, prefix):
+    """Batches of Metrics, interleaving series in time order as agents deliver them"""
+    rng = np.random.default_rng(args.seed)
+    per_series = args.points // args.series
+    interval_ns = int(args.interval * 10 ** 9)
+    end = time.time_ns() // interval_ns * interval_ns
+    times = end - interval_ns * np.arange(per_series - 1, -1, -1, dtype=np.int64)
+    walks = np.round(np.abs(100 + np.cumsum(rng.normal(0, 1, (args.series, per_series)), axis=1)), 2)
+    series = [
+        (f'{prefix}{index % args.names}', {'host': f'host-{index // args.names}'}) for index in range(args.series)
+    ]
+    batch = []
+    for position, timestamp in enumerate(times.tolist()):
+        for index, (name, tags) in enumerate(series):
+            batch.append(Metric(name, float(walks[index, position]), tags, timestamp, 'bench'))
+            if len(batch) == args.batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def ingest(storage, args, prefix):
+    points = 0
+    started = time.perf_counter()
+    for batch in synthetic_metrics(args, prefix):
+        if not storage.write_batch([storage.encode_point(metric) for metric in batch]):
+            raise SystemExit('write_batch failed')
+        points += len(batch)
+    return points, time.perf_counter() - started
+
+
+def queries(args, prefix):
+    """{label: call(storage)} covering each query the backend serves"""
+    start = f'-{int(args.points // args.series * args.interval) + 60}s'
+    name = f'{prefix}0'
+    names = [f'{prefix}{index}' for index in range(args.names)]
+
+    def aggregate(**options):
+        return lambda storage: storage.fetch_aggregated_metrics(start_time=start, **options)
+
+    return {
+        'raw 1000': lambda storage: list(storage.iter_metrics(name=name, start_time=start, limit=1000)),
+        'raw all': lambda storage: list(storage.iter_metrics(name=name, start_time=start, limit=10 ** 9)),
+        'aggregate 1m mean': aggregate(name=name, window='1m'),
+        'aggregate 1h p95': aggregate(name=name, window='1h', aggregate_fn='p95'),
+        'aggregate 5m max group_by': aggregate(name=name, window='5m', aggregate_fn='max', group_by=['host']),
+        'aggregate names 5m': aggregate(name=names, window='5m'),
+        'names': lambda storage: storage.get_metric_names(),
+    }
+
+
+def measure_queries(storage, args, prefix):
+    results = {}
+    for label, call in queries(args, prefix).items():
+        latencies = []
+        rows = None
+        for _ in range(args.iterations):
+            started = time.perf_counter()
+            rows = call(storage)
+            latencies.append(time.perf_counter() - started)
+        results[label] = dict(percentiles(latencies), rows=len(rows))
+    return results
+
+
+def run_local(args, prefix):
+    path = args.path or tempfile.mkdtemp(prefix='theia-store-')
+    storage = LocalStore(path, chunk_points=args.chunk_points)
+    points, seconds = ingest(storage, args, prefix)
+    started = time.perf_counter()
+    storage.close()
+    flush_seconds = time.perf_counter() - started
+    size = directory_bytes(path)
+    storage = LocalStore(path)
+    result = {
+        'points': points, 'ingest_seconds': seconds, 'points_per_second': points / seconds,
+        'flush_seconds': flush_seconds, 'disk_bytes': size, 'bytes_per_point': size / points,
+        'queries': measure_queries(storage, args, prefix),
+    }
+    if not args.path and not args.keep:
+        shutil.rmtree(path)
+    return result
+
+
+def run_influxdb(args, prefix):
+    from influxdb_service import InfluxDB
+    storage = InfluxDB()
+    before = directory_bytes(args.influxdb_data_dir) if args.influxdb_data_dir else None
+    points, seconds = ingest(storage, args, prefix)
+    result = {'points': points, 'ingest_seconds': seconds, 'points_per_second': points / seconds}
+    if before is not None:
+        # Measured before InfluxDB compacts its write-ahead log into TSM files, so an upper bound
+        size = directory_bytes(args.influxdb_data_dir) - before
+        result.update(disk_bytes=size, bytes_per_point=size / points)
+    result['queries'] = measure_queries(storage, args, prefix)
+    storage.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--series', type=int, default=200)
+    parser.add_argument('--names', type=int, default=10, help='metric names; series are spread over hosts')
+    parser.add_argument('--interval', type=float, default=10.0, help='seconds between points of a series')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=20, help='runs of each query')
+    parser.add_argument('--chunk-points', type=int, default=1024, help="the local store's LOCAL_STORE_CHUNK_POINTS")
+    parser.add_argument('--path', help='local store directory (default: a temporary one, removed afterwards)')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary local store')
+    parser.add_argument('--influxdb', action='store_true', help='also benchmark InfluxDB (INFLUXDB_* settings)')
+    parser.add_argument('--influxdb-data-dir', help="InfluxDB's engine directory, to measure its disk use")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    prefix = f'bench.storage.{int(time.time())}.m'
+    report = {'local': run_local(args, prefix)}
+    if args.influxdb:
+        report['influxdb'] = run_influxdb(args, prefix)
+
+    for backend, result in report.items():
+        disk = f"{result['bytes_per_point']:.2f} B/point" if 'bytes_per_point' in result else 'disk not measured'
+        print(f"{backend}: {result['points_per_second']:,.0f} points/s, {disk}")
+        print(f"  {'query':<28}{'p50 ms':>9}{'p99 ms':>9}{'rows':>9}")
+        for label, latency in result['queries'].items():
+            print(f"  {label:<28}{latency['p50_ms']:>9.2f}{latency['p99_ms']:>9.2f}{latency['rows']:>9}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
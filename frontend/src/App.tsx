@@ -2,7 +2,13 @@ import React, { useState, useEffect } from 'react';
 import './App.css';
 import MetricDashboard from './components/MetricDashboard';
 import MetricSelector from './components/MetricSelector';
-import { fetchMetricNames, fetchAggregatedMetrics } from './services/api';
+import {
+  fetchMetricNames,
+  fetchAggregatedMetrics,
+  subscribeAggregatedMetrics,
+  mergeBuckets,
+  BucketUpdate,
+} from './services/api';
 
 interface MetricData {
   name: string;
@@ -26,8 +32,20 @@ function App() {
   useEffect(() => {
     if (selectedMetrics.length > 0) {
       loadMetricsData();
-      const interval = setInterval(loadMetricsData, 5000); // Refresh every 5 seconds
-      return () => clearInterval(interval);
+      // Live updates arrive over server-sent events; polling then only reconciles
+      const unsubscribes = typeof EventSource === 'undefined' ? [] : selectedMetrics.map((metricName: string) =>
+        subscribeAggregatedMetrics(metricName, timeWindow, aggregateFunction, (update: BucketUpdate) =>
+          setMetricsData((prev: Record<string, MetricData[]>) => ({
+            ...prev,
+            [metricName]: mergeBuckets(prev[metricName] || [], update.buckets, update.range_start),
+          }))
+        )
+      );
+      const interval = setInterval(loadMetricsData, unsubscribes.length > 0 ? 60000 : 5000);
+      return () => {
+        clearInterval(interval);
+        unsubscribes.forEach((unsubscribe: () => void) => unsubscribe());
+      };
     }
   }, [selectedMetrics, timeWindow, aggregateFunction]);
 
@@ -44,10 +62,14 @@ function App() {
 
   const loadMetricsData = async () => {
     try {
+      // All selected metrics in one request, split by name
+      const metrics = await fetchAggregatedMetrics(selectedMetrics, timeWindow, aggregateFunction);
       const data: Record<string, MetricData[]> = {};
       for (const metricName of selectedMetrics) {
-        const metrics = await fetchAggregatedMetrics(metricName, timeWindow, aggregateFunction);
-        data[metricName] = metrics;
+        data[metricName] = [];
+      }
+      for (const row of metrics) {
+        data[row.name]?.push(row);
       }
       setMetricsData(data);
     } catch (error) {
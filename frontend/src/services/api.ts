@@ -16,28 +16,126 @@ export interface AggregatedMetric {
   time_bucket: string;
   avg_value: number;
   count: number;
+  // Values of the group_by tags, when the query grouped by any
+  tags?: Record<string, string | null>;
 }
 
+export interface AggregateOptions {
+  // Split each metric into one series per combination of these tags
+  groupBy?: string[];
+  // Tag filters: a value, !value, ~regex or !~regex; a list matches any of them
+  tags?: Record<string, string | string[]>;
+  // Keep only the top N series, ranked by topBy (mean, sum, max, min or last) of their buckets
+  top?: number;
+  topBy?: string;
+}
+
+interface SeriesState {
+  rows: AggregatedMetric[];
+  since?: string;
+  etag?: string;
+}
+
+// Last known series per query; each poll only fetches buckets from the server's
+// X-Next-Since cursor onwards and merges them in
+const seriesStates = new Map<string, SeriesState>();
+
+const bucketKey = (row: AggregatedMetric) =>
+  `${row.name}|${JSON.stringify(row.tags || {})}|${Date.parse(row.time_bucket)}`;
+
+export const mergeBuckets = (
+  rows: AggregatedMetric[],
+  delta: AggregatedMetric[],
+  rangeStart?: string
+): AggregatedMetric[] => {
+  const merged = new Map<string, AggregatedMetric>();
+  for (const row of rows) {
+    merged.set(bucketKey(row), row);
+  }
+  for (const row of delta) {
+    merged.set(bucketKey(row), row);
+  }
+  const start = rangeStart ? Date.parse(rangeStart) : -Infinity;
+  return Array.from(merged.values())
+    .filter((row) => Date.parse(row.time_bucket) >= start)
+    .sort((a, b) => Date.parse(a.time_bucket) - Date.parse(b.time_bucket));
+};
+
 export const fetchMetrics = async (params?: {
   name?: string;
   source?: string;
   start_time?: string;
   end_time?: string;
+  since?: string;
   limit?: number;
 }): Promise<Metric[]> => {
   const response = await axios.get(`${API_BASE_URL}/api/metrics`, { params });
   return response.data;
 };
 
+// One request for any number of metrics; rows carry their name (and group_by tags)
 export const fetchAggregatedMetrics = async (
-  name?: string,
+  names?: string | string[],
   window: string = '1m',
-  aggregate: string = 'mean'
+  aggregate: string = 'mean',
+  options: AggregateOptions = {}
 ): Promise<AggregatedMetric[]> => {
+  const nameList = names === undefined ? [] : ([] as string[]).concat(names).sort();
+  const key = JSON.stringify([nameList, window, aggregate, options]);
+  const state = seriesStates.get(key);
+
+  const params = new URLSearchParams({ window, aggregate });
+  nameList.forEach((name: string) => params.append('name', name));
+  if (options.groupBy && options.groupBy.length > 0) {
+    params.set('group_by', options.groupBy.join(','));
+  }
+  Object.entries(options.tags || {}).forEach(([tag, values]) =>
+    ([] as string[]).concat(values).forEach((value: string) => params.append(`tag.${tag}`, value))
+  );
+  if (options.top) {
+    params.set('top', String(options.top));
+    params.set('top_by', options.topBy || 'mean');
+  }
+  if (state?.since) {
+    params.set('since', state.since);
+  }
+
   const response = await axios.get(`${API_BASE_URL}/api/metrics/aggregate`, {
-    params: { name, window, aggregate },
+    params,
+    headers: state?.etag ? { 'If-None-Match': state.etag } : undefined,
+    validateStatus: (status) => status === 200 || status === 304,
   });
-  return response.data;
+  if (response.status === 304 && state) {
+    return state.rows;
+  }
+  const rows = state
+    ? mergeBuckets(state.rows, response.data, response.headers['x-range-start'])
+    : response.data;
+  seriesStates.set(key, {
+    rows,
+    since: response.headers['x-next-since'],
+    etag: response.headers['etag'],
+  });
+  return rows;
+};
+
+export interface BucketUpdate {
+  buckets: AggregatedMetric[];
+  range_start: string;
+}
+
+// Subscribe to live bucket updates for one series; merge each update into the rows
+// held for it with mergeBuckets. Returns a function that closes the stream.
+export const subscribeAggregatedMetrics = (
+  name: string,
+  window: string,
+  aggregate: string,
+  onUpdate: (update: BucketUpdate) => void
+): (() => void) => {
+  const params = new URLSearchParams({ name, window, aggregate });
+  const source = new EventSource(`${API_BASE_URL}/api/metrics/stream?${params}`);
+  source.onmessage = (event: MessageEvent) => onUpdate(JSON.parse(event.data));
+  return () => source.close();
 };
 
 export const fetchMetricNames = async (): Promise<string[]> => {
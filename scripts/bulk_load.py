@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+Bulk load historical metrics into InfluxDB, or generate synthetic ones for load testing
+
+  load      stream CSV, NDJSON or line protocol files, optionally gzipped, into InfluxDB
+  generate  write a synthetic dataset of a chosen cardinality to InfluxDB, or to a file
+
+Input is read as a stream: gzipped files are decompressed on the fly and
+plain files are memory-mapped. Metrics are encoded straight to line
+protocol and written in batches by a pool of concurrent writers. With
+--checkpoint, the input position up to which every batch has been written
+is saved as the load goes, and rerunning with the same checkpoint resumes
+from there.
+
+    python scripts/bulk_load.py load history.csv.gz recent.lp --writers 8 --checkpoint backfill.json
+    python scripts/bulk_load.py generate --metrics 20 --tag-keys 2 --tag-values 50 --duration 7d --interval 60s
+    python scripts/bulk_load.py generate --metrics 5 --duration 1d --output synthetic.lp.gz
+"""
+import argparse
+import contextlib
+import csv
+import gzip
+import json
+import mmap
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+# Add backend directory to path to import app modules, and the agent's for its line protocol parser
+# When running in Docker, backend is at /app, the agent at /agent, scripts are at /scripts
+if os.path.exists("/app"):
+    # Running in Docker
+    sys.path.insert(0, "/app")
+    sys.path.append("/agent")
+else:
+    # Running locally
+    backend_path = os.path.join(os.path.dirname(__file__), "..", "backend")
+    if backend_path not in sys.path:
+        sys.path.insert(0, backend_path)
+    sys.path.append(os.path.join(os.path.dirname(__file__), "..", "agent"))
+
+from flux_queries import parse_duration  # noqa: E402
+from line_protocol import PRECISIONS, parse_line  # noqa: E402
+from metric_record import Metric, encode_line, escape, format_float, validate  # noqa: E402
+
+FORMATS = {
+    ".csv": "csv",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".json": "ndjson",
+    ".lp": "line",
+    ".line": "line",
+    ".txt": "line",
+}
+
+
+def input_format(path, default=None):
+    """The format of an input file, from --format or its extension (ignoring .gz)"""
+    if default:
+        return default
+    base = path[:-3] if path.endswith(".gz") else path
+    extension = os.path.splitext(base)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Cannot tell the format of {path}; use --format")
+    return FORMATS[extension]
+
+
+@contextlib.contextmanager
+def open_input(path):
+    """A seekable binary reader with readline: gzip decompressed on the fly, anything else memory-mapped
+
+    Offsets are positions in the uncompressed data, so a gzip file resumes by
+    decompressing up to its offset without parsing the lines before it.
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            yield f
+        return
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # An empty file cannot be mapped
+            yield f
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def integer_timestamp(metric, multiplier):
+    """Scale an integer timestamp from the input precision to nanoseconds"""
+    timestamp = metric.get("timestamp")
+    if type(timestamp) is int:
+        metric["timestamp"] = timestamp * multiplier
+    elif isinstance(timestamp, str) and timestamp.isdigit():
+        metric["timestamp"] = int(timestamp) * multiplier
+    return metric
+
+
+def csv_parser(header, precision):
+    """Parse CSV rows with a name and value column, optional timestamp and source, and tags in the rest
+
+    Each row must be on one line; quoted newlines are not supported.
+    """
+    columns = next(csv.reader([header]))
+    if "name" not in columns or "value" not in columns:
+        raise ValueError("CSV header must have name and value columns")
+    multiplier = PRECISIONS[precision]
+
+    def parse(line):
+        row = next(csv.reader([line]))
+        if len(row) != len(columns):
+            raise ValueError(f"Expected {len(columns)} columns, got {len(row)}")
+        metric = {"tags": {}}
+        for column, cell in zip(columns, row):
+            if column in ("name", "value", "timestamp", "source"):
+                metric[column] = cell or None
+            elif cell:
+                metric["tags"][column] = cell
+        return [validate(integer_timestamp(metric, multiplier))]
+
+    return parse
+
+
+def ndjson_parser(precision):
+    """Parse one JSON object per line, in the shape POST /metrics accepts"""
+    multiplier = PRECISIONS[precision]
+
+    def parse(line):
+        try:
+            metric = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        if type(metric) is dict:
+            integer_timestamp(metric, multiplier)
+        return [validate(metric)]
+
+    return parse
+
+
+def line_parser(precision):
+    def parse(line):
+        return parse_line(line, precision=precision)
+
+    return parse
+
+
+def client_line(metric):
+    """Encode a Metric as line protocol the way a client sends it, so load and /write read it back as is"""
+    tags = dict(metric.tags)
+    if metric.source:
+        tags["source"] = metric.source
+    tag_text = "".join([f",{escape(key)}={escape(value)}" for key, value in sorted(tags.items()) if key and value])
+    return f"{escape(metric.name)}{tag_text} value={format_float(metric.value)} {metric.timestamp}"
+
+
+class Loader:
+    """Write batches of line protocol with a pool of writers, and track how far the input is stored
+
+    Batches are submitted in input order, each with the input position after
+    its last line. They finish out of order, so the checkpoint only moves to
+    the position of the last batch that every earlier batch has finished
+    before. At most two batches per writer are in flight, which bounds memory
+    however fast the input is read.
+    """
+
+    def __init__(self, write, writers=4, save=None, checkpoint_interval=5.0, report_interval=5.0, written=0,
+                 rejected=0):
+        self.write = write
+        self.save = save
+        self.checkpoint_interval = checkpoint_interval
+        self.report_interval = report_interval
+        self.executor = ThreadPoolExecutor(writers, thread_name_prefix="bulk-writer")
+        self.slots = threading.BoundedSemaphore(writers * 2)
+        self.lock = threading.Lock()
+        self.in_flight = deque()  # [position, points, done]
+        self.position = None
+        # Counts carry on from a checkpoint; the rate covers this run only
+        self.written = self.resumed = written
+        self.rejected = rejected
+        self.error = None
+        self.started = time.monotonic()
+        self.last_report = self.last_checkpoint = self.started
+
+    def submit(self, lines, position):
+        """Queue a batch for writing; returns False without queueing it once a write has failed"""
+        self.slots.acquire()
+        if self.error is not None:
+            self.slots.release()
+            return False
+        entry = [position, len(lines), False]
+        with self.lock:
+            self.in_flight.append(entry)
+        self.executor.submit(self._write, "\n".join(lines), entry)
+        self.tick()
+        return True
+
+    def _write(self, body, entry):
+        try:
+            self.write(body)
+        except Exception as e:
+            with self.lock:
+                self.error = self.error or e
+        else:
+            with self.lock:
+                entry[2] = True
+                while self.in_flight and self.in_flight[0][2]:
+                    position, points, _ = self.in_flight.popleft()
+                    self.position = position
+                    self.written += points
+        finally:
+            self.slots.release()
+
+    def tick(self):
+        """Report progress and save the checkpoint when their intervals are due"""
+        now = time.monotonic()
+        if self.report_interval and now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.report()
+        if self.save is not None and now - self.last_checkpoint >= self.checkpoint_interval:
+            self.last_checkpoint = now
+            self.checkpoint()
+
+    def checkpoint(self, complete=False):
+        with self.lock:
+            position, written = self.position, self.written
+        if self.save is not None and (position is not None or complete):
+            self.save(position, written, self.rejected, complete)
+
+    def report(self):
+        with self.lock:
+            written = self.written
+        elapsed = time.monotonic() - self.started
+        rate = (written - self.resumed) / elapsed if elapsed else 0
+        print(f"{written} points written, {rate:.0f} points/s, {self.rejected} rejected")
+
+    def close(self, complete=True):
+        """Wait for every batch and save the final checkpoint; returns the first write error, if any"""
+        self.executor.shutdown(wait=True)
+        self.checkpoint(complete=complete and self.error is None)
+        self.report()
+        return self.error
+
+
+def influx_writer(retries):
+    """A write function for Loader sending line protocol to InfluxDB, with exponential backoff between retries"""
+    from influxdb_service import InfluxDB
+
+    influxdb = InfluxDB()
+
+    def write(body):
+        for attempt in range(retries + 1):
+            try:
+                influxdb.write_api.write(bucket=influxdb.bucket, record=body)
+                return
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"Error writing batch, retrying: {e}")
+                time.sleep(0.5 * 2 ** attempt)
+
+    return write
+
+
+def read_checkpoint(path, inputs):
+    """Return (file index, offset, line, points, rejected, complete) to resume from"""
+    if not path or not os.path.exists(path):
+        return 0, 0, 0, 0, 0, False
+    with open(path) as f:
+        state = json.load(f)
+    if state["inputs"] != inputs:
+        raise SystemExit(f"Checkpoint {path} is for other inputs: {', '.join(state['inputs'])}")
+    return (inputs.index(state["file"]) if state["file"] else 0, state["offset"], state["line"],
+            state["points"], state["rejected"], state["complete"])
+
+
+def checkpoint_writer(path, inputs):
+    """A save function for Loader; writes to a temporary file and renames it, so a crash never leaves half a checkpoint"""
+    def save(position, points, rejected, complete):
+        file, offset, line = position or (None, 0, 0)
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({
+                "inputs": inputs, "file": file, "offset": offset, "line": line, "points": points,
+                "rejected": rejected, "complete": complete,
+            }, f)
+        os.replace(temporary, path)
+
+    return save
+
+
+def load(args):
+    inputs = [os.path.abspath(path) for path in args.inputs]
+    first, offset, line_number, points, rejected, complete = read_checkpoint(args.checkpoint, inputs)
+    if complete:
+        print(f"Checkpoint {args.checkpoint} says the load is complete: {points} points written")
+        return
+    if args.checkpoint and (first or offset):
+        print(f"Resuming {inputs[first]} at line {line_number + 1}, after {points} points")
+
+    write = (lambda body: None) if args.dry_run else influx_writer(args.retries)
+    save = checkpoint_writer(args.checkpoint, inputs) if args.checkpoint and not args.dry_run else None
+    loader = Loader(write, writers=args.writers, save=save, checkpoint_interval=args.checkpoint_interval,
+                    report_interval=args.report_interval, written=points, rejected=rejected)
+    errors_shown = 0
+
+    batch = []
+    interrupted = False
+    try:
+        for index in range(first, len(inputs)):
+            if loader.error is not None:
+                break
+            path = inputs[index]
+            fmt = input_format(path, args.format)
+            with open_input(path) as reader:
+                if fmt == "csv":
+                    header = reader.readline().decode("utf-8").rstrip("\r\n")
+                    parse = csv_parser(header, args.precision)
+                elif fmt == "ndjson":
+                    parse = ndjson_parser(args.precision)
+                else:
+                    parse = line_parser(args.precision)
+                if index == first and offset:
+                    reader.seek(offset)
+                else:
+                    line_number = 1 if fmt == "csv" else 0
+
+                for raw in iter(reader.readline, b""):
+                    line_number += 1
+                    line = raw.decode("utf-8").rstrip("\r\n")
+                    if not line.strip():
+                        continue
+                    try:
+                        lines = [encode_line(metric) for metric in parse(line)]
+                    except (ValueError, TypeError) as e:
+                        loader.rejected += 1
+                        if errors_shown < args.max_errors:
+                            errors_shown += 1
+                            print(f"{path}:{line_number}: {e}")
+                        continue
+                    batch.extend(lines)
+                    if len(batch) >= args.batch_size:
+                        if not loader.submit(batch, (path, reader.tell(), line_number)):
+                            break
+                        batch = []
+                if batch and not loader.submit(batch, (path, reader.tell(), line_number)):
+                    break
+                batch = []
+    except KeyboardInterrupt:
+        print("Interrupted, waiting for the batches in flight")
+        interrupted = True
+    finished(loader.close(complete=not interrupted), args.checkpoint)
+
+
+def finished(error, checkpoint=None):
+    if error is not None:
+        resume = f"; rerun with --checkpoint {checkpoint} to resume" if checkpoint else ""
+        raise SystemExit(f"Write failed: {error}{resume}")
+
+
+def synthetic_series(metrics, tag_keys, tag_values):
+    """Every combination of metric name and tag values: metrics * tag_values ** tag_keys series"""
+    for index in range(metrics * tag_values ** tag_keys):
+        rest = index // metrics
+        tags = {}
+        for key in range(tag_keys):
+            tags[f"tag_{key}"] = f"value_{rest % tag_values}"
+            rest //= tag_values
+        yield f"synthetic.metric_{index % metrics}", tags
+
+
+def synthetic_metrics(args):
+    """Points for every series at each --interval over the last --duration, as random walks"""
+    rng = random.Random(args.seed)
+    series = list(synthetic_series(args.metrics, args.tag_keys, args.tag_values))
+    interval = parse_duration(args.interval)
+    steps = parse_duration(args.duration) // interval
+    interval = interval // timedelta(microseconds=1) * 1000
+    end = time.time_ns() // interval * interval
+    values = [rng.uniform(0, 100) for _ in series]
+    for step in range(steps):
+        timestamp = end - (steps - 1 - step) * interval
+        for index, (name, tags) in enumerate(series):
+            values[index] = abs(values[index] + rng.gauss(0, 1))
+            yield Metric(name, values[index], tags, timestamp, args.source)
+
+
+def generate(args):
+    series = args.metrics * args.tag_values ** args.tag_keys
+    steps = parse_duration(args.duration) // parse_duration(args.interval)
+    print(f"Generating {series} series x {steps} points = {series * steps} points")
+
+    if args.output:
+        started = time.monotonic()
+        if args.output.endswith(".gz"):
+            output = gzip.open(args.output, "wt", encoding="utf-8", compresslevel=6)
+        else:
+            output = open(args.output, "w", encoding="utf-8")
+        count = 0
+        with output as f:
+            for metric in synthetic_metrics(args):
+                f.write(client_line(metric))
+                f.write("\n")
+                count += 1
+        elapsed = time.monotonic() - started
+        print(f"Wrote {count} points to {args.output} in {elapsed:.1f}s ({count / elapsed:.0f} points/s)")
+        return
+
+    write = (lambda body: None) if args.dry_run else influx_writer(args.retries)
+    loader = Loader(write, writers=args.writers, report_interval=args.report_interval)
+    batch = []
+    try:
+        for metric in synthetic_metrics(args):
+            batch.append(encode_line(metric))
+            if len(batch) >= args.batch_size:
+                if not loader.submit(batch, None):
+                    break
+                batch = []
+        if batch:
+            loader.submit(batch, None)
+    except KeyboardInterrupt:
+        print("Interrupted, waiting for the batches in flight")
+    finished(loader.close())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    writing = argparse.ArgumentParser(add_help=False)
+    writing.add_argument("--batch-size", type=int, default=5000, help="points per write request")
+    writing.add_argument("--writers", type=int, default=4, help="concurrent write requests")
+    writing.add_argument("--retries", type=int, default=5, help="retries of a failed write before giving up")
+    writing.add_argument("--report-interval", type=float, default=5.0, help="seconds between progress lines")
+    writing.add_argument("--dry-run", action="store_true", help="read and encode everything but write nothing")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load_parser = commands.add_parser("load", parents=[writing], help="load files into InfluxDB")
+    load_parser.add_argument("inputs", nargs="+", help="CSV, NDJSON or line protocol files, optionally .gz")
+    load_parser.add_argument("--format", choices=["csv", "ndjson", "line"],
+                             help="format of every input (default: from each file's extension)")
+    load_parser.add_argument("--precision", choices=list(PRECISIONS), default="ns",
+                             help="unit of integer timestamps in the input")
+    load_parser.add_argument("--checkpoint", help="file to save progress to and resume from")
+    load_parser.add_argument("--checkpoint-interval", type=float, default=5.0,
+                             help="seconds between checkpoint saves")
+    load_parser.add_argument("--max-errors", type=int, default=10, help="rejected lines to print")
+
+    generate_parser = commands.add_parser("generate", parents=[writing], help="generate a synthetic dataset")
+    generate_parser.add_argument("--metrics", type=int, default=10, help="metric names")
+    generate_parser.add_argument("--tag-keys", type=int, default=2, help="tag keys per series")
+    generate_parser.add_argument("--tag-values", type=int, default=10, help="values per tag key")
+    generate_parser.add_argument("--duration", default="1d", help="time span to fill, as a duration such as 7d")
+    generate_parser.add_argument("--interval", default="60s", help="time between the points of a series")
+    generate_parser.add_argument("--source", default="bulk-load", help="source of every point")
+    generate_parser.add_argument("--seed", type=int, default=1)
+    generate_parser.add_argument("--output", help="write client line protocol to this file (.gz to compress) "
+                                                  "instead of InfluxDB, to load later")
+
+    args = parser.parse_args()
+    try:
+        if args.command == "load":
+            load(args)
+        else:
+            generate(args)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+
+if __name__ == "__main__":
+    main()
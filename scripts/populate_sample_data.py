@@ -32,6 +32,8 @@ def populate_sample_data():
     start_time = now - timedelta(hours=6)
 
     metrics_count = 0
+    # Collected and written in one request instead of a round trip per point
+    points = []
 
     # Button clicks - high frequency
     print("Generating button click metrics...")
@@ -39,7 +41,7 @@ def populate_sample_data():
         timestamp = start_time + timedelta(
             seconds=random.randint(0, 21600)  # Random time in last 6 hours
         )
-        influxdb.write_metric(
+        points.append(influxdb.build_point(
             name="button_clicks",
             value=random.randint(200, 1500),
             tags={
@@ -48,7 +50,7 @@ def populate_sample_data():
             },
             timestamp=timestamp,
             source="web-app",
-        )
+        ))
         metrics_count += 1
 
     # API requests - medium frequency with response times
@@ -58,7 +60,7 @@ def populate_sample_data():
 
     for i in range(40):
         timestamp = start_time + timedelta(seconds=random.randint(0, 21600))
-        influxdb.write_metric(
+        points.append(influxdb.build_point(
             name="api_requests",
             value=random.uniform(0.05, 2.5),  # Response time in seconds
             tags={
@@ -68,7 +70,7 @@ def populate_sample_data():
             },
             timestamp=timestamp,
             source="api-server",
-        )
+        ))
         metrics_count += 1
 
     # Page views - high frequency
@@ -77,7 +79,7 @@ def populate_sample_data():
 
     for i in range(60):
         timestamp = start_time + timedelta(seconds=random.randint(0, 21600))
-        influxdb.write_metric(
+        points.append(influxdb.build_point(
             name="page_views",
             value=random.randint(200, 1500),
             tags={
@@ -86,7 +88,7 @@ def populate_sample_data():
             },
             timestamp=timestamp,
             source="web-app",
-        )
+        ))
         metrics_count += 1
 
     # Error counts - lower frequency
@@ -95,7 +97,7 @@ def populate_sample_data():
 
     for i in range(15):
         timestamp = start_time + timedelta(seconds=random.randint(0, 21600))
-        influxdb.write_metric(
+        points.append(influxdb.build_point(
             name="errors",
             value=random.randint(1, 5),
             tags={
@@ -104,14 +106,14 @@ def populate_sample_data():
             },
             timestamp=timestamp,
             source="api-server",
-        )
+        ))
         metrics_count += 1
 
     # CPU usage - continuous metric
     print("Generating CPU usage metrics...")
     for i in range(30):
         timestamp = start_time + timedelta(seconds=random.randint(0, 21600))
-        influxdb.write_metric(
+        points.append(influxdb.build_point(
             name="cpu_usage",
             value=random.uniform(10.0, 95.0),  # CPU percentage
             tags={
@@ -120,14 +122,14 @@ def populate_sample_data():
             },
             timestamp=timestamp,
             source="monitoring-agent",
-        )
+        ))
         metrics_count += 1
 
     # Memory usage
     print("Generating memory usage metrics...")
     for i in range(30):
         timestamp = start_time + timedelta(seconds=random.randint(0, 21600))
-        influxdb.write_metric(
+        points.append(influxdb.build_point(
             name="memory_usage",
             value=random.uniform(40.0, 90.0),  # Memory percentage
             tags={
@@ -136,14 +138,14 @@ def populate_sample_data():
             },
             timestamp=timestamp,
             source="monitoring-agent",
-        )
+        ))
         metrics_count += 1
 
     # Database query time
     print("Generating database query metrics...")
     for i in range(25):
         timestamp = start_time + timedelta(seconds=random.randint(0, 21600))
-        influxdb.write_metric(
+        points.append(influxdb.build_point(
             name="db_query_time",
             value=random.uniform(0.01, 0.5),  # Query time in seconds
             tags={
@@ -152,9 +154,13 @@ def populate_sample_data():
             },
             timestamp=timestamp,
             source="database",
-        )
+        ))
         metrics_count += 1
 
+    print(f"Writing {len(points)} points...")
+    if not influxdb.write_points(points):
+        influxdb.close()
+        sys.exit(1)
     influxdb.close()
 
     print(f"✓ Successfully inserted {metrics_count} sample metrics!")